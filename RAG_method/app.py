@@ -9,12 +9,13 @@ import gradio as gr
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
 from multimodal_rag import DiabetesKnowledgeBase
+from models import ollama_base_url
 
 # Check if Ollama and required models are installed
 def check_models():
     # Check if Ollama server is running
     try:
-        response = subprocess.run(["curl", "-s", "http://localhost:11434/api/version"], 
+        response = subprocess.run(["curl", "-s", f"{ollama_base_url}/api/version"], 
                                  check=True, capture_output=True, shell=True)
         print("Ollama server is running.")
     except (subprocess.CalledProcessError, FileNotFoundError):
@@ -92,7 +93,10 @@ def main():
         ]
     )
     
-    demo.launch(share=True)
+    try:
+        demo.launch(share=True)
+    finally:
+        kb.close()
     
 if __name__ == "__main__":
     main()
@@ -0,0 +1,100 @@
+import os
+import sys
+import time
+import zlib
+import argparse
+import statistics
+import numpy as np
+
+# Add the current directory to the path
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from rerank import embed_contents, rerank
+
+# Compares the similarity filter of get_contexts_for_question before and after batching, at several k.
+# The old filter embedded every candidate on its own and scored it with a scalar cosine, the new one
+# embeds all candidates in one call and scores them with one matrix product.
+# By default the embedding model is simulated with a fixed cost per call plus a small cost per text,
+# --real uses the sentence transformer from init_embeddings.
+
+question = "What is the HbA1c target for most adults with diabetes?"
+
+class SimulatedEmbeddings:
+    def __init__(self, call_ms: float, item_ms: float, dim: int = 384):
+        self.call_ms = call_ms
+        self.item_ms = item_ms
+        self.dim = dim
+
+    def _vector(self, text: str) -> list[float]:
+        return np.random.default_rng(zlib.crc32(text.encode('utf-8'))).standard_normal(self.dim).tolist()
+
+    def embed_query(self, text: str) -> list[float]:
+        return self.embed_documents([text])[0]
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        time.sleep((self.call_ms + self.item_ms * len(texts)) / 1000)
+        return [self._vector(text) for text in texts]
+
+def make_candidates(n: int) -> list[str]:
+    topics = ["insulin dosing", "HbA1c targets", "hypoglycemia treatment", "foot care", "retinopathy screening"]
+    return [f"Chunk {i} about {topics[i % len(topics)]} in adults with type {1 + i % 2} diabetes." for i in range(n)]
+
+# The filter as it was: one embed_documents call and one scalar cosine per candidate
+def per_doc_rerank(embeddings, question_embedding, contents: list[str], k: int, similarity_threshold: float) -> list[str]:
+    scored = []
+    for content in contents:
+        content_embedding = np.array(embeddings.embed_documents([content])[0])
+        query = np.array(question_embedding)
+        norm = np.linalg.norm(query) * np.linalg.norm(content_embedding)
+        similarity = np.dot(query, content_embedding) / norm if norm else 0
+        if similarity < similarity_threshold:
+            continue
+        scored.append((content, similarity))
+    scored.sort(key=lambda x: x[1], reverse=True)
+    return [content for content, _ in scored[:k]]
+
+def batched_rerank(embeddings, question_embedding, contents: list[str], k: int, similarity_threshold: float) -> list[str]:
+    content_embeddings = embed_contents(embeddings, contents, [None] * len(contents))
+    return rerank(question_embedding, contents, content_embeddings, k, similarity_threshold)
+
+def time_runs(fn, runs: int) -> tuple[list[float], list[str]]:
+    latencies = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        result = fn()
+        latencies.append(time.perf_counter() - start)
+    return latencies, result
+
+def main():
+    parser = argparse.ArgumentParser(description="Latency of per-document vs batched similarity filtering")
+    parser.add_argument("--k", type=int, nargs="+", default=[10, 50, 200])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--threshold", type=float, default=0.0)
+    parser.add_argument("--call-ms", type=float, default=8, help="Simulated cost of one embedding call")
+    parser.add_argument("--item-ms", type=float, default=0.5, help="Simulated extra cost per embedded text")
+    parser.add_argument("--real", action="store_true", help="Use the real embedding model instead of a simulation")
+    args = parser.parse_args()
+
+    if args.real:
+        from models import init_embeddings
+        embeddings = init_embeddings()
+    else:
+        embeddings = SimulatedEmbeddings(args.call_ms, args.item_ms)
+
+    question_embedding = embeddings.embed_query(question)
+    for k in args.k:
+        # get_contexts_for_question filters twice as many candidates as it returns
+        contents = make_candidates(k * 2)
+
+        old_latencies, old_result = time_runs(
+            lambda: per_doc_rerank(embeddings, question_embedding, contents, k, args.threshold), args.runs)
+        new_latencies, new_result = time_runs(
+            lambda: batched_rerank(embeddings, question_embedding, contents, k, args.threshold), args.runs)
+
+        old_ms = statistics.median(old_latencies) * 1000
+        new_ms = statistics.median(new_latencies) * 1000
+        print(f"k={k:<4} candidates={len(contents):<4} per-doc {old_ms:9.1f} ms  batched {new_ms:8.1f} ms  "
+              f"speedup {old_ms / new_ms:6.1f}x  same results: {old_result == new_result}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+import os
+import pickle
+import sqlite3
+import threading
+from typing import Any, Iterator, Optional, Sequence
+from langchain_core.stores import BaseStore
+
+# Number of keys looked up per "in (...)" query, sqlite limits the amount of bound parameters
+_BATCH = 500
+
+# Disk-backed docstore for the MultiVectorRetriever.
+# Every mset/mdelete is its own sqlite transaction, so ingest only appends the new chunks
+# and a crash never leaves a half written store. Nothing is loaded until it is asked for.
+class SQLiteDocStore(BaseStore[str, Any]):
+    def __init__(self, path: str):
+        self.path = path
+        self._connection: sqlite3.Connection | None = None
+        self._lock = threading.Lock()
+
+    # Open the database on first use
+    def _connect(self) -> sqlite3.Connection:
+        if self._connection is None:
+            connection = sqlite3.connect(self.path, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL;")
+            connection.execute("PRAGMA synchronous=NORMAL;")
+            connection.execute("PRAGMA mmap_size=268435456;")  # 256 MB
+            connection.execute("CREATE TABLE IF NOT EXISTS docs (key TEXT PRIMARY KEY, value BLOB NOT NULL)")
+            connection.commit()
+            self._connection = connection
+        return self._connection
+
+    def mget(self, keys: Sequence[str]) -> list[Optional[Any]]:
+        found = {}
+        with self._lock:
+            connection = self._connect()
+            for i in range(0, len(keys), _BATCH):
+                batch = list(keys[i:i + _BATCH])
+                placeholders = ",".join("?" * len(batch))
+                rows = connection.execute(f"SELECT key, value FROM docs WHERE key IN ({placeholders})", batch)
+                for key, value in rows:
+                    found[key] = pickle.loads(value)
+        return [found.get(key) for key in keys]
+
+    def mset(self, key_value_pairs: Sequence[tuple[str, Any]]) -> None:
+        rows = [(key, pickle.dumps(value)) for key, value in key_value_pairs]
+        with self._lock:
+            connection = self._connect()
+            with connection:
+                connection.executemany("INSERT OR REPLACE INTO docs (key, value) VALUES (?, ?)", rows)
+
+    def mdelete(self, keys: Sequence[str]) -> None:
+        with self._lock:
+            connection = self._connect()
+            with connection:
+                connection.executemany("DELETE FROM docs WHERE key = ?", [(key,) for key in keys])
+
+    def yield_keys(self, *, prefix: Optional[str] = None) -> Iterator[str]:
+        with self._lock:
+            connection = self._connect()
+            if prefix is None:
+                keys = [row[0] for row in connection.execute("SELECT key FROM docs")]
+            else:
+                keys = [row[0] for row in connection.execute(
+                    "SELECT key FROM docs WHERE substr(key, 1, ?) = ?", (len(prefix), prefix))]
+        yield from keys
+
+    def count(self) -> int:
+        with self._lock:
+            return self._connect().execute("SELECT COUNT(*) FROM docs").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+    # Copy the documents of an old pickled InMemoryStore into this store.
+    # The pickle file is left untouched.
+    def import_pickle(self, pickle_path: str) -> int:
+        if not os.path.exists(pickle_path):
+            return 0
+
+        with open(pickle_path, 'rb') as f:
+            old_store = pickle.load(f)
+
+        items = list(old_store.store.items())
+        if items:
+            self.mset(items)
+        return len(items)
@@ -0,0 +1,117 @@
+import os
+import time
+import threading
+import unicodedata
+from collections import OrderedDict
+from typing import List, Optional
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+embedding_cache_size = int(os.getenv("EMBEDDING_CACHE_SIZE", "20000"))
+embedding_cache_ttl_seconds = float(os.getenv("EMBEDDING_CACHE_TTL_SECONDS", "86400"))
+
+# The same text always maps to the same key, whatever its spacing, unicode form or case.
+# all-MiniLM-L6-v2 lowercases its input anyway, so case never changes the vector.
+def normalize_text(text: str) -> str:
+    return " ".join(unicodedata.normalize("NFC", text).split()).casefold()
+
+# Bounded in-memory LRU of embeddings keyed by (model name, normalized text).
+# Entries older than ttl_seconds are treated as missing, a ttl of 0 keeps them until they are evicted.
+class EmbeddingCache:
+    def __init__(self, max_entries: int = embedding_cache_size, ttl_seconds: float = embedding_cache_ttl_seconds):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries: OrderedDict[tuple[str, str], tuple[float, np.ndarray]] = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    # Look up many texts at once, returns the vector of every text or None where it is missing
+    def get_many(self, model_name: str, texts: List[str]) -> List[Optional[np.ndarray]]:
+        now = time.monotonic()
+        found = []
+        with self._lock:
+            for text in texts:
+                key = (model_name, normalize_text(text))
+                entry = self._entries.get(key)
+                if entry is not None and self.ttl_seconds and now - entry[0] > self.ttl_seconds:
+                    del self._entries[key]
+                    self.expirations += 1
+                    entry = None
+
+                if entry is None:
+                    self.misses += 1
+                    found.append(None)
+                else:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    found.append(entry[1])
+        return found
+
+    def put_many(self, model_name: str, texts: List[str], vectors) -> None:
+        now = time.monotonic()
+        with self._lock:
+            for text, vector in zip(texts, vectors):
+                key = (model_name, normalize_text(text))
+                self._entries[key] = (now, np.asarray(vector, dtype=np.float32))
+                self._entries.move_to_end(key)
+
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+            }
+
+# One cache for the whole process, so retrieval, reranking and eval share every embedding
+embedding_cache = EmbeddingCache()
+
+# Embeddings that go through the cache first, only texts missing from it reach the model, in one batch.
+# The model embeds queries and documents the same way, so both share the cache entries.
+class CachedEmbeddings(Embeddings):
+    def __init__(self, embeddings: Embeddings, model_name: str, cache: EmbeddingCache = embedding_cache):
+        self.embeddings = embeddings
+        self.model_name = model_name
+        self.cache = cache
+
+    def _embed(self, texts: List[str]) -> List[np.ndarray]:
+        vectors = self.cache.get_many(self.model_name, texts)
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+
+        if missing:
+            # a text can repeat within one call, it is embedded once
+            missing_texts = list(dict.fromkeys(normalize_text(texts[i]) for i in missing))
+            originals = {normalize_text(texts[i]): texts[i] for i in missing}
+            new_vectors = self.embeddings.embed_documents([originals[text] for text in missing_texts])
+            self.cache.put_many(self.model_name, missing_texts, new_vectors)
+
+            by_text = dict(zip(missing_texts, new_vectors))
+            for i in missing:
+                vectors[i] = np.asarray(by_text[normalize_text(texts[i])], dtype=np.float32)
+        return vectors
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [vector.tolist() for vector in self._embed(list(texts))]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._embed([text])[0].tolist()
+
+    # Same as SentenceTransformer.encode, so eval can use the cached model in its place
+    def encode(self, texts: List[str]) -> np.ndarray:
+        return np.stack(self._embed(list(texts))) if texts else np.zeros((0, 0), dtype=np.float32)
+
+    def stats(self) -> dict:
+        return self.cache.stats()
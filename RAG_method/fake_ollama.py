@@ -0,0 +1,145 @@
+import os
+import re
+import json
+import time
+import random
+import hashlib
+import argparse
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Stand-in for the Ollama server with the endpoints models.py uses: /api/generate, /api/chat, /api/tags
+# and /api/version. Answers are deterministic, the same prompt always gives the same text, and arrive
+# after a configurable first token latency at a configurable token rate, streamed as NDJSON like Ollama.
+# Ingest, retrieval and load tests can then run on any machine and measure our code apart from the model:
+#   python fake_ollama.py --port 11434    (or point OLLAMA_BASE_URL at another port)
+
+fake_first_token_ms = float(os.getenv("FAKE_LLM_FIRST_TOKEN_MS", "50"))
+fake_tokens_per_second = float(os.getenv("FAKE_LLM_TOKENS_PER_SECOND", "100"))  # 0 sends every token at once
+fake_max_tokens = int(os.getenv("FAKE_LLM_MAX_TOKENS", "64"))
+fake_seed = os.getenv("FAKE_LLM_SEED", "0")
+
+_WORD = re.compile(r"[A-Za-z][A-Za-z\-]{3,}")
+_FALLBACK_WORDS = ["diabetes", "insulin", "glucose", "patients", "therapy", "monitoring", "treatment", "risk"]
+
+# The answer is made of words of the prompt itself, so summaries stay close to the text they summarize
+def fake_completion(prompt: str, max_tokens: int = fake_max_tokens, seed: str = fake_seed) -> list[str]:
+    rng = random.Random(hashlib.sha256(f"{seed}\0{prompt}".encode('utf-8')).digest())
+    words = _WORD.findall(prompt) or _FALLBACK_WORDS
+    tokens = [rng.choice(words).lower() for _ in range(max_tokens)]
+    tokens[0] = tokens[0].capitalize()
+    tokens[-1] += "."
+    return [token if i == 0 else " " + token for i, token in enumerate(tokens)]
+
+# The model's output as (token, seconds to wait before it)
+def timed_tokens(prompt: str, options: dict, first_token_ms: float, tokens_per_second: float):
+    tokens = fake_completion(prompt, int(options.get("num_predict") or fake_max_tokens))
+    for i, token in enumerate(tokens):
+        if i == 0:
+            yield token, first_token_ms / 1000
+        else:
+            yield token, 1 / tokens_per_second if tokens_per_second > 0 else 0
+
+def _now() -> str:
+    return datetime.now(timezone.utc).isoformat().replace("+00:00", "Z")
+
+class FakeOllamaHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    first_token_ms = fake_first_token_ms
+    tokens_per_second = fake_tokens_per_second
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, payload: dict, status: int = 200):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_chunk(self, payload: dict):
+        line = (json.dumps(payload) + "\n").encode('utf-8')
+        self.wfile.write(f"{len(line):X}\r\n".encode('ascii') + line + b"\r\n")
+        self.wfile.flush()
+
+    def do_GET(self):
+        if self.path == "/api/version":
+            self._send_json({"version": "0.0.0-fake"})
+        elif self.path == "/api/tags":
+            self._send_json({"models": [{"name": name, "model": name, "size": 0} for name in ["llama2:latest", "llava:latest"]]})
+        elif self.path == "/":
+            self._send_json({"status": "Ollama is running"})
+        else:
+            self._send_json({"error": "not found"}, 404)
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        if self.path == "/api/generate":
+            prompt = request.get("prompt", "")
+            message = lambda text: {"response": text}
+        elif self.path == "/api/chat":
+            prompt = "\n".join(m.get("content", "") for m in request.get("messages", []))
+            message = lambda text: {"message": {"role": "assistant", "content": text}}
+        else:
+            self._send_json({"error": "not found"}, 404)
+            return
+
+        started = time.perf_counter()
+        base = {"model": request.get("model", "llama2")}
+        options = request.get("options") or {}
+        tokens = []
+
+        # Ollama streams unless it is told not to
+        if request.get("stream", True):
+            self.send_response(200)
+            self.send_header("Content-Type", "application/x-ndjson")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            for token, delay in timed_tokens(prompt, options, self.first_token_ms, self.tokens_per_second):
+                time.sleep(delay)
+                tokens.append(token)
+                self._send_chunk({**base, "created_at": _now(), **message(token), "done": False})
+            self._send_chunk({**base, "created_at": _now(), **message(""), **self._final(prompt, tokens, started)})
+            self.wfile.write(b"0\r\n\r\n")
+            return
+
+        for token, delay in timed_tokens(prompt, options, self.first_token_ms, self.tokens_per_second):
+            time.sleep(delay)
+            tokens.append(token)
+        self._send_json({**base, "created_at": _now(), **message("".join(tokens)), **self._final(prompt, tokens, started)})
+
+    # The closing fields of a response, durations are in nanoseconds like Ollama's
+    def _final(self, prompt: str, tokens: list[str], started: float) -> dict:
+        total = int((time.perf_counter() - started) * 1e9)
+        return {
+            "done": True,
+            "done_reason": "stop",
+            "total_duration": total,
+            "load_duration": 0,
+            "prompt_eval_count": len(prompt.split()),
+            "prompt_eval_duration": 0,
+            "eval_count": len(tokens),
+            "eval_duration": total,
+        }
+
+def main():
+    parser = argparse.ArgumentParser(description="Deterministic fake Ollama server for offline performance tests")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=11434)
+    parser.add_argument("--first-token-ms", type=float, default=fake_first_token_ms)
+    parser.add_argument("--tokens-per-second", type=float, default=fake_tokens_per_second)
+    args = parser.parse_args()
+
+    FakeOllamaHandler.first_token_ms = args.first_token_ms
+    FakeOllamaHandler.tokens_per_second = args.tokens_per_second
+    server = ThreadingHTTPServer((args.host, args.port), FakeOllamaHandler)
+    print(f"Fake Ollama listening on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+if __name__ == "__main__":
+    main()
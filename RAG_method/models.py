@@ -1,33 +1,55 @@
 import os
 import base64
+import hashlib
 import requests
 from langchain_ollama import ChatOllama, OllamaLLM
 from langchain_core.output_parsers import StrOutputParser
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_huggingface import HuggingFaceEmbeddings
+from embedding_cache import CachedEmbeddings
 
+# Where the Ollama server runs, point it at fake_ollama.py to test without the models
+default_ollama_base_url = "http://localhost:11434"
+ollama_base_url = os.getenv("OLLAMA_BASE_URL", default_ollama_base_url)
+# Summaries and descriptions from any other server, fake_ollama.py included, go to a data directory
+# of their own, so a run against the local Ollama never reads them
+processed_dir_name = "processed" if ollama_base_url == default_ollama_base_url else \
+    "processed_" + hashlib.sha256(ollama_base_url.encode('utf-8')).hexdigest()[:8]
 
 # Initialize the text-based LLM (llama2)
 def init_text_model():
-    return OllamaLLM(model="llama2")
+    return OllamaLLM(model="llama2", base_url=ollama_base_url)
 
 # Initialize the chat-based LLM (Llama2)
 def init_chat_model():
-    return ChatOllama(model="llama2", max_tokens=512)
+    return ChatOllama(model="llama2", max_tokens=512, base_url=ollama_base_url)
 
-# Initialize the embeddings model
+embedding_model_name = "sentence-transformers/all-MiniLM-L6-v2"
+
+# Initialize the embeddings model, every embedding goes through the shared embedding cache
 def init_embeddings():
-    return HuggingFaceEmbeddings(model_name="sentence-transformers/all-MiniLM-L6-v2")
+    return CachedEmbeddings(HuggingFaceEmbeddings(model_name=embedding_model_name), embedding_model_name)
+
+# The summary model and prompt, together they decide which cached summaries are still valid.
+# The server is part of the model, a summary cache copied between data directories stays correct too.
+summary_model_id = "ollama/llama2" if ollama_base_url == default_ollama_base_url else f"ollama/llama2@{ollama_base_url}"
+summary_prompt_text = """You are an assistant with diabetes medical expertise tasked with summarizing tables and text. 
+    Give a concise summary of the table or text. Table or text chunk: {element}"""
 
 # Create a chain for summarizing text
 def get_text_summary_chain():
-    prompt_text = """You are an assistant with diabetes medical expertise tasked with summarizing tables and text. 
-    Give a concise summary of the table or text. Table or text chunk: {element}"""
-    
-    prompt = ChatPromptTemplate.from_template(prompt_text)
+    prompt = ChatPromptTemplate.from_template(summary_prompt_text)
     model = init_text_model()
     return {"element": lambda x: x} | prompt | model | StrOutputParser()
 
+# Create a chain that rewrites a question a few ways, one per line, for multi-query retrieval
+def get_paraphrase_chain(n: int = 2):
+    prompt = ChatPromptTemplate.from_template(
+        "Rewrite the following question about diabetes in " + str(n) + " different ways. "
+        "Keep the medical terms, write one question per line and nothing else. Question: {question}"
+    )
+    return {"question": lambda x: x} | prompt | init_text_model() | StrOutputParser()
+
 # Process an image with LLaVA to get a description
 # Process an image with LLaVA using Ollama API
 def process_image_with_llava(image_path):
@@ -40,7 +62,7 @@ def process_image_with_llava(image_path):
             image_data = base64.b64encode(img_file.read()).decode("utf-8")
         
         # Prepare the API request
-        url = "http://localhost:11434/api/generate"
+        url = f"{ollama_base_url}/api/generate"
         prompt = """ 
         Describe this image in detail. If it contains graphs, charts, or illustrations related to diabetes, 
         explain what they show regarding diabetes management, treatment, or monitoring.
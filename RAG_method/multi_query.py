@@ -0,0 +1,68 @@
+import os
+import re
+from concurrent.futures import Executor
+from typing import Callable, List, Sequence
+
+# Multi-query retrieval: a compound question is searched as several sub-queries side by side
+multi_query_enabled = os.getenv("MULTI_QUERY", "false") == "true"
+multi_query_paraphrase = os.getenv("MULTI_QUERY_PARAPHRASE", "false") == "true"
+multi_query_max = int(os.getenv("MULTI_QUERY_MAX", "4"))
+multi_query_workers = int(os.getenv("MULTI_QUERY_WORKERS", "4"))
+
+_QUESTION_WORDS = r"(?:how|what|why|when|which|who|where|is|are|does|do|did|can|should|could|was|were)\b"
+# Independent clauses: a new sentence, or "and"/"or" followed by a new question word
+_CLAUSE = re.compile(rf"\?\s+|;\s*|\.\s+(?=[A-Z])|,?\s+(?:and|or|as well as)\s+(?={_QUESTION_WORDS})", re.I)
+_PREPOSITION = re.compile(r"\b(?:of|for|in|by|on|with|to|from|about|among)\s+", re.I)
+_BOTH = re.compile(r"\b(?:both|either)\s+", re.I)
+
+def _outside_parentheses(text: str, position: int) -> bool:
+    return text.count("(", 0, position) == text.count(")", 0, position)
+
+# "criteria used by the WHO and the ADA to define diabetes" becomes one query per conjunct: the left one
+# is the text before "and", the right one repeats the left one up to its last preposition
+def _split_conjunction(clause: str) -> List[str]:
+    matches = [m for m in re.finditer(r"\s+(?:and|or)\s+", clause) if _outside_parentheses(clause, m.start())]
+    if len(matches) != 1:
+        return []
+
+    left = _BOTH.sub("", clause[:matches[0].start()])
+    right = clause[matches[0].end():]
+    prepositions = list(_PREPOSITION.finditer(left))
+    if not prepositions or len(right.split()) < 2:
+        return []
+    return [left, left[:prepositions[-1].end()] + right]
+
+# Split a question into the queries to search, the question itself always comes first
+def decompose(question: str, max_queries: int = multi_query_max) -> List[str]:
+    question = " ".join(question.split())
+    queries = [question]
+    for clause in _CLAUSE.split(question):
+        clause = clause.strip(" ?.,;")
+        queries.extend([clause] + _split_conjunction(clause))
+
+    unique = {}
+    for query in queries:
+        query = query.strip(" ?.,;")
+        if len(query.split()) >= 3:
+            unique.setdefault(query.lower(), query)
+    return list(unique.values())[:max_queries]
+
+# Lines of a paraphrase answer without their numbering or bullets
+def parse_paraphrases(text: str) -> List[str]:
+    lines = (re.sub(r"^\s*(?:\d+[.)]|[-*])\s*", "", line).strip() for line in text.split("\n"))
+    return [line for line in lines if len(line.split()) >= 3]
+
+# Interleave the rankings of the sub-queries, a doc_id found by several keeps its best rank
+def merge_rankings(rankings: Sequence[Sequence[str]]) -> List[str]:
+    merged = {}
+    for rank in range(max((len(ranking) for ranking in rankings), default=0)):
+        for ranking in rankings:
+            if rank < len(ranking):
+                merged.setdefault(ranking[rank], None)
+    return list(merged)
+
+# Search every query vector at once on the executor and merge the results, wall-clock time stays
+# close to the slowest single search
+def fan_out(search: Callable[[Sequence[float]], List[str]], query_vectors: Sequence[Sequence[float]],
+            executor: Executor) -> List[str]:
+    return merge_rankings(list(executor.map(search, query_vectors)))
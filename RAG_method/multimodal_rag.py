@@ -1,7 +1,7 @@
 import os
-import uuid
 import json
-import pickle
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
 from typing import List
 from pathlib import Path
 from datetime import datetime
@@ -10,7 +10,6 @@ from pydantic import BaseModel
 from unstructured.partition.pdf import partition_pdf
 
 from langchain.retrievers.multi_vector import MultiVectorRetriever
-from langchain.storage import InMemoryStore
 from langchain_chroma import Chroma
 from langchain_core.documents import Document
 from langchain_core.runnables import RunnablePassthrough
@@ -18,7 +17,11 @@ from langchain_core.runnables import RunnableLambda
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.output_parsers import StrOutputParser
 
-from models import init_embeddings, init_chat_model, get_text_summary_chain, process_image_with_llava
+from models import init_embeddings, init_chat_model, get_text_summary_chain, get_paraphrase_chain, process_image_with_llava, summary_model_id, summary_prompt_text, processed_dir_name
+from summary_cache import SummaryCache
+from docstore import SQLiteDocStore
+from rerank import embed_contents, rerank
+from multi_query import decompose, fan_out, parse_paraphrases, multi_query_enabled, multi_query_paraphrase, multi_query_max, multi_query_workers
 
 class Element(BaseModel):
     type: str
@@ -33,21 +36,28 @@ class DiabetesKnowledgeBase:
         Path(self.image_dir).mkdir(parents=True, exist_ok=True)
 
         # Create a directory to store processed data
-        self.processed_dir = os.path.join(data_dir, "processed")
+        self.processed_dir = os.path.join(data_dir, processed_dir_name)
         Path(self.processed_dir).mkdir(parents=True, exist_ok=True)
 
         # Create a file to track processed PDFs and their timestamps
         self.processed_log_path = os.path.join(self.processed_dir, "processed_files.json")
         self.processed_files = self._load_processed_files()
 
+        # Lists the documents of the file being committed, see _recover_ingest
+        self.journal_path = os.path.join(self.processed_dir, "ingest_journal.json")
+
         # Create a path for the persisted vector store
         self.vectorstore_path = os.path.join(self.processed_dir, "chroma_db")
-        self.docstore_path = os.path.join(self.processed_dir, "docstore.pkl")
+        self.docstore_path = os.path.join(self.processed_dir, "docstore.sqlite")
+        self.legacy_docstore_path = os.path.join(self.processed_dir, "docstore.pkl")
 
         # Initialize components
         self.embeddings = init_embeddings()
         self.chat_model = init_chat_model()
         self.summary_chain = get_text_summary_chain()
+        self.summary_cache = SummaryCache(
+            os.path.join(self.processed_dir, "summary_cache.sqlite"), summary_model_id, summary_prompt_text
+        )
         
         # Initialze the retriever system
         self.vectorstore = Chroma(
@@ -56,29 +66,31 @@ class DiabetesKnowledgeBase:
             persist_directory=self.vectorstore_path
         )
 
-        # Load docstore if it exists, otherwise create new one
-        if os.path.exists(self.docstore_path):
-            with open(self.docstore_path, 'rb') as f:
-                self.store = pickle.load(f)
-            
-            # Get document count using the yield_keys method
-            try:
-                doc_count = sum(1 for _ in self.store.yield_keys())
-                print(f"Loaded existing docstore with {doc_count} documents.")
-            except Exception as e:
-                print(f"Loaded existing docstore. Unable to count documents: {str(e)}")
-        else:
-            self.store = InMemoryStore()
-            print("Created new docstore!")
+        # Open the docstore, documents are only read from disk when the retriever asks for them
+        self.store = SQLiteDocStore(self.docstore_path)
+
+        # Move an old pickled docstore over the first time, the import is one transaction so a crash just retries it
+        if self.store.count() == 0 and os.path.exists(self.legacy_docstore_path):
+            imported = self.store.import_pickle(self.legacy_docstore_path)
+            print(f"Imported {imported} documents from {self.legacy_docstore_path}.")
+
+        print(f"Opened docstore with {self.store.count()} documents.")
         
-       
         self.id_key = "doc_id"
+
+        # Undo whatever a killed ingest left half written
+        self._recover_ingest()
         
         self.retriever = MultiVectorRetriever(
             vectorstore=self.vectorstore,
             docstore=self.store,
             id_key=self.id_key
         )
+
+        # Compound questions are searched as several sub-queries at once, see get_contexts_for_question
+        self.multi_query = multi_query_enabled
+        self.search_pool = ThreadPoolExecutor(max_workers=multi_query_workers) if multi_query_enabled else None
+        self.paraphrase_chain = get_paraphrase_chain() if multi_query_enabled and multi_query_paraphrase else None
         
 
         # Initialize RAG chain
@@ -117,21 +129,20 @@ class DiabetesKnowledgeBase:
     
     # Save the log of processed files
     def _save_processed_files(self):
-        with open(self.processed_log_path, 'w') as f:
-            json.dump(self.processed_files, f)
+        self._write_json(self.processed_log_path, self.processed_files)
 
-    # Save the docstore to disk
-    def _persist_docstore(self):
+    # Write json to a temporary file first so a crash never leaves half a file behind
+    def _write_json(self, path: str, data):
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
 
-        with open(self.docstore_path, 'wb') as f:
-            pickle.dump(self.store, f)
-        
-        # Get document count using the yield_keys method
-        try:
-            doc_count = sum(1 for _ in self.store.yield_keys())
-            print(f"Persisted docstore with {doc_count} documents.")
-        except Exception as e:
-            print(f"Persisted docstore. Unable to count documents: {str(e)}")
+    # The docstore commits every write itself, this only reports its size
+    def _persist_docstore(self):
+        print(f"Persisted docstore with {self.store.count()} documents.")
 
 
     # Process a PDF file, extract text, tables, and images  
@@ -170,23 +181,13 @@ class DiabetesKnowledgeBase:
         text_elements = [e for e in categorized_elements if e.type == "text" and e.text != ""]
         texts = [i.text for i in text_elements]
         print(f"Summarizing {len(texts)} text chunks...")
-        text_summaries = self.summary_chain.batch(texts, {"max_concurrent": 1})
-
-        # Save the interim results to prevent data loss in case of interruption
-        interim_results_dir = os.path.join(self.processed_dir, f"{filename}_interim")
-        Path(interim_results_dir).mkdir(parents=True, exist_ok=True)
-
-        with open(os.path.join(interim_results_dir, "text_summaries.pkl"), 'wb') as f:
-            pickle.dump(text_summaries, f)
+        text_summaries = self._summarize(texts, max_concurrency=1)
         
         # Process table elements
         table_elements = [e for e in categorized_elements if e.type == "table"]
         tables = [i.text for i in table_elements]
         print(f"Summarizing {len(tables)} tables...")
-        table_summaries = self.summary_chain.batch(tables, {"max_concurrent": 5})
-
-        with open(os.path.join(interim_results_dir, "table_summaries.pkl"), 'wb') as f:
-            pickle.dump(table_summaries, f)
+        table_summaries = self._summarize(tables, max_concurrency=5)
         
         # Create a file to track processed images
         processed_images_path = os.path.join(self.processed_dir, "processed_images.json")
@@ -206,10 +207,16 @@ class DiabetesKnowledgeBase:
         
         # Filter out already processed images
         new_images = [img for img in recent_images if img not in processed_images]
+
+        # Images described by an earlier run that died before indexing them only need to be indexed
+        pending_images = [
+            img for img, record in processed_images.items()
+            if record["source_pdf"] == filename and not record.get("indexed") and img not in new_images
+        ]
         
         # Print debugging information
         print(f"Found {len(recent_images)} recently extracted images")
-        print(f"Processing {len(new_images)} new images")
+        print(f"Processing {len(new_images)} new images, resuming {len(pending_images)} already described images")
 
         # Load existing image descriptions if available
         image_descriptions_path = os.path.join(self.processed_dir, "image_descriptions.json")
@@ -238,47 +245,87 @@ class DiabetesKnowledgeBase:
                 "size_bytes": os.path.getsize(img_path)
             }
             
-            # Save descriptions and processed images record incrementally
-            with open(image_descriptions_path, 'w') as f:
-                json.dump(image_descriptions, f)
-                
-            with open(processed_images_path, 'w') as f:
-                json.dump(processed_images, f)
-            
-        # Save interim image descriptions
-        with open(os.path.join(interim_results_dir, "image_descriptions.json"), 'w') as f:
-            json.dump({img: image_descriptions[img] for img in new_images if img in image_descriptions}, f)
-            
+            # Save descriptions and processed images record incrementally, every image is a checkpoint
+            self._write_json(image_descriptions_path, image_descriptions)
+            self._write_json(processed_images_path, processed_images)
+
+        images = [img for img in pending_images + new_images if img in image_descriptions]
+        image_texts = [image_descriptions[img] for img in images]
+
+        # Everything the file adds goes in at once, the processed files log is the commit point.
+        # The journal lists the documents that were not in the knowledge base before,
+        # so a crash before the commit lets _recover_ingest take them out again.
+        documents = [
+            (texts, text_summaries, "text"),
+            (tables, table_summaries, "table"),
+            (image_texts, image_texts, "image"),
+        ]
+        added = [
+            doc_id for contents, _, content_type in documents
+            for doc_id in self._new_doc_ids(contents, content_type, filename)
+        ]
+        self._write_json(self.journal_path, {"file": filename, "mtime": file_mtime, "added": added})
+
         # Add to retriever (only if there are items to add)
-        if texts and text_summaries:
-            self._add_to_retriever(texts, text_summaries, "text", filename)
-            
-        if tables and table_summaries:
-            self._add_to_retriever(tables, table_summaries, "table", filename)
-            
-        # Add new image descriptions to retriever
-        if new_images:
-            new_image_descriptions = [image_descriptions[img] for img in new_images if img in image_descriptions]
-            if new_image_descriptions:
-                self._add_to_retriever(new_image_descriptions, new_image_descriptions, "image", filename)
+        for contents, summaries, content_type in documents:
+            if contents and summaries:
+                self._add_to_retriever(contents, summaries, content_type, filename)
                 
         # Mark as processed
         self.processed_files[filename] = file_mtime
         self._save_processed_files()
+        os.remove(self.journal_path)
+
+        for img in images:
+            processed_images[img]["indexed"] = True
+        self._write_json(processed_images_path, processed_images)
         
         # Persist the vectorstore
         self.vectorstore.persist()
         self._persist_docstore()
 
-        print(f"Finished processing {filename}. Added {len(texts)} text chunks, {len(tables)} tables, and {len(new_images)} new images to knowledge base.")
-        
-        # Clean up interim files
-        if os.path.exists(interim_results_dir):
-            try:
-                import shutil
-                shutil.rmtree(interim_results_dir)
-            except PermissionError:
-                print(f"Warning: Could not remove interim directory {interim_results_dir}. This won't affect functionality.")
+        print(f"Finished processing {filename}. Added {len(texts)} text chunks, {len(tables)} tables, and {len(images)} new images to knowledge base.")
+
+    # Roll back the documents of a file whose ingest was killed before it was marked as processed.
+    # The file is then processed again, its finished summaries and image descriptions are reused.
+    def _recover_ingest(self):
+        if not os.path.exists(self.journal_path):
+            return
+
+        with open(self.journal_path, 'r') as f:
+            journal = json.load(f)
+
+        if self.processed_files.get(journal["file"]) != journal["mtime"] and journal["added"]:
+            print(f"Rolling back {len(journal['added'])} documents of interrupted ingest of {journal['file']}")
+            self.vectorstore.delete(ids=journal["added"])
+            self.store.mdelete(journal["added"])
+        os.remove(self.journal_path)
+
+    # Ids are derived from the source file and content, so resuming a file writes the same documents again
+    def _doc_ids(self, contents: List[str], content_type: str, source_file: str) -> List[str]:
+        return [
+            hashlib.sha256(f"{source_file}\0{content_type}\0{content}".encode('utf-8')).hexdigest()
+            for content in contents
+        ]
+
+    # The ids of the documents that are not in the docstore yet
+    def _new_doc_ids(self, contents: List[str], content_type: str, source_file: str) -> List[str]:
+        doc_ids = self._doc_ids(contents, content_type, source_file)
+        return [doc_id for doc_id, stored in zip(doc_ids, self.store.mget(doc_ids)) if stored is None]
+
+    # Summarize chunks, the ones summarized before by the same model and prompt come from the summary cache.
+    # Every batch is stored as soon as it is done, so a restart resumes from the last finished batch.
+    def _summarize(self, chunks: List[str], max_concurrency: int, batch_size: int = 16) -> List[str]:
+        chunk_hashes = [hashlib.sha256(chunk.encode('utf-8')).hexdigest() for chunk in chunks]
+        summaries = []
+        for i in range(0, len(chunks), batch_size):
+            summaries.extend(self.summary_cache.summarize(
+                chunk_hashes[i:i + batch_size], chunks[i:i + batch_size],
+                lambda missing: self.summary_chain.batch(missing, {"max_concurrency": max_concurrency})
+            ))
+            print(f"Summarized {len(summaries)}/{len(chunks)} chunks")
+        print(f"Summary cache: {self.summary_cache.stats()}")
+        return summaries
 
     # Add contents and their summaries to the retriever
     def _add_to_retriever(self, contents, summaries, content_type, source_file):
@@ -287,7 +334,7 @@ class DiabetesKnowledgeBase:
             print(f"No {content_type} content to add for {source_file} - skipping")
             return
         
-        doc_ids = [str(uuid.uuid4()) for _ in contents]
+        doc_ids = self._doc_ids(contents, content_type, source_file)
         summary_docs = [
             Document(
                 page_content=s, 
@@ -300,12 +347,14 @@ class DiabetesKnowledgeBase:
             )
             for i, s in enumerate(summaries)
         ]
-        self.vectorstore.add_documents(summary_docs)
+        self.vectorstore.add_documents(summary_docs, ids=doc_ids)
         self.store.mset(list(zip(doc_ids, contents)))
         print(f"Added {len(summary_docs)} {content_type} documents from {source_file}")
         
         
-    # Process all PDFs in the data directory
+    # Process all PDFs in the data directory, one after the other. Unlike ai_server's staged ingest this does
+    # not partition several PDFs at once: process_pdf tells the images of a PDF apart by their modification
+    # time in the shared figures directory, so the images of PDFs partitioned together would get mixed up.
     def process_all_pdfs(self):
         pdf_files = [f for f in os.listdir(self.data_dir) if f.lower().endswith('.pdf')]
         for pdf_file in pdf_files:
@@ -316,6 +365,12 @@ class DiabetesKnowledgeBase:
     # Answer a  question using the RAG pipeline
     def answer_question(self, question: str) -> str:
         return self.chain.invoke(question)
+
+    # Stop the sub-query search threads and close the docstore
+    def close(self):
+        if self.search_pool is not None:
+            self.search_pool.shutdown(wait=True)
+        self.store.close()
         
     # Get a report of processed files
     def get_processed_files_status(self) -> str:
@@ -332,111 +387,105 @@ class DiabetesKnowledgeBase:
     # Retrieve the most relevant contexts for a given question with improved filtering and processing
     def get_contexts_for_question(self, question: str, k=10, similarity_threshold=0.5):
         
-        # Use the retriever to get relevant documents
-        docs = self.retriever.invoke(question, k=k*2)
+        # Create embedding for the question, it is used for the search and the similarity filter.
+        # With multi-query the sub-queries are embedded in the same call and each scores the candidates.
+        queries = self._queries_for(question) if self.multi_query else [question]
+        try:
+            if len(queries) > 1:
+                question_embedding = self.embeddings.embed_documents(queries)
+            else:
+                question_embedding = self.embeddings.embed_query(question)
+        except:
+            # If embedding fails, proceed without filtering by similarity
+            print("Warning: Could not create embedding for question.")
+            docs = self.retriever.invoke(question)
+            contents = [content for content in map(self._doc_content, docs) if content and content.strip()]
+            return contents[:k]
+        
+        # as many candidates as the retriever searches: this used to call retriever.invoke(question, k=k*2),
+        # which ignores k, so the contexts were always picked among the retriever's own k summaries
+        candidates = self.retriever.search_kwargs.get("k", 4)
+        if len(queries) > 1:
+            doc_ids = fan_out(lambda vector: self._search_doc_ids(vector, candidates), question_embedding, self.search_pool)
+        else:
+            doc_ids = self._search_doc_ids(question_embedding, candidates)
+        contents, stored = self._load_candidates(doc_ids)
         
         # Handle empty results
-        if not docs:
+        if not contents:
             print("No relevant documents found for the question.")
             return []
         
-        contexts = []
-        
-        # Extract embedding model from retriever if available
-        embedding_model = self.embeddings
-        
-        # Create embedding for the question
+        # Score every candidate at once, only contents without a stored vector are embedded, in one batch
         try:
-            question_embedding = embedding_model.embed_query(question)
-        except:
-            # If embedding fails, proceed without filtering by similarity
-            question_embedding = None
-            print("Warning: Could not create embedding for question.")
+            content_embeddings = embed_contents(self.embeddings, contents, stored)
+        except Exception as e:
+            print(f"Error calculating similarity: {str(e)}")
+            # Fall back to the contents without similarity filtering
+            return contents[:k]
         
-        # Process each document
-        for doc in docs:
-            # Extract the content based on document type
-            if hasattr(doc, 'page_content'):
-                content = doc.page_content
-            elif isinstance(doc, str):
-                content = doc
-            elif hasattr(doc, 'text'):
-                content = doc.text
-            elif hasattr(doc, 'content'):
-                content = doc.content
-            else:
-                try:
-                    content = str(doc)
-                except:
-                    print(f"Could not convert document to string: {type(doc)}")
-                    continue
+        return rerank(question_embedding, contents, content_embeddings, k, similarity_threshold)
+
+    # The question split into sub-queries, plus paraphrases from the LLM when they are turned on
+    # The question itself always comes first, decompose drops queries as short as "Define HbA1c".
+    def _queries_for(self, question: str) -> List[str]:
+        queries = [question] + decompose(question)
+        if self.paraphrase_chain is not None:
+            try:
+                queries += parse_paraphrases(self.paraphrase_chain.invoke(question))
+            except Exception as e:
+                print(f"Warning: Could not paraphrase question: {str(e)}")
+
+        # decompose repeats the question without its punctuation, that is the same query
+        unique = {}
+        for query in queries:
+            unique.setdefault(" ".join(query.split()).strip(" ?.,;").lower(), query)
+        return list(unique.values())[:multi_query_max]
+
+    # The parent ids of the summaries closest to the question embedding, in order of relevance
+    def _search_doc_ids(self, question_embedding, n: int) -> List[str]:
+        hits = self.vectorstore.similarity_search_by_vector(question_embedding, k=n)
+        return list(dict.fromkeys(hit.metadata[self.id_key] for hit in hits if self.id_key in hit.metadata))
+
+    # The contents of the parent documents and, where a summary is the content itself (images), the stored summary vector
+    def _load_candidates(self, doc_ids: List[str]):
+        if not doc_ids:
+            return [], []
+        
+        summaries = {}
+        stored = self.vectorstore.get(where={self.id_key: {"$in": doc_ids}}, include=["embeddings", "documents", "metadatas"])
+        for summary, vector, metadata in zip(stored["documents"], stored["embeddings"], stored["metadatas"]):
+            summaries[metadata[self.id_key]] = (summary, vector)
+        
+        contents = []
+        vectors = []
+        for doc_id, doc in zip(doc_ids, self.store.mget(doc_ids)):
+            content = self._doc_content(doc)
             
             # Skip empty content
             if not content or not content.strip():
                 continue
             
-            # Apply similarity filtering if embedding is available
-            if question_embedding is not None:
-                try:
-                    # Get embedding for the content
-                    content_embedding = embedding_model.embed_documents([content])[0]
-                    
-                    # Calculate similarity 
-                    similarity = self._cosine_similarity(question_embedding, content_embedding)
-                    
-                    # Only keep contexts with similarity above threshold
-                    if similarity < similarity_threshold:
-                        continue
-                    
-                    # Add a score to the context for potential ranking
-                    doc_metadata = getattr(doc, 'metadata', {}) if hasattr(doc, 'metadata') else {}
-                    doc_metadata['similarity_score'] = float(similarity)
-                    
-                    # Create a formatted context with metadata
-                    context_with_metadata = {
-                        'content': content,
-                        'metadata': doc_metadata,
-                        'similarity': float(similarity)
-                    }
-                    contexts.append(context_with_metadata)
-                    
-                except Exception as e:
-                    print(f"Error calculating similarity: {str(e)}")
-                    # Fall back to adding content without similarity filtering
-                    contexts.append({'content': content, 'metadata': getattr(doc, 'metadata', {})})
-            else:
-                # Without embedding, just add the content
-                contexts.append({'content': content, 'metadata': getattr(doc, 'metadata', {})})
-        
-        # Sort contexts by similarity score if available
-        if contexts and all('similarity' in ctx for ctx in contexts):
-            contexts.sort(key=lambda x: x['similarity'], reverse=True)
+            summary, vector = summaries.get(doc_id, (None, None))
+            contents.append(content)
+            vectors.append(vector if summary == content else None)
         
-        # Limit to top k results
-        contexts = contexts[:k]
-        
-        # Extract just the content for compatibility with existing code
-        return [ctx['content'] for ctx in contexts]
+        return contents, vectors
 
-    # Calculate cosine similarity between two vectors
-    def _cosine_similarity(self, vector_a, vector_b):
-    
-        import numpy as np
-        
-        # Ensure vectors are numpy arrays
-        if not isinstance(vector_a, np.ndarray):
-            vector_a = np.array(vector_a)
-        if not isinstance(vector_b, np.ndarray):
-            vector_b = np.array(vector_b)
-        
-        # Calculate cosine similarity
-        dot_product = np.dot(vector_a, vector_b)
-        norm_a = np.linalg.norm(vector_a)
-        norm_b = np.linalg.norm(vector_b)
-        
-        # Handle zero division
-        if norm_a == 0 or norm_b == 0:
-            return 0
-            
-        return dot_product / (norm_a * norm_b)
-        
+    # Extract the content based on document type
+    def _doc_content(self, doc):
+        if doc is None:
+            return None
+        if hasattr(doc, 'page_content'):
+            return doc.page_content
+        if isinstance(doc, str):
+            return doc
+        if hasattr(doc, 'text'):
+            return doc.text
+        if hasattr(doc, 'content'):
+            return doc.content
+        try:
+            return str(doc)
+        except:
+            print(f"Could not convert document to string: {type(doc)}")
+            return None
@@ -0,0 +1,32 @@
+import numpy as np
+from typing import List, Optional, Sequence
+
+# Cosine similarity of one query vector against every row of a matrix, rows with a zero norm score 0
+def cosine_similarities(query: np.ndarray, matrix: np.ndarray) -> np.ndarray:
+    query = np.asarray(query, dtype=np.float32)
+    matrix = np.asarray(matrix, dtype=np.float32)
+
+    norms = np.linalg.norm(matrix, axis=1) * np.linalg.norm(query)
+    dots = matrix @ query
+    return np.divide(dots, norms, out=np.zeros_like(dots), where=norms != 0)
+
+# Embed every content without a stored vector in one call and stack them with the stored ones
+def embed_contents(embeddings, contents: List[str], stored: Sequence[Optional[Sequence[float]]]) -> np.ndarray:
+    missing = [i for i, vector in enumerate(stored) if vector is None]
+    vectors = list(stored)
+
+    if missing:
+        for i, vector in zip(missing, embeddings.embed_documents([contents[i] for i in missing])):
+            vectors[i] = vector
+
+    return np.asarray(vectors, dtype=np.float32)
+
+# Keep the contents at or above the similarity threshold and return the k most similar,
+# contents that score the same keep their retrieval order. With several query embeddings,
+# one per sub-query, a content scores its best similarity to any of them.
+def rerank(question_embedding, contents: List[str], content_embeddings: np.ndarray, k: int, similarity_threshold: float) -> List[str]:
+    queries = np.atleast_2d(np.asarray(question_embedding, dtype=np.float32))
+    similarities = np.max([cosine_similarities(query, content_embeddings) for query in queries], axis=0)
+    keep = np.flatnonzero(similarities >= similarity_threshold)
+    order = keep[np.argsort(-similarities[keep], kind="stable")][:k]
+    return [contents[i] for i in order]
@@ -0,0 +1,125 @@
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+from typing import Callable
+
+summary_cache_max_mb = float(os.getenv("SUMMARY_CACHE_MAX_MB", "512"))
+
+# Number of keys looked up per "in (...)" query, sqlite limits the amount of bound parameters
+_BATCH = 500
+
+# Durable cache of chunk summaries keyed by (chunk hash, model id, prompt hash).
+# Summaries survive re-indexing and crashes, and switching model or prompt never returns stale ones.
+# Once the cache grows past max_bytes the least recently used summaries are dropped.
+class SummaryCache:
+    def __init__(self, path: str, model_id: str, prompt: str, max_bytes: int = int(summary_cache_max_mb * 1024 * 1024)):
+        self.path = path
+        self.model_id = model_id
+        self.prompt_hash = hashlib.sha256(prompt.encode('utf-8')).hexdigest()[:16]
+        self.max_bytes = max_bytes
+
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL;")
+        self._connection.execute("PRAGMA synchronous=NORMAL;")
+        self._connection.execute('''
+            CREATE TABLE IF NOT EXISTS summaries (
+                key TEXT PRIMARY KEY,
+                summary TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                last_used REAL NOT NULL
+            )''')
+        self._connection.execute("CREATE INDEX IF NOT EXISTS idx_last_used ON summaries (last_used)")
+        self._connection.commit()
+
+    def _key(self, chunk_hash: str) -> str:
+        return f"{chunk_hash}:{self.model_id}:{self.prompt_hash}"
+
+    # Look up the cached summaries of some chunks, returns {chunk hash: summary} for the ones found
+    def get_many(self, chunk_hashes: list[str]) -> dict[str, str]:
+        keys = {self._key(chunk_hash): chunk_hash for chunk_hash in chunk_hashes}
+        found = {}
+
+        with self._lock:
+            key_list = list(keys)
+            for i in range(0, len(key_list), _BATCH):
+                batch = key_list[i:i + _BATCH]
+                placeholders = ",".join("?" * len(batch))
+                rows = self._connection.execute(
+                    f"SELECT key, summary FROM summaries WHERE key IN ({placeholders})", batch)
+                for key, summary in rows:
+                    found[keys[key]] = summary
+
+            if found:
+                now = time.time()
+                with self._connection:
+                    self._connection.executemany(
+                        "UPDATE summaries SET last_used = ? WHERE key = ?",
+                        [(now, self._key(chunk_hash)) for chunk_hash in found])
+
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+        return found
+
+    def put_many(self, summaries: dict[str, str]) -> None:
+        now = time.time()
+        rows = [
+            (self._key(chunk_hash), summary, len(summary.encode('utf-8')), now)
+            for chunk_hash, summary in summaries.items()
+        ]
+        with self._lock:
+            with self._connection:
+                self._connection.executemany(
+                    "INSERT OR REPLACE INTO summaries (key, summary, size, last_used) VALUES (?, ?, ?, ?)", rows)
+            self._evict()
+
+    # Summarize chunks, only the ones missing from the cache go through summarize_fn.
+    # Every finished batch is stored right away, so a crash loses at most the batch in flight.
+    def summarize(self, chunk_hashes: list[str], chunks: list[str], summarize_fn: Callable[[list[str]], list[str]]) -> list[str]:
+        found = self.get_many(chunk_hashes)
+        missing = [(chunk_hash, chunk) for chunk_hash, chunk in zip(chunk_hashes, chunks) if chunk_hash not in found]
+
+        if missing:
+            new_summaries = summarize_fn([chunk for _, chunk in missing])
+            computed = {chunk_hash: summary for (chunk_hash, _), summary in zip(missing, new_summaries)}
+            self.put_many(computed)
+            found.update(computed)
+
+        return [found[chunk_hash] for chunk_hash in chunk_hashes]
+
+    # Drop the least recently used summaries until the cache is back under 90% of its size limit
+    def _evict(self):
+        total = self._connection.execute("SELECT COALESCE(SUM(size), 0) FROM summaries").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+
+        target = total - int(self.max_bytes * 0.9)
+        freed = 0
+        evicted = []
+        for key, size in self._connection.execute("SELECT key, size FROM summaries ORDER BY last_used"):
+            evicted.append((key,))
+            freed += size
+            if freed >= target:
+                break
+
+        with self._connection:
+            self._connection.executemany("DELETE FROM summaries WHERE key = ?", evicted)
+
+    def stats(self) -> dict:
+        with self._lock:
+            entries, size = self._connection.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM summaries").fetchone()
+            lookups = self.hits + self.misses
+            return {
+                "model_id": self.model_id,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "entries": entries,
+                "bytes": size,
+            }
@@ -0,0 +1,433 @@
+import os
+import re
+import math
+import sqlite3
+import threading
+import numpy as np
+
+# Settings of the local approximate nearest neighbour index
+ann_nlist = int(os.getenv("ANN_NLIST", "0"))  # 0 picks sqrt(n) lists whenever the index is trained
+ann_nprobe = int(os.getenv("ANN_NPROBE", "16"))
+ann_dtype = os.getenv("ANN_DTYPE", "float32")  # float16 halves the size, scoring it is slower
+ann_train_size = int(os.getenv("ANN_TRAIN_SIZE", "20000"))
+# First pass over compact codes: "none", "int8" (4x smaller than float32) or "binary" (32x smaller)
+ann_quantization = os.getenv("ANN_QUANTIZATION", "none")
+# With codes the best k * ann_rescore candidates are rescored with their float vectors
+ann_rescore = int(os.getenv("ANN_RESCORE", "4"))
+
+_KMEANS_ITERATIONS = 10
+_KMEANS_SAMPLE_PER_LIST = 64
+# Rows scored per matrix product when going over the whole index
+_CHUNK = 65536
+# Deleted rows are reclaimed once there are at least this many and they outnumber the live ones
+_COMPACT_MIN_ROWS = 1024
+_DATA_FILE = re.compile(r"(vectors|codes)(\.\d+)?\.bin")
+# Number of set bits of every byte, to count the differing bits of binary codes
+_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint16)
+
+def normalize(vectors) -> np.ndarray:
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+# Indices of the k highest scores, highest first
+def top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    if k >= len(scores):
+        return np.argsort(-scores, kind="stable")
+    best = np.argpartition(-scores, k)[:k]
+    return best[np.argsort(-scores[best], kind="stable")]
+
+# Index of the nearest centroid of every vector, computed in chunks to bound memory
+def nearest_centroids(vectors, centroids: np.ndarray) -> np.ndarray:
+    assignments = np.empty(len(vectors), dtype=np.int64)
+    for i in range(0, len(vectors), _CHUNK):
+        chunk = np.asarray(vectors[i:i + _CHUNK], dtype=np.float32)
+        assignments[i:i + _CHUNK] = np.argmax(chunk @ centroids.T, axis=1)
+    return assignments
+
+# Memory-map a file of rows x width values, growing it to that size first
+def _map_file(path: str, dtype: np.dtype, rows: int, width: int) -> np.memmap:
+    with open(path, 'a+b') as f:
+        if os.path.getsize(path) < rows * width * dtype.itemsize:
+            f.truncate(rows * width * dtype.itemsize)
+    return np.memmap(path, dtype=dtype, mode='r+', shape=(rows, width))
+
+# Inverted file (IVF) index over a memory-mapped matrix of unit vectors, scored by inner product, i.e. cosine.
+# Every vector belongs to the list of its nearest k-means centroid and a query only scans the nprobe lists
+# nearest to it: more probes means higher recall and higher latency. Until it holds train_size vectors the
+# index is untrained and every query scans all vectors, which is exact.
+# The matrix lives in vectors.bin and doubles when full, ids, lists and centroids live in index.sqlite.
+# Vectors are flushed before the rows pointing at them are committed, so a crash never leaves an id
+# pointing at a vector that was not written.
+# Deleted and replaced vectors leave dead rows behind. Once they outnumber the live ones the live rows
+# are copied into files of the next generation, which the same commit that renumbers the rows switches to,
+# so the files on disk stay within about twice the live vectors however often files are re-ingested.
+# With quantization every vector also has a code in codes.bin: int8 with a scale per dimension, or one
+# sign bit per dimension. Queries scan only the codes and rescore a short list with the float vectors,
+# so the memory a query goes over shrinks 4 or 32 times while the float vectors mostly stay on disk.
+class IVFIndex:
+    def __init__(self, path: str, dtype: str = ann_dtype, nlist: int = ann_nlist, nprobe: int = ann_nprobe,
+                 train_size: int = ann_train_size, quantization: str = ann_quantization, rescore: int = ann_rescore):
+        if quantization not in ("none", "int8", "binary"):
+            raise ValueError(f"Unknown quantization: {quantization}")
+
+        self.path = path
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.train_size = train_size
+        self.quantization = quantization
+        self.rescore = rescore
+        os.makedirs(path, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(os.path.join(path, "index.sqlite"), check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL;")
+        self._connection.execute("PRAGMA synchronous=NORMAL;")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value BLOB)")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS rows (row INTEGER PRIMARY KEY, id TEXT UNIQUE NOT NULL, list INTEGER NOT NULL)")
+        self._connection.commit()
+
+        meta = dict(self._connection.execute("SELECT key, value FROM meta"))
+        self.dtype = np.dtype(meta.get("dtype", dtype))
+        self.dim: int | None = int(meta["dim"]) if "dim" in meta else None
+        self.trained_size = int(meta.get("trained_size", 0))
+        self.generation = int(meta.get("generation", 0))
+        self.vectors_path, self.codes_path = self._data_paths(self.generation)
+        self._remove_stale_files()
+        self.centroids: np.ndarray | None = None
+        if "centroids" in meta:
+            self.centroids = np.frombuffer(meta["centroids"], dtype=np.float32).reshape(-1, self.dim)
+        # the codes of an index follow the setting, they are rebuilt from the float vectors when it changes
+        self.code_scale: np.ndarray | None = None
+        if "code_scale" in meta:
+            self.code_scale = np.frombuffer(meta["code_scale"], dtype=np.float32)
+        # number of vectors the scale was fitted on
+        self.scale_size = int(meta.get("code_scale_size", 0))
+        encoded_as = meta.get("quantization", "none")
+
+        # row -> id, id -> row and the rows of every list, rebuilt from the rows table
+        self.ids: list[str | None] = []
+        self.row_of: dict[str, int] = {}
+        self.lists: list[list[int]] = [[] for _ in range(self._list_count())]
+        self._arrays: dict[int, np.ndarray] = {}
+        for row, doc_id, list_id in self._connection.execute("SELECT row, id, list FROM rows ORDER BY row"):
+            self.ids.extend([None] * (row + 1 - len(self.ids)))
+            self.ids[row] = doc_id
+            self.row_of[doc_id] = row
+            self.lists[list_id].append(row)
+
+        self.vectors: np.memmap | None = None
+        self.codes: np.memmap | None = None
+        if self.dim is not None:
+            self._map_vectors(max(len(self.ids), 1))
+            if self.quantization != encoded_as:
+                self._encode_all(self._active_rows())
+
+    # Files of a generation, generation 0 keeps the names of indexes that were never compacted
+    def _data_paths(self, generation: int) -> tuple[str, str]:
+        suffix = f".{generation}" if generation else ""
+        return os.path.join(self.path, f"vectors{suffix}.bin"), os.path.join(self.path, f"codes{suffix}.bin")
+
+    # Files of earlier generations, or of a compaction that was interrupted before its commit
+    def _remove_stale_files(self):
+        current = {os.path.basename(self.vectors_path), os.path.basename(self.codes_path)}
+        for name in os.listdir(self.path):
+            if _DATA_FILE.fullmatch(name) and name not in current:
+                os.remove(os.path.join(self.path, name))
+
+    def _list_count(self) -> int:
+        return len(self.centroids) if self.centroids is not None else 1
+
+    def __len__(self) -> int:
+        return len(self.row_of)
+
+    # Grow vectors.bin to hold at least rows vectors, doubling so appends stay cheap
+    def _map_vectors(self, rows: int):
+        capacity = self.vectors.shape[0] if self.vectors is not None else 0
+        if rows <= capacity:
+            return
+
+        capacity = max(1024, capacity)
+        while capacity < rows:
+            capacity *= 2
+        if self.vectors is not None:
+            self.vectors.flush()
+        self.vectors = _map_file(self.vectors_path, self.dtype, capacity, self.dim)
+
+        if self.quantization != "none":
+            if self.codes is not None:
+                self.codes.flush()
+            dtype, width = self._code_layout()
+            self.codes = _map_file(self.codes_path, dtype, capacity, width)
+
+    # dtype and width of one code, the width for binary is dim bits rounded up to bytes
+    def _code_layout(self) -> tuple[np.dtype, int]:
+        if self.quantization == "int8":
+            return np.dtype(np.int8), self.dim
+        return np.dtype(np.uint8), (self.dim + 7) // 8
+
+    def _encode(self, vectors: np.ndarray) -> np.ndarray:
+        if self.quantization == "binary":
+            return np.packbits(vectors > 0, axis=1)
+        return np.clip(np.rint(vectors / self.code_scale), -127, 127).astype(np.int8)
+
+    # int8 codes map the largest value of every dimension in the sample to 127
+    def _fit_scale(self, sample: np.ndarray):
+        scale = np.abs(sample).max(axis=0) / 127
+        self.code_scale = np.where(scale == 0, 1, scale).astype(np.float32)
+        self.scale_size = len(sample)
+        with self._connection:
+            self._connection.executemany("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                                         [("code_scale", self.code_scale.tobytes()),
+                                          ("code_scale_size", str(self.scale_size))])
+
+    # Encode the given rows again from their float vectors, after the scale changed or quantization was turned on
+    def _encode_all(self, rows: np.ndarray):
+        if self.quantization == "int8" and len(rows):
+            self._fit_scale(np.asarray(self.vectors[rows[:self.train_size]], dtype=np.float32))
+        if self.codes is not None:
+            for i in range(0, len(rows), _CHUNK):
+                chunk_rows = rows[i:i + _CHUNK]
+                self.codes[chunk_rows] = self._encode(np.asarray(self.vectors[chunk_rows], dtype=np.float32))
+            self.codes.flush()
+        # "none" is recorded too, so codes gone stale while quantization was off are rebuilt when it is back on
+        with self._connection:
+            self._connection.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                                     ("quantization", self.quantization))
+
+    # Scores of the first pass, higher is nearer: the dot product with the int8 codes, or minus the number of differing bits
+    def _code_scores(self, rows: np.ndarray, query: np.ndarray) -> np.ndarray:
+        codes = self.codes[rows]
+        if self.quantization == "binary":
+            return -_POPCOUNT[np.bitwise_xor(codes, np.packbits(query > 0))].sum(axis=1, dtype=np.int32)
+        return codes.astype(np.float32) @ (query * self.code_scale)
+
+    def _list_array(self, list_id: int) -> np.ndarray:
+        array = self._arrays.get(list_id)
+        if array is None:
+            array = np.array(sorted(self.lists[list_id]), dtype=np.int64)
+            self._arrays[list_id] = array
+        return array
+
+    # Add or replace vectors, replaced ids get a new row
+    def add(self, ids: list[str], vectors) -> None:
+        vectors = normalize(vectors)
+        latest = {doc_id: i for i, doc_id in enumerate(ids)}
+        ids = list(latest)
+        vectors = vectors[list(latest.values())]
+
+        with self._lock:
+            self._delete(id_ for id_ in ids if id_ in self.row_of)
+            if self.dim is None:
+                self.dim = vectors.shape[1]
+                with self._connection:
+                    self._connection.executemany("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                                                 [("dim", str(self.dim)), ("dtype", self.dtype.name),
+                                                  ("quantization", self.quantization)])
+            if self.quantization == "int8" and self.code_scale is None:
+                self._fit_scale(vectors)
+
+            start = len(self.ids)
+            self._map_vectors(start + len(ids))
+            self.vectors[start:start + len(ids)] = vectors.astype(self.dtype)
+            self.vectors.flush()
+            if self.codes is not None:
+                self.codes[start:start + len(ids)] = self._encode(vectors)
+                self.codes.flush()
+
+            list_ids = nearest_centroids(vectors, self.centroids) if self.centroids is not None else np.zeros(len(ids), dtype=np.int64)
+            rows = [(start + i, doc_id, int(list_id)) for i, (doc_id, list_id) in enumerate(zip(ids, list_ids))]
+            with self._connection:
+                self._connection.executemany("INSERT INTO rows (row, id, list) VALUES (?, ?, ?)", rows)
+
+            for row, doc_id, list_id in rows:
+                self.ids.append(doc_id)
+                self.row_of[doc_id] = row
+                self.lists[list_id].append(row)
+                self._arrays.pop(list_id, None)
+
+            # train once there is enough data, then again whenever the index grew 4 times so lists stay short
+            if len(self) >= self.train_size and len(self) >= 4 * self.trained_size:
+                self._train()
+            # until then the scale of the first batch would clip every later vector larger than it,
+            # so it is fitted again on all vectors whenever the index doubled, up to a sample of train_size
+            elif (self.quantization == "int8" and self.scale_size < self.train_size
+                  and len(self) >= 2 * self.scale_size):
+                self._encode_all(self._active_rows())
+
+    def delete(self, ids: list[str]) -> None:
+        with self._lock:
+            self._delete(ids)
+
+    def _delete(self, ids):
+        rows = [self.row_of.pop(doc_id) for doc_id in ids if doc_id in self.row_of]
+        if not rows:
+            return
+
+        with self._connection:
+            self._connection.executemany("DELETE FROM rows WHERE row = ?", [(row,) for row in rows])
+        removed = set(rows)
+        for list_id, members in enumerate(self.lists):
+            if removed.intersection(members):
+                self.lists[list_id] = [row for row in members if row not in removed]
+                self._arrays.pop(list_id, None)
+        for row in rows:
+            self.ids[row] = None
+
+        dead = len(self.ids) - len(self.row_of)
+        if dead >= _COMPACT_MIN_ROWS and dead > len(self.row_of):
+            self._compact()
+
+    # Copy the live rows to the front of new files and renumber them, the old files go once the rows point at the new ones
+    def _compact(self):
+        rows = self._active_rows()
+        vectors_path, codes_path = self._data_paths(self.generation + 1)
+        capacity = 1024
+        while capacity < len(rows):
+            capacity *= 2
+
+        vectors = _map_file(vectors_path, self.dtype, capacity, self.dim)
+        codes = None
+        if self.codes is not None:
+            dtype, width = self._code_layout()
+            codes = _map_file(codes_path, dtype, capacity, width)
+        for i in range(0, len(rows), _CHUNK):
+            chunk_rows = rows[i:i + _CHUNK]
+            vectors[i:i + len(chunk_rows)] = self.vectors[chunk_rows]
+            if codes is not None:
+                codes[i:i + len(chunk_rows)] = self.codes[chunk_rows]
+        vectors.flush()
+        if codes is not None:
+            codes.flush()
+
+        list_of = {row: list_id for list_id, members in enumerate(self.lists) for row in members}
+        renumbered = [(new_row, self.ids[row], list_of[row]) for new_row, row in enumerate(rows.tolist())]
+        with self._connection:
+            self._connection.execute("DELETE FROM rows")
+            self._connection.executemany("INSERT INTO rows (row, id, list) VALUES (?, ?, ?)", renumbered)
+            self._connection.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                                     ("generation", str(self.generation + 1)))
+
+        self.generation += 1
+        self.vectors_path, self.codes_path = vectors_path, codes_path
+        self.vectors, self.codes = vectors, codes
+        self.ids = [doc_id for _, doc_id, _ in renumbered]
+        self.row_of = {doc_id: row for row, doc_id, _ in renumbered}
+        self.lists = [[] for _ in range(self._list_count())]
+        for row, _, list_id in renumbered:
+            self.lists[list_id].append(row)
+        self._arrays = {}
+        self._remove_stale_files()
+
+    def _active_rows(self) -> np.ndarray:
+        return np.array(sorted(self.row_of.values()), dtype=np.int64)
+
+    # Spherical k-means on a sample of the vectors, then every vector is moved to the list of its nearest centroid
+    def _train(self):
+        rows = self._active_rows()
+        nlist = min(self.nlist or max(1, int(math.sqrt(len(rows)))), len(rows))
+        rng = np.random.default_rng(len(rows))
+
+        sample = np.sort(rng.choice(rows, min(len(rows), nlist * _KMEANS_SAMPLE_PER_LIST), replace=False))
+        data = np.asarray(self.vectors[sample], dtype=np.float32)
+        centroids = data[rng.choice(len(data), nlist, replace=False)]
+        for _ in range(_KMEANS_ITERATIONS):
+            assignments = nearest_centroids(data, centroids)
+            order = np.argsort(assignments, kind="stable")
+            counts = np.bincount(assignments, minlength=nlist)
+            starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+            filled = counts > 0
+            sums = np.add.reduceat(data[order], starts[filled], axis=0)
+            # empty lists keep their old centroid
+            centroids[filled] = normalize(sums)
+
+        assignments = np.empty(len(rows), dtype=np.int64)
+        for i in range(0, len(rows), _CHUNK):
+            chunk = self.vectors[rows[i:i + _CHUNK]]
+            assignments[i:i + _CHUNK] = nearest_centroids(chunk, centroids)
+
+        with self._connection:
+            self._connection.executemany("UPDATE rows SET list = ? WHERE row = ?",
+                                         zip(assignments.tolist(), rows.tolist()))
+            self._connection.executemany("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", [
+                ("centroids", centroids.astype(np.float32).tobytes()),
+                ("trained_size", str(len(rows))),
+            ])
+
+        self.centroids = centroids.astype(np.float32)
+        self.trained_size = len(rows)
+        self.lists = [[] for _ in range(nlist)]
+        for row, list_id in zip(rows.tolist(), assignments.tolist()):
+            self.lists[list_id].append(row)
+        self._arrays = {}
+        # the scale of the first batch is refitted on the larger sample
+        if self.quantization == "int8":
+            self._encode_all(rows)
+        print(f"Trained ANN index: {nlist} lists over {len(rows)} vectors")
+
+    # The k nearest ids of a query with their cosine similarity, best first
+    def search(self, query, k: int, nprobe: int | None = None) -> list[tuple[str, float]]:
+        query = normalize(query)
+        with self._lock:
+            if not self.row_of:
+                return []
+
+            if self.centroids is None:
+                candidates = self._list_array(0)
+            else:
+                probes = top_k(self.centroids @ query, nprobe or self.nprobe)
+                candidates = np.sort(np.concatenate([self._list_array(int(list_id)) for list_id in probes]))
+
+            if self.codes is not None:
+                candidates = np.sort(candidates[top_k(self._code_scores(candidates, query), k * self.rescore)])
+
+            scores = np.asarray(self.vectors[candidates], dtype=np.float32) @ query
+            return [(self.ids[candidates[i]], float(scores[i])) for i in top_k(scores, k)]
+
+    # Exact k nearest ids of many queries at once by scanning every vector, the ground truth for recall
+    def search_exact(self, queries, k: int) -> list[list[tuple[str, float]]]:
+        queries = normalize(queries)
+        with self._lock:
+            rows = self._active_rows()
+            best_scores = np.full((len(queries), 0), -np.inf, dtype=np.float32)
+            best_rows = np.zeros((len(queries), 0), dtype=np.int64)
+            for i in range(0, len(rows), _CHUNK):
+                chunk_rows = rows[i:i + _CHUNK]
+                scores = queries @ np.asarray(self.vectors[chunk_rows], dtype=np.float32).T
+                best_scores = np.concatenate([best_scores, scores], axis=1)
+                best_rows = np.concatenate([best_rows, np.broadcast_to(chunk_rows, scores.shape)], axis=1)
+                if best_scores.shape[1] > k:
+                    keep = np.argpartition(-best_scores, k - 1, axis=1)[:, :k]
+                    best_scores = np.take_along_axis(best_scores, keep, axis=1)
+                    best_rows = np.take_along_axis(best_rows, keep, axis=1)
+
+            order = np.argsort(-best_scores, axis=1, kind="stable")
+            best_scores = np.take_along_axis(best_scores, order, axis=1)
+            best_rows = np.take_along_axis(best_rows, order, axis=1)
+            return [
+                [(self.ids[row], float(score)) for row, score in zip(query_rows, query_scores)]
+                for query_rows, query_scores in zip(best_rows.tolist(), best_scores.tolist())
+            ]
+
+    # Ids and vectors of the given ids that are in the index
+    def get(self, ids: list[str]) -> tuple[list[str], np.ndarray]:
+        with self._lock:
+            found = [doc_id for doc_id in ids if doc_id in self.row_of]
+            rows = [self.row_of[doc_id] for doc_id in found]
+            vectors = np.asarray(self.vectors[rows], dtype=np.float32) if rows else np.zeros((0, self.dim or 0), dtype=np.float32)
+        return found, vectors
+
+    # Bytes the first pass of a query scans per vector
+    def scan_bytes_per_vector(self) -> int:
+        if self.codes is not None:
+            dtype, width = self._code_layout()
+            return width * dtype.itemsize
+        return (self.dim or 0) * self.dtype.itemsize
+
+    def close(self):
+        with self._lock:
+            if self.vectors is not None:
+                self.vectors.flush()
+            if self.codes is not None:
+                self.codes.flush()
+            self._connection.close()
@@ -0,0 +1,112 @@
+import os
+import time
+import threading
+from typing import Callable, Optional
+import numpy as np
+
+# Semantic answer cache, off unless ANSWER_CACHE=true
+answer_cache_enabled = os.getenv("ANSWER_CACHE", "false") == "true"
+answer_cache_size = int(os.getenv("ANSWER_CACHE_SIZE", "1024"))
+answer_cache_threshold = float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.95"))
+answer_cache_ttl_seconds = float(os.getenv("ANSWER_CACHE_TTL_SECONDS", "3600"))
+
+# Answers to earlier questions, found again by the cosine similarity of the question embeddings.
+# Every entry carries the knowledge base version it was generated against, once version_fn returns
+# another version the whole cache is dropped. When full the least recently used answer is replaced.
+class SemanticAnswerCache:
+    def __init__(self, embed_fn: Callable[[str], list[float]], version_fn: Callable[[], str],
+                 max_entries: int = answer_cache_size, threshold: float = answer_cache_threshold,
+                 ttl_seconds: float = answer_cache_ttl_seconds):
+        self.embed_fn = embed_fn
+        self.version_fn = version_fn
+        self.max_entries = max_entries
+        self.threshold = threshold
+        self.ttl_seconds = ttl_seconds
+
+        # one row per entry, allocated on the first put once the embedding size is known
+        self._vectors: np.ndarray | None = None
+        self._answers: list[str] = []
+        self._created = np.zeros(max_entries)
+        self._last_used = np.zeros(max_entries)
+        self._size = 0
+        self._version: str | None = None
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def embed(self, question: str) -> np.ndarray:
+        vector = np.asarray(self.embed_fn(question), dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    # Drop everything generated against an older version of the knowledge base, returns the current version
+    def _check_version(self) -> str:
+        kb_version = self.version_fn()
+        if kb_version != self._version:
+            if self._size:
+                self.invalidations += 1
+            self._size = 0
+            self._answers = []
+            self._version = kb_version
+        return kb_version
+
+    # Find the cached answer of the most similar earlier question, if it is similar enough
+    def lookup(self, question_vector: np.ndarray) -> Optional[str]:
+        now = time.time()
+        with self._lock:
+            self._check_version()
+            if self._size == 0:
+                self.misses += 1
+                return None
+
+            similarities = self._vectors[:self._size] @ question_vector
+            if self.ttl_seconds:
+                similarities[now - self._created[:self._size] > self.ttl_seconds] = -np.inf
+
+            best = int(np.argmax(similarities))
+            if similarities[best] < self.threshold:
+                self.misses += 1
+                return None
+
+            self._last_used[best] = now
+            self.hits += 1
+            return self._answers[best]
+
+    # Store an answer generated against kb_version, it is dropped if the knowledge base changed meanwhile
+    def put(self, question_vector: np.ndarray, answer: str, kb_version: str) -> None:
+        now = time.time()
+        with self._lock:
+            if self._check_version() != kb_version:
+                return
+            if self._vectors is None:
+                self._vectors = np.zeros((self.max_entries, question_vector.shape[0]), dtype=np.float32)
+
+            if self._size < self.max_entries:
+                row = self._size
+                self._size += 1
+                self._answers.append(answer)
+            else:
+                row = int(np.argmin(self._last_used[:self._size]))
+                self._answers[row] = answer
+                self.evictions += 1
+
+            self._vectors[row] = question_vector
+            self._created[row] = now
+            self._last_used[row] = now
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+                "entries": self._size,
+                "max_entries": self.max_entries,
+                "threshold": self.threshold,
+            }
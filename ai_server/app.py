@@ -1,10 +1,20 @@
 from multimodal_rag import DiabetesKnowledgeBase
+from batching import MicroBatcher
+from answer_cache import SemanticAnswerCache, answer_cache_enabled
+from metadata_filter import RetrievalFilter
+from vector_store import PartitionedVectorStore
+from contextlib import asynccontextmanager
 from dotenv import load_dotenv
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
+import numpy as np
 import uvicorn
+import asyncio
 import torch
+import json
+import os
 
 print("Torch version:", torch.__version__)
 print("Is ROCm available?:", torch.version.hip)
@@ -14,12 +24,36 @@ print("Torch device:", torch.device("cuda" if torch.cuda.is_available() else "mp
 
 class AnswerReq(BaseModel):
     message: str
+    filters: RetrievalFilter | None = None
 
 class AnswerRes(BaseModel):
     message: str
 
+class RetrieveRes(BaseModel):
+    chunks: list[str]
+
 load_dotenv("./.env")
-app = FastAPI()
+
+# Micro-batching of /answer calls, turned off with BATCHING=false to get the old one-at-a-time path
+batching_enabled = os.getenv("BATCHING", "true") == "true"
+batch_max_size = int(os.getenv("BATCH_MAX_SIZE", "8"))
+batch_max_wait_ms = float(os.getenv("BATCH_MAX_WAIT_MS", "20"))
+
+kb = DiabetesKnowledgeBase()
+batcher = MicroBatcher(kb.answer_questions, max_batch_size=batch_max_size, max_wait_ms=batch_max_wait_ms)
+answer_cache = SemanticAnswerCache(kb.embeddings.embed_query, lambda: kb.version) if answer_cache_enabled else None
+
+# Tells the client whether an answer came from the semantic answer cache: hit, miss or off
+ANSWER_CACHE_HEADER = "X-Answer-Cache"
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if batching_enabled:
+        await batcher.start()
+    yield
+    await batcher.stop()
+
+app = FastAPI(lifespan=lifespan)
 
 origins = [
         "*"
@@ -33,22 +67,111 @@ app.add_middleware(
         allow_headers=["*"],
         )
 
-kb = DiabetesKnowledgeBase()
-
 #kb.process_all_pdfs()
 #print(kb.get_processed_files_status())
 
+# Look a question up in the semantic answer cache, returns the cached answer if there is one
+# and the question embedding to store the new answer under otherwise
+async def lookup_answer(message: str, filters: RetrievalFilter | None = None) -> tuple[str | None, np.ndarray | None]:
+    # answers are cached by question only, a filtered answer is neither looked up nor stored
+    if answer_cache is None or filters is not None:
+        return None, None
+    question_vector = await asyncio.to_thread(answer_cache.embed, message)
+    return answer_cache.lookup(question_vector), question_vector
+
+def cache_status(cached: str | None) -> str:
+    if answer_cache is None:
+        return "off"
+    return "hit" if cached is not None else "miss"
+
 @app.post("/answer")
-async def answer(request: AnswerReq) -> AnswerRes:
+async def answer(request: AnswerReq, http_response: Response) -> AnswerRes:
     message: str = request.message
     response: AnswerRes = AnswerRes(message="")
+
+    # the version is read before generating, so an ingest meanwhile never gets an old answer cached under it
+    kb_version = kb.version
+    cached, question_vector = await lookup_answer(message, request.filters)
+    http_response.headers[ANSWER_CACHE_HEADER] = cache_status(cached)
+    if cached is not None:
+        return AnswerRes(message=cached)
+
     try: 
-        response = AnswerRes(message=kb.answer_question(message))
+        if request.filters is not None:
+            # a batch shares one retriever, so filtered questions go on their own
+            response = AnswerRes(message=await asyncio.to_thread(kb.answer_question, message, request.filters))
+        elif batching_enabled:
+            response = AnswerRes(message=await batcher.submit(message))
+        else:
+            response = AnswerRes(message=kb.answer_question(message))
     except Exception as e:
         raise e
         raise HTTPException(status_code=500, detail=f"sumthin aint right {str(e)}")
+
+    if question_vector is not None:
+        answer_cache.put(question_vector, response.message, kb_version)
     return response
 
+# Format a payload as a single server-sent event
+def sse_event(payload: dict) -> str:
+    return f"data: {json.dumps(payload)}\n\n"
+
+def stream_tokens(message: str, filters: RetrievalFilter | None, question_vector: np.ndarray | None, kb_version: str):
+    tokens = []
+    try:
+        for token in kb.stream_answer(message, filters):
+            tokens.append(token)
+            yield sse_event({"token": token})
+    except Exception as e:
+        yield sse_event({"error": f"sumthin aint right {str(e)}"})
+        return
+
+    if question_vector is not None:
+        answer_cache.put(question_vector, "".join(tokens).strip(), kb_version)
+    yield sse_event({"done": True})
+
+# A cached answer is sent as a single token
+def cached_tokens(cached: str):
+    yield sse_event({"token": cached})
+    yield sse_event({"done": True})
+
+# StreamingResponse runs the sync generator in a worker thread, so generation never blocks the event loop
+@app.post("/answer/stream")
+async def answer_stream(request: AnswerReq) -> StreamingResponse:
+    kb_version = kb.version
+    cached, question_vector = await lookup_answer(request.message, request.filters)
+    if cached is not None:
+        events = cached_tokens(cached)
+    else:
+        events = stream_tokens(request.message, request.filters, question_vector, kb_version)
+    return StreamingResponse(
+            events,
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no", ANSWER_CACHE_HEADER: cache_status(cached)}
+            )
+
+# The chunks a question retrieves, optionally filtered by source, type and date added
+@app.post("/retrieve")
+async def retrieve(request: AnswerReq) -> RetrieveRes:
+    return RetrieveRes(chunks=await asyncio.to_thread(kb.retrieve, request.message, request.filters))
+
+# Counters of the caches and schedulers in this server
+@app.get("/stats")
+async def stats() -> dict:
+    return {
+        "summary_cache": kb.summary_cache.stats(),
+        "lexical_index": kb.lexical_index.stats(),
+        "partitions": kb.vectorstore.stats() if isinstance(kb.vectorstore, PartitionedVectorStore) else {"enabled": False},
+        "context": kb.context_packer.stats(),
+        "rerank": kb.reranker.stats() if kb.reranker is not None else {"enabled": False},
+        "answer_cache": answer_cache.stats() if answer_cache is not None else {"enabled": False},
+        "batching": {
+            "enabled": batching_enabled,
+            "batches_run": batcher.batches_run,
+            "avg_batch_size": batcher.avg_batch_size(),
+        },
+    }
+
 @app.get("/healthcheck", status_code=200)
 async def healthcheck() -> None:
     return
@@ -0,0 +1,76 @@
+import asyncio
+from typing import Any, Callable
+
+# Collects concurrent requests into micro-batches and runs them through one batch call.
+# A batch is closed once it holds max_batch_size items or max_wait_ms passed since its first item,
+# batches run one at a time in a worker thread so the event loop stays free.
+class MicroBatcher:
+    def __init__(self, batch_fn: Callable[[list], list], max_batch_size: int = 8, max_wait_ms: float = 20):
+        self.batch_fn = batch_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.queue: asyncio.Queue | None = None
+        self.worker: asyncio.Task | None = None
+
+        # Counters for the throughput benchmark and logs
+        self.batches_run = 0
+        self.items_run = 0
+
+    async def start(self):
+        self.queue = asyncio.Queue()
+        self.worker = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.worker is not None:
+            self.worker.cancel()
+            try:
+                await self.worker
+            except asyncio.CancelledError:
+                pass
+            self.worker = None
+
+    # Queue one item and wait until the batch containing it has been run
+    async def submit(self, item: Any) -> Any:
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((item, future))
+        return await future
+
+    def avg_batch_size(self) -> float:
+        return self.items_run / self.batches_run if self.batches_run else 0.0
+
+    async def _collect(self) -> list:
+        loop = asyncio.get_running_loop()
+        batch = [await self.queue.get()]
+        deadline = loop.time() + self.max_wait
+
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+        # Callers that gave up while waiting do not need a result
+        return [(item, future) for item, future in batch if not future.cancelled()]
+
+    async def _run(self):
+        while True:
+            batch = await self._collect()
+            if not batch:
+                continue
+
+            try:
+                results = await asyncio.to_thread(self.batch_fn, [item for item, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            self.batches_run += 1
+            self.items_run += len(batch)
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
@@ -0,0 +1,112 @@
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import statistics
+import numpy as np
+
+# Add the current directory to the path
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from ann_index import IVFIndex, normalize
+
+# Latency and recall of the local IVF index against Chroma on a synthetic corpus.
+# Chunks are drawn around a few thousand random topics, like real summaries cluster around subjects,
+# and the queries come from the same distribution. Recall@k is measured against an exact scan.
+# Chroma needs chromadb and takes long to fill at 1M vectors, --skip-chroma leaves it out.
+
+def percentile(values: list[float], pct: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+def corpus_batches(n: int, dim: int, topics: int, batch_size: int, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((topics, dim)).astype(np.float32)
+    for start in range(0, n, batch_size):
+        size = min(batch_size, n - start)
+        vectors = centers[rng.integers(0, topics, size)] + 0.6 * rng.standard_normal((size, dim)).astype(np.float32)
+        yield [f"chunk-{i}" for i in range(start, start + size)], normalize(vectors)
+
+def make_queries(n: int, dim: int, topics: int) -> np.ndarray:
+    _, queries = next(corpus_batches(n, dim, topics, n, seed=0))
+    rng = np.random.default_rng(1)
+    # queries are unit vectors, so the noise is scaled to a norm of about 0.3
+    return normalize(queries + 0.3 / np.sqrt(dim) * rng.standard_normal(queries.shape).astype(np.float32))
+
+def recall_at_k(results: list[list[str]], truth: list[list[str]], k: int) -> float:
+    return statistics.mean(len(set(found[:k]) & set(expected[:k])) / k for found, expected in zip(results, truth))
+
+def time_queries(search, queries: np.ndarray) -> tuple[list[float], list[list[str]]]:
+    latencies = []
+    results = []
+    for query in queries:
+        start = time.perf_counter()
+        results.append(search(query))
+        latencies.append(time.perf_counter() - start)
+    return latencies, results
+
+def report(name: str, latencies: list[float], results, truth, k: int):
+    print(f"{name:>14}: p50 {statistics.median(latencies) * 1000:8.2f} ms  "
+          f"p99 {percentile(latencies, 99) * 1000:8.2f} ms  recall@{k} {recall_at_k(results, truth, k):.3f}")
+
+def build_chroma(path: str, n: int, dim: int, topics: int, batch_size: int):
+    import chromadb
+    client = chromadb.PersistentClient(path=path)
+    collection = client.create_collection("bench", metadata={"hnsw:space": "cosine"})
+    for ids, vectors in corpus_batches(n, dim, topics, min(batch_size, 5000)):
+        collection.add(ids=ids, embeddings=vectors.tolist())
+    return collection
+
+def main():
+    parser = argparse.ArgumentParser(description="Local IVF index vs Chroma: latency and recall")
+    parser.add_argument("--n", type=int, default=1_000_000, help="Number of chunks in the synthetic corpus")
+    parser.add_argument("--dim", type=int, default=384)
+    parser.add_argument("--topics", type=int, default=2000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[1, 4, 16, 64])
+    parser.add_argument("--dtype", choices=["float16", "float32"], default="float32")
+    parser.add_argument("--batch-size", type=int, default=50_000)
+    parser.add_argument("--skip-chroma", action="store_true")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="bench_ann_")
+    try:
+        run(args, workdir)
+    finally:
+        shutil.rmtree(workdir)
+
+def run(args, workdir: str):
+    queries = make_queries(args.queries, args.dim, args.topics)
+
+    start = time.perf_counter()
+    index = IVFIndex(os.path.join(workdir, "ivf"), dtype=args.dtype)
+    for ids, vectors in corpus_batches(args.n, args.dim, args.topics, args.batch_size):
+        index.add(ids, vectors)
+    print(f"IVF index: {len(index)} vectors, {index._list_count()} lists, built in {time.perf_counter() - start:.1f}s "
+          f"({os.path.getsize(index.vectors_path) / 2**20:.0f} MB of {args.dtype} vectors)")
+
+    start = time.perf_counter()
+    truth = [[doc_id for doc_id, _ in hits] for hits in index.search_exact(queries, args.k)]
+    print(f"Exact ground truth for {args.queries} queries in {time.perf_counter() - start:.1f}s")
+
+    latencies, results = time_queries(lambda q: [doc_id for doc_id, _ in index.search_exact(q[None, :], args.k)[0]], queries[:20])
+    report("exact scan", latencies, results, truth[:20], args.k)
+
+    for nprobe in args.nprobe:
+        latencies, results = time_queries(lambda q: [doc_id for doc_id, _ in index.search(q, args.k, nprobe)], queries)
+        report(f"ivf nprobe={nprobe}", latencies, results, truth, args.k)
+    index.close()
+
+    if not args.skip_chroma:
+        start = time.perf_counter()
+        collection = build_chroma(os.path.join(workdir, "chroma"), args.n, args.dim, args.topics, args.batch_size)
+        print(f"Chroma: {collection.count()} vectors, built in {time.perf_counter() - start:.1f}s")
+        latencies, results = time_queries(
+            lambda q: collection.query(query_embeddings=[q.tolist()], n_results=args.k)["ids"][0], queries)
+        report("chroma", latencies, results, truth, args.k)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+import os
+import sys
+import time
+import asyncio
+import argparse
+import threading
+import statistics
+
+# Add the current directory to the path
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from batching import MicroBatcher
+
+# Compares /answer throughput of the serial path against the micro-batching scheduler.
+# By default generation is simulated with a fixed cost per forward pass plus a small cost per
+# extra prompt, which is how a left-padded batch behaves on the gpu. --real runs the knowledge base.
+
+questions = [
+    "What is the HbA1c target for most adults with diabetes?",
+    "How should insulin be adjusted for hospitalized patients?",
+    "What are the symptoms of diabetic ketoacidosis?",
+    "How is hypoglycemia treated in the hospital?",
+]
+
+def simulated_batch_fn(pass_ms: float, item_ms: float):
+    def batch_fn(items: list[str]) -> list[str]:
+        time.sleep((pass_ms + item_ms * (len(items) - 1)) / 1000)
+        return [f"answer to {item}" for item in items]
+    return batch_fn
+
+def percentile(values: list[float], pct: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+async def run_serial(batch_fn, requests: int, concurrency: int) -> list[float]:
+    # Same as the old /answer: one question per call and never two calls on the gpu at once
+    lock = threading.Lock()
+
+    def answer(question: str) -> str:
+        with lock:
+            return batch_fn([question])[0]
+
+    return await drive(lambda q: asyncio.to_thread(answer, q), requests, concurrency)
+
+async def run_batched(batch_fn, requests: int, concurrency: int, max_batch_size: int, max_wait_ms: float):
+    batcher = MicroBatcher(batch_fn, max_batch_size=max_batch_size, max_wait_ms=max_wait_ms)
+    await batcher.start()
+    latencies = await drive(batcher.submit, requests, concurrency)
+    await batcher.stop()
+    return latencies, batcher.avg_batch_size()
+
+async def drive(call, requests: int, concurrency: int) -> list[float]:
+    latencies = []
+    pending = iter(range(requests))
+
+    async def client():
+        for i in pending:
+            start = time.perf_counter()
+            await call(questions[i % len(questions)])
+            latencies.append(time.perf_counter() - start)
+
+    await asyncio.gather(*[client() for _ in range(concurrency)])
+    return latencies
+
+def report(name: str, latencies: list[float], elapsed: float, extra: str = ""):
+    print(f"{name:>8}: {len(latencies) / elapsed:8.2f} req/s  "
+          f"p50 {statistics.median(latencies) * 1000:8.1f} ms  "
+          f"p95 {percentile(latencies, 95) * 1000:8.1f} ms {extra}")
+
+async def main():
+    parser = argparse.ArgumentParser(description="Throughput of serial vs micro-batched generation")
+    parser.add_argument("--requests", type=int, default=64)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 8, 16])
+    parser.add_argument("--max-batch-size", type=int, default=int(os.getenv("BATCH_MAX_SIZE", "8")))
+    parser.add_argument("--max-wait-ms", type=float, default=float(os.getenv("BATCH_MAX_WAIT_MS", "20")))
+    parser.add_argument("--pass-ms", type=float, default=400, help="Simulated cost of one forward pass")
+    parser.add_argument("--item-ms", type=float, default=40, help="Simulated extra cost per prompt in a batch")
+    parser.add_argument("--real", action="store_true", help="Use the real knowledge base instead of a simulation")
+    args = parser.parse_args()
+
+    if args.real:
+        from multimodal_rag import DiabetesKnowledgeBase
+        batch_fn = DiabetesKnowledgeBase().answer_questions
+    else:
+        batch_fn = simulated_batch_fn(args.pass_ms, args.item_ms)
+
+    for concurrency in args.concurrency:
+        print(f"--- concurrency {concurrency}, {args.requests} requests")
+
+        start = time.perf_counter()
+        latencies = await run_serial(batch_fn, args.requests, concurrency)
+        report("serial", latencies, time.perf_counter() - start)
+
+        start = time.perf_counter()
+        latencies, avg_batch = await run_batched(batch_fn, args.requests, concurrency, args.max_batch_size, args.max_wait_ms)
+        report("batched", latencies, time.perf_counter() - start, f"avg batch {avg_batch:.1f}")
+
+if __name__ == "__main__":
+    asyncio.run(main())
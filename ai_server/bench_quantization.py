@@ -0,0 +1,130 @@
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import hashlib
+import argparse
+import tempfile
+import statistics
+import numpy as np
+
+# Add the current directory to the path
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from ann_index import IVFIndex, normalize
+from lexical_index import tokenize
+from bench_ann import corpus_batches, percentile, recall_at_k
+
+# Memory, latency and recall of the quantized first pass of the local IVF index on the questions of
+# rag_method/evaluation_dataset.json. The ground truth is an exact float32 scan, so the recall is what
+# quantization and the rescoring short list lose compared to full vectors.
+# By default the questions and the sentences of their ground truth answers are embedded with a hashed
+# bag of words, so no model is needed. --real embeds them with the knowledge base's model and searches
+# the vectors ingested in ./data/processed (processed_fake with FAKE_MODELS). Random distractor vectors scale the index up in both modes.
+
+DEFAULT_DATASET = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "rag_method", "evaluation_dataset.json")
+
+# Every token adds a random direction seeded by its hash, texts sharing words end up close
+def hashed_embedding(text: str, dim: int) -> np.ndarray:
+    vector = np.zeros(dim, dtype=np.float32)
+    for token in tokenize(text):
+        seed = int.from_bytes(hashlib.sha256(token.encode('utf-8')).digest()[:8], "little")
+        vector += np.random.default_rng(seed).standard_normal(dim).astype(np.float32)
+    return vector
+
+def load_dataset(path: str) -> tuple[list[str], list[str]]:
+    with open(path, 'r') as f:
+        dataset = json.load(f)
+    questions = [item["question"].strip() for item in dataset]
+    sentences = [sentence.strip() for item in dataset for sentence in re.split(r"\n|(?<=[.!?])\s+", item["ground_truth"])
+                 if sentence.strip()]
+    return questions, sentences
+
+def simulated_corpus(questions: list[str], sentences: list[str], dim: int):
+    corpus = normalize([hashed_embedding(sentence, dim) for sentence in sentences])
+    queries = normalize([hashed_embedding(question, dim) for question in questions])
+    return [f"answer-{i}" for i in range(len(sentences))], corpus, queries
+
+def real_corpus(questions: list[str]):
+    from models import init_embeddings, processed_dir_name
+    from vector_store import open_vectorstore, vector_pages
+
+    embeddings = init_embeddings()
+    processed_dir = os.path.join("./data", processed_dir_name)
+    store = open_vectorstore(embeddings, processed_dir)
+    ids, vectors = [], []
+    for page_ids, page_vectors, _ in vector_pages(store):
+        ids.extend(page_ids)
+        vectors.append(page_vectors)
+    if not ids:
+        raise SystemExit(f"No ingested vectors in {processed_dir}, run an ingest first or leave out --real")
+    return ids, normalize(np.concatenate(vectors)), normalize(embeddings.embed_documents(questions))
+
+def build_index(path: str, quantization: str, ids: list[str], corpus: np.ndarray, distractors: int, batch_size: int):
+    index = IVFIndex(path, quantization=quantization)
+    index.add(ids, corpus)
+    if distractors:
+        for batch_ids, vectors in corpus_batches(distractors, corpus.shape[1], max(1, distractors // 500), batch_size):
+            index.add(batch_ids, vectors)
+    return index
+
+def main():
+    parser = argparse.ArgumentParser(description="Quantized IVF first pass: memory saved, latency and recall loss")
+    parser.add_argument("--dataset", default=DEFAULT_DATASET)
+    parser.add_argument("--real", action="store_true", help="Embed with the knowledge base's model and search its ingested vectors")
+    parser.add_argument("--distractors", type=int, default=200_000, help="Random vectors added next to the corpus")
+    parser.add_argument("--dim", type=int, default=384, help="Dimension of the hashed embeddings")
+    parser.add_argument("--k", type=int, default=4)
+    parser.add_argument("--nprobe", type=int, default=16)
+    parser.add_argument("--rescore", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--repeat", type=int, default=20, help="Times every question is searched for the latency")
+    parser.add_argument("--batch-size", type=int, default=50_000)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="bench_quantization_")
+    try:
+        run(args, workdir)
+    finally:
+        shutil.rmtree(workdir)
+
+def run(args, workdir: str):
+    questions, sentences = load_dataset(args.dataset)
+    if args.real:
+        ids, corpus, queries = real_corpus(questions)
+    else:
+        ids, corpus, queries = simulated_corpus(questions, sentences, args.dim)
+    print(f"{len(questions)} questions against {len(ids)} chunks and {args.distractors} distractors, dim {corpus.shape[1]}")
+
+    baseline = None
+    baseline_recall = None
+    for quantization in ["none", "int8", "binary"]:
+        start = time.perf_counter()
+        index = build_index(os.path.join(workdir, quantization), quantization, ids, corpus, args.distractors, args.batch_size)
+        scanned = index.scan_bytes_per_vector() * len(index)
+        baseline = baseline or scanned
+        print(f"\n{quantization}: built in {time.perf_counter() - start:.1f}s, first pass scans {scanned / 2**20:.1f} MB "
+              f"({100 * (1 - scanned / baseline):.0f}% saved)")
+
+        truth = [[doc_id for doc_id, _ in hits] for hits in index.search_exact(queries, args.k)]
+        for rescore in args.rescore if quantization != "none" else [1]:
+            index.rescore = rescore
+            latencies, results = [], []
+            for query in queries:
+                for _ in range(args.repeat):
+                    start = time.perf_counter()
+                    hits = index.search(query, args.k, args.nprobe)
+                    latencies.append(time.perf_counter() - start)
+                results.append([doc_id for doc_id, _ in hits])
+
+            # the float32 index loses some recall to the IVF lists already, the loss is what quantization adds
+            recall = recall_at_k(results, truth, args.k)
+            baseline_recall = recall if baseline_recall is None else baseline_recall
+            name = f"rescore={rescore}" if quantization != "none" else "float32"
+            print(f"{name:>14}: p50 {statistics.median(latencies) * 1000:7.2f} ms  p95 {percentile(latencies, 95) * 1000:7.2f} ms  "
+                  f"recall@{args.k} {recall:.3f}  loss {baseline_recall - recall:+.3f}")
+        index.close()
+
+if __name__ == "__main__":
+    main()
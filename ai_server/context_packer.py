@@ -0,0 +1,120 @@
+import os
+import re
+import threading
+from collections import deque
+from typing import Callable
+
+# Token budget of the <context> block of the prompt, TinyLlama has a 2048 token window in total
+context_token_budget = int(os.getenv("CONTEXT_TOKEN_BUDGET", "1024"))
+# Passages whose word shingles overlap an already packed passage this much are dropped
+context_dedup_threshold = float(os.getenv("CONTEXT_DEDUP_THRESHOLD", "0.8"))
+# A truncated passage shorter than this is not worth its place in the prompt
+context_min_tokens = int(os.getenv("CONTEXT_MIN_TOKENS", "32"))
+
+_SENTENCE_END = re.compile(r"(?<=[.!?])\s+")
+_SEPARATOR = "\n\n"
+
+def shingles(text: str, size: int = 3) -> set[tuple[str, ...]]:
+    words = text.lower().split()
+    return {tuple(words[i:i + size]) for i in range(max(1, len(words) - size + 1))}
+
+def jaccard(a: set, b: set) -> float:
+    return len(a & b) / len(a | b) if a and b else 0.0
+
+# Packs retrieved passages into a fixed token budget for the prompt.
+# Passages arrive best first and are taken greedily: one that does not fit is cut at the last
+# sentence boundary that does, and a near duplicate of a passage already packed is skipped.
+# The tokens of every request are recorded, so the prompt size can be watched in /stats.
+class ContextPacker:
+    def __init__(self, count_tokens: Callable[[str], int], budget: int = context_token_budget,
+                 dedup_threshold: float = context_dedup_threshold, min_tokens: int = context_min_tokens):
+        self.count_tokens = count_tokens
+        self.budget = budget
+        self.dedup_threshold = dedup_threshold
+        self.min_tokens = min_tokens
+        self.separator_tokens = count_tokens(_SEPARATOR)
+
+        self._lock = threading.Lock()
+        self._recent = deque(maxlen=1000)
+        self.requests = 0
+        self.total_tokens = 0
+        self.chunks_in = 0
+        self.chunks_packed = 0
+        self.duplicates_dropped = 0
+        self.truncated = 0
+
+    # The leading sentences of a passage that fit in max_tokens
+    def _truncate(self, passage: str, max_tokens: int) -> str:
+        kept = []
+        used = 0
+        for sentence in _SENTENCE_END.split(passage):
+            tokens = self.count_tokens(sentence) + (1 if kept else 0)
+            if used + tokens > max_tokens:
+                break
+            kept.append(sentence)
+            used += tokens
+
+        # tokens of the joined text can differ a little from the sum of its sentences
+        while kept and self.count_tokens(" ".join(kept)) > max_tokens:
+            kept.pop()
+        return " ".join(kept)
+
+    # Returns the packed context and the number of tokens it uses
+    def pack(self, passages: list[str]) -> tuple[str, int]:
+        packed = []
+        packed_shingles = []
+        used = 0
+        duplicates = 0
+        truncated = 0
+
+        for passage in passages:
+            passage = passage.strip()
+            if not passage:
+                continue
+
+            passage_shingles = shingles(passage)
+            if any(jaccard(passage_shingles, seen) >= self.dedup_threshold for seen in packed_shingles):
+                duplicates += 1
+                continue
+
+            remaining = self.budget - used - (self.separator_tokens if packed else 0)
+            if remaining < self.min_tokens:
+                break
+
+            tokens = self.count_tokens(passage)
+            if tokens > remaining:
+                passage = self._truncate(passage, remaining)
+                tokens = self.count_tokens(passage) if passage else 0
+                if tokens < self.min_tokens:
+                    continue
+                truncated += 1
+
+            used += tokens + (self.separator_tokens if packed else 0)
+            packed.append(passage)
+            packed_shingles.append(passage_shingles)
+
+        with self._lock:
+            self.requests += 1
+            self.total_tokens += used
+            self.chunks_in += len(passages)
+            self.chunks_packed += len(packed)
+            self.duplicates_dropped += duplicates
+            self.truncated += truncated
+            self._recent.append(used)
+
+        return _SEPARATOR.join(packed), used
+
+    def stats(self) -> dict:
+        with self._lock:
+            recent = sorted(self._recent)
+            return {
+                "budget": self.budget,
+                "requests": self.requests,
+                "avg_tokens": round(self.total_tokens / self.requests, 1) if self.requests else 0.0,
+                "avg_chunks_in": round(self.chunks_in / self.requests, 1) if self.requests else 0.0,
+                "avg_chunks_packed": round(self.chunks_packed / self.requests, 1) if self.requests else 0.0,
+                "p50_tokens": recent[len(recent) // 2] if recent else 0,
+                "max_tokens": recent[-1] if recent else 0,
+                "duplicates_dropped": self.duplicates_dropped,
+                "truncated": self.truncated,
+            }
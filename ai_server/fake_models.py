@@ -0,0 +1,139 @@
+import os
+import re
+import time
+import random
+import hashlib
+import threading
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from lexical_index import tokenize
+
+# Stand-ins for the Hugging Face models of models.py, used with FAKE_MODELS=true. They need neither
+# weights nor CUDA, answer deterministically and take a configurable time, so ingest, retrieval and
+# load tests run on any machine and measure our own code apart from the model.
+
+fake_first_token_ms = float(os.getenv("FAKE_LLM_FIRST_TOKEN_MS", "50"))
+fake_tokens_per_second = float(os.getenv("FAKE_LLM_TOKENS_PER_SECOND", "100"))  # 0 generates without delay
+fake_max_tokens = int(os.getenv("FAKE_LLM_MAX_TOKENS", "64"))
+fake_seed = os.getenv("FAKE_LLM_SEED", "0")
+fake_embedding_ms = float(os.getenv("FAKE_EMBEDDING_MS", "0"))  # per call, a batch costs the same as one text
+fake_embedding_dim = int(os.getenv("FAKE_EMBEDDING_DIM", "384"))
+
+_WORD = re.compile(r"[A-Za-z][A-Za-z\-]{3,}")
+_FALLBACK_WORDS = ["diabetes", "insulin", "glucose", "patients", "therapy", "monitoring", "treatment", "risk"]
+
+# The answer is made of words of the prompt itself, so summaries stay close to the text they summarize
+def fake_completion(prompt: str, max_tokens: int = fake_max_tokens, seed: str = fake_seed) -> list[str]:
+    rng = random.Random(hashlib.sha256(f"{seed}\0{prompt}".encode('utf-8')).digest())
+    words = _WORD.findall(prompt) or _FALLBACK_WORDS
+    tokens = [rng.choice(words).lower() for _ in range(max_tokens)]
+    tokens[0] = tokens[0].capitalize()
+    tokens[-1] += "."
+    return [token if i == 0 else " " + token for i, token in enumerate(tokens)]
+
+# Whitespace tokenizer with the parts of the Hugging Face interface our code and langchain use
+class FakeTokenizer:
+    eos_token = "</s>"
+    pad_token = "</s>"
+    eos_token_id = 2
+    pad_token_id = 2
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._vocab = {"<unk>": 0, "<s>": 1, "</s>": 2}
+        self._words = ["<unk>", "<s>", "</s>"]
+
+    def convert_tokens_to_ids(self, tokens):
+        if isinstance(tokens, str):
+            return self._id(tokens)
+        return [self._id(token) for token in tokens]
+
+    def _id(self, token: str) -> int:
+        with self._lock:
+            if token not in self._vocab:
+                self._vocab[token] = len(self._words)
+                self._words.append(token)
+            return self._vocab[token]
+
+    def encode(self, text: str, add_special_tokens: bool = True) -> list[int]:
+        ids = [self._id(token) for token in text.split()]
+        return [1] + ids if add_special_tokens else ids
+
+    def decode(self, ids, skip_special_tokens: bool = False) -> str:
+        if skip_special_tokens:
+            ids = [i for i in ids if i > 2]
+        return " ".join(self._words[i] if i < len(self._words) else "<unk>" for i in ids)
+
+# Callable like a transformers pipeline, which is all HuggingFacePipeline needs. A batch of prompts
+# takes as long as one, as on the GPU: the first token latency plus the answer at the token rate.
+class FakeTextPipeline:
+    def __init__(self, task: str = "text-generation", first_token_ms: float = fake_first_token_ms,
+                 tokens_per_second: float = fake_tokens_per_second, max_tokens: int = fake_max_tokens):
+        self.task = task
+        self.tokenizer = FakeTokenizer()
+        self.first_token_ms = first_token_ms
+        self.tokens_per_second = tokens_per_second
+        self.max_tokens = max_tokens
+        self.calls = 0
+        self.prompts = 0
+
+    def _token_delay(self) -> float:
+        return 1 / self.tokens_per_second if self.tokens_per_second > 0 else 0
+
+    # Generated text starts with the prompt like the chat model's, the answer follows the assistant tag
+    def _result(self, prompt: str) -> dict:
+        completion = "".join(fake_completion(prompt, self.max_tokens))
+        if self.task == "summarization":
+            return {"summary_text": completion}
+        return {"generated_text": f"{prompt}\n<|assistant|>\n{completion}"}
+
+    def __call__(self, text_inputs, streamer=None, **kwargs):
+        single = isinstance(text_inputs, str)
+        prompts = [text_inputs] if single else list(text_inputs)
+        self.calls += 1
+        self.prompts += len(prompts)
+
+        # Streaming runs one prompt in a thread and hands every token to the streamer as it is generated
+        if streamer is not None:
+            time.sleep(self.first_token_ms / 1000)
+            for i, token in enumerate(fake_completion(prompts[0], self.max_tokens)):
+                if i > 0:
+                    time.sleep(self._token_delay())
+                streamer.on_finalized_text(token)
+            streamer.on_finalized_text("", stream_end=True)
+            return None
+
+        time.sleep(self.first_token_ms / 1000 + (self.max_tokens - 1) * self._token_delay())
+        results = [[self._result(prompt)] for prompt in prompts]
+        return results[0] if single else results
+
+# Hashed bag of words: every token adds a random direction seeded by its hash, texts sharing words end up close
+class FakeEmbeddings(Embeddings):
+    def __init__(self, dim: int = fake_embedding_dim, latency_ms: float = fake_embedding_ms):
+        self.dim = dim
+        self.latency_ms = latency_ms
+
+    def _embed(self, text: str) -> list[float]:
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for token in tokenize(text) or [text]:
+            seed = int.from_bytes(hashlib.sha256(token.encode('utf-8')).digest()[:8], "little")
+            vector += np.random.default_rng(seed).standard_normal(self.dim).astype(np.float32)
+        norm = np.linalg.norm(vector)
+        return (vector / norm if norm else vector).tolist()
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        time.sleep(self.latency_ms / 1000)
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text: str) -> list[float]:
+        return self.embed_documents([text])[0]
+
+# Scores a (query, passage) pair by the share of the query's tokens the passage contains
+class FakeCrossEncoder:
+    def predict(self, pairs, batch_size: int = 32) -> np.ndarray:
+        scores = []
+        for query, passage in pairs:
+            query_tokens = set(tokenize(query))
+            overlap = len(query_tokens & set(tokenize(passage)))
+            scores.append(overlap / len(query_tokens) if query_tokens else 0.0)
+        return np.asarray(scores, dtype=np.float32)
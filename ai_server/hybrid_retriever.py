@@ -0,0 +1,101 @@
+import os
+from typing import Any
+from pydantic import ConfigDict
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.retrievers import BaseRetriever
+from langchain_core.stores import BaseStore
+from langchain_core.vectorstores import VectorStore
+from lexical_index import BM25Index
+
+# Retrieval settings, RETRIEVAL=hybrid fuses BM25 into the plain MultiVectorRetriever of RETRIEVAL=dense
+retrieval_mode = os.getenv("RETRIEVAL", "dense")
+retrieval_k = int(os.getenv("RETRIEVAL_K", "4"))
+# Candidates of each leg, unless they are set they follow k: k dense and 2 * k lexical
+hybrid_dense_k = int(os.environ["HYBRID_DENSE_K"]) if "HYBRID_DENSE_K" in os.environ else None
+hybrid_lexical_k = int(os.environ["HYBRID_LEXICAL_K"]) if "HYBRID_LEXICAL_K" in os.environ else None
+hybrid_fusion = os.getenv("HYBRID_FUSION", "rrf")  # "rrf" or "weighted"
+hybrid_alpha = float(os.getenv("HYBRID_ALPHA", "0.5"))  # weight of the dense leg in the weighted blend
+rrf_k = 60
+# A filtered lexical search takes this many times lexical_k hits and keeps the ones whose vectors match
+lexical_filter_oversample = 4
+
+# Reciprocal rank fusion: every list adds 1 / (rrf_k + rank) to the documents it ranks
+def reciprocal_rank_fusion(rankings: list[list[str]], k: int = rrf_k) -> dict[str, float]:
+    fused: dict[str, float] = {}
+    for ranking in rankings:
+        for rank, doc_id in enumerate(ranking):
+            fused[doc_id] = fused.get(doc_id, 0.0) + 1.0 / (k + rank + 1)
+    return fused
+
+# Weighted blend of min-max normalized scores, a document missing from one list scores 0 there
+def weighted_fusion(dense: list[tuple[str, float]], lexical: list[tuple[str, float]], alpha: float) -> dict[str, float]:
+    def normalized(results: list[tuple[str, float]]) -> dict[str, float]:
+        if not results:
+            return {}
+        scores = [score for _, score in results]
+        low, high = min(scores), max(scores)
+        return {doc_id: (score - low) / (high - low) if high > low else 1.0 for doc_id, score in results}
+
+    fused: dict[str, float] = {}
+    for weight, scores in [(alpha, normalized(dense)), (1 - alpha, normalized(lexical))]:
+        for doc_id, score in scores.items():
+            fused[doc_id] = fused.get(doc_id, 0.0) + weight * score
+    return fused
+
+# Dense search over the summary vectors fused with BM25 over the parent chunks, returns the parent chunks
+# like the MultiVectorRetriever. Exact terms such as drug names and ICD codes are found by the lexical leg,
+# so the dense leg can stay small. With a metadata filter (a Chroma where clause) both legs only return
+# chunks whose vectors match it.
+class HybridRetriever(BaseRetriever):
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    vectorstore: VectorStore
+    docstore: BaseStore[str, Any]
+    lexical_index: BM25Index
+    id_key: str = "doc_id"
+    k: int = retrieval_k
+    dense_k: int | None = hybrid_dense_k
+    lexical_k: int | None = hybrid_lexical_k
+    fusion: str = hybrid_fusion
+    alpha: float = hybrid_alpha
+    filter: dict | None = None
+
+    def _dense(self, query: str, k: int) -> list[tuple[str, float]]:
+        results = []
+        seen = set()
+        search_kwargs = {"filter": self.filter} if self.filter else {}
+        for document, score in self.vectorstore.similarity_search_with_relevance_scores(query, k=k, **search_kwargs):
+            doc_id = document.metadata.get(self.id_key)
+            if doc_id is not None and doc_id not in seen:
+                seen.add(doc_id)
+                results.append((doc_id, score))
+        return results
+
+    # BM25 knows nothing about metadata, the hits are checked against their vectors instead
+    def _lexical(self, query: str, k: int) -> list[tuple[str, float]]:
+        if not self.filter:
+            return self.lexical_index.search(query, k)
+
+        hits = self.lexical_index.search(query, k * lexical_filter_oversample)
+        if not hits:
+            return []
+        # hits are matched on the doc id in the metadata, not on vector ids: vectors ingested before the
+        # manifest have random ids of their own
+        where = {"$and": [self.filter, {self.id_key: {"$in": [doc_id for doc_id, _ in hits]}}]}
+        matching = self.vectorstore.get(where=where, include=["metadatas"])
+        allowed = {metadata.get(self.id_key) for metadata in matching["metadatas"] if metadata}
+        return [(doc_id, score) for doc_id, score in hits if doc_id in allowed][:k]
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> list[Any]:
+        dense_k = self.k if self.dense_k is None else self.dense_k
+        lexical_k = 2 * self.k if self.lexical_k is None else self.lexical_k
+        dense = self._dense(query, dense_k) if dense_k else []
+        lexical = self._lexical(query, lexical_k) if lexical_k else []
+
+        if self.fusion == "weighted":
+            fused = weighted_fusion(dense, lexical, self.alpha)
+        else:
+            fused = reciprocal_rank_fusion([[doc_id for doc_id, _ in dense], [doc_id for doc_id, _ in lexical]])
+
+        doc_ids = sorted(fused, key=fused.get, reverse=True)[:self.k]
+        return [document for document in self.docstore.mget(doc_ids) if document is not None]
@@ -0,0 +1,274 @@
+import os
+import sys
+import json
+import time
+import queue
+import threading
+import subprocess
+from manifest import chunk_id
+
+# Concurrency of every ingest stage, the queues between stages are bounded so a fast stage
+# can only run INGEST_QUEUE_SIZE files ahead of the next one
+parse_workers = int(os.getenv("INGEST_PARSE_WORKERS", str(max(1, (os.cpu_count() or 2) - 1))))
+summary_batch_size = int(os.getenv("INGEST_SUMMARY_BATCH_SIZE", "32"))
+summary_concurrency = int(os.getenv("INGEST_SUMMARY_CONCURRENCY", "12"))
+embed_batch_size = int(os.getenv("INGEST_EMBED_BATCH_SIZE", "256"))
+# The write stage has no worker count, it commits one file at a time: the commit of a file goes through
+# the single ingest journal, and the manifest counts chunks shared between files, so two files written at
+# once could each take a shared chunk for new or delete it from under the other. Its throughput knob is
+# the embedding batch size.
+queue_size = int(os.getenv("INGEST_QUEUE_SIZE", "2"))
+
+chunk_max_length = 2000
+# Characters the end of a chunk repeats at the start of the next one, and where chunks may be cut:
+# "line" between lines of the PDF, "sentence" between sentences. Both apply to PDFs ingested from then on
+chunk_overlap = int(os.getenv("CHUNK_OVERLAP", "0"))
+chunk_boundary = os.getenv("CHUNK_BOUNDARY", "line")
+
+# Marks the end of the work going through a queue
+_DONE = object()
+_WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "parse_worker.py")
+
+# One parse_worker.py process. It is a fresh interpreter rather than a fork or a multiprocessing spawn:
+# a fork would copy the server with its loaded models and running threads, whose locks may be held,
+# and a spawned child runs the main script, app.py, again before it runs anything else.
+class ParseWorker:
+    def __init__(self):
+        self.process = subprocess.Popen([sys.executable, _WORKER_SCRIPT], stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE, text=True, encoding='utf-8')
+
+    def alive(self) -> bool:
+        return self.process.poll() is None
+
+    # The hash and text chunks of one PDF. The worker sends the chunks in batches, they are all kept
+    # because the write stage commits a file at once.
+    def parse(self, pdf_path: str, max_length: int, overlap: int, boundary: str) -> tuple[str, list[str]]:
+        request = {"pdf_path": pdf_path, "max_length": max_length, "overlap": overlap, "boundary": boundary}
+        self.process.stdin.write(json.dumps(request) + "\n")
+        self.process.stdin.flush()
+
+        chunks = []
+        while True:
+            line = self.process.stdout.readline()
+            if not line:
+                raise RuntimeError(f"parse worker exited with code {self.process.wait()}")
+            answer = json.loads(line)
+            if "error" in answer:
+                raise RuntimeError(answer["error"])
+            if "hash" in answer:
+                return answer["hash"], chunks
+            chunks.extend(answer["chunks"])
+
+    def close(self):
+        try:
+            self.process.stdin.close()
+            self.process.wait(timeout=10)
+        except (OSError, subprocess.TimeoutExpired):
+            self.process.kill()
+
+# Counts the work done by one stage and the time it spent busy
+class StageMetrics:
+    def __init__(self, name: str, unit: str):
+        self.name = name
+        self.unit = unit
+        self.files = 0
+        self.items = 0
+        self.busy_seconds = 0.0
+        self.lock = threading.Lock()
+
+    def record(self, items: int, seconds: float, files: int = 0):
+        with self.lock:
+            self.items += items
+            self.files += files
+            self.busy_seconds += seconds
+
+    def rate(self) -> float:
+        return self.items / self.busy_seconds if self.busy_seconds else 0.0
+
+    def as_dict(self) -> dict:
+        return {
+            "files": self.files,
+            self.unit: self.items,
+            "busy_seconds": round(self.busy_seconds, 3),
+            f"{self.unit}_per_second": round(self.rate(), 3),
+        }
+
+    def __str__(self) -> str:
+        return f"[{self.name}] {self.files} files, {self.items} {self.unit}, {self.rate():.2f} {self.unit}/s"
+
+# Staged ingestion of many PDFs: parse in worker processes, summarize in batches on the summary model,
+# then embed and write to the vector store in batches. Every stage runs at the same time on different files.
+# Only chunks the knowledge base has never seen are summarized and embedded, the rest are reused.
+# Summaries are checkpointed per batch in the summary cache, so a file that was interrupted resumes
+# from its last finished batch, and the write of each file is committed all at once.
+class IngestPipeline:
+    def __init__(self, kb, parse_workers: int = parse_workers, summary_batch_size: int = summary_batch_size,
+                 summary_concurrency: int = summary_concurrency, embed_batch_size: int = embed_batch_size,
+                 queue_size: int = queue_size):
+        self.kb = kb
+        self.parse_workers = parse_workers
+        self.summary_batch_size = summary_batch_size
+        self.summary_concurrency = summary_concurrency
+        self.embed_batch_size = embed_batch_size
+
+        self.parsed = queue.Queue(maxsize=queue_size)
+        self.summarized = queue.Queue(maxsize=queue_size)
+
+        self.metrics = {
+            "parse": StageMetrics("parse", "chunks"),
+            "summarize": StageMetrics("summarize", "chunks"),
+            "write": StageMetrics("write", "chunks"),
+        }
+        self.failed: list[str] = []
+
+    # Run every PDF through the pipeline and return the stage metrics
+    def run(self, pdf_paths: list[str]) -> dict:
+        if not pdf_paths:
+            return {}
+
+        start = time.perf_counter()
+        stages = [
+            threading.Thread(target=self._parse_stage, args=(pdf_paths,), name="ingest-parse"),
+            threading.Thread(target=self._summarize_stage, name="ingest-summarize"),
+            threading.Thread(target=self._write_stage, name="ingest-write"),
+        ]
+        for stage in stages:
+            stage.start()
+        for stage in stages:
+            stage.join()
+
+        result = {name: metrics.as_dict() for name, metrics in self.metrics.items()}
+        result["wall_seconds"] = round(time.perf_counter() - start, 3)
+        result["failed"] = list(self.failed)
+        result["summary_cache"] = self.kb.summary_cache.stats()
+        print(f"Ingested {len(pdf_paths) - len(self.failed)}/{len(pdf_paths)} PDFs in {result['wall_seconds']}s")
+        print(f"Summary cache: {result['summary_cache']}")
+        return result
+
+    def _fail(self, pdf_path: str, stage: str, error: Exception):
+        print(f"Failed to {stage} {pdf_path}: {str(error)}")
+        self.failed.append(pdf_path)
+
+    # Every stage hands _DONE on however it ends, so the stages after it always finish too
+    def _parse_stage(self, pdf_paths: list[str]):
+        pending = queue.SimpleQueue()
+        for pdf_path in pdf_paths:
+            pending.put(pdf_path)
+
+        try:
+            # every thread drives one worker process, a full queue holds them back until the next stage catches up
+            threads = [threading.Thread(target=self._parse_files, args=(pending,), name=f"ingest-parse-{i}")
+                       for i in range(self.parse_workers)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            # files no thread got to, when the threads stopped early
+            while not pending.empty():
+                self._fail(pending.get(), "parse", RuntimeError("the parse stage stopped"))
+        finally:
+            self.parsed.put(_DONE)
+
+    def _parse_files(self, pending: queue.SimpleQueue):
+        worker = None
+        try:
+            while True:
+                try:
+                    pdf_path = pending.get_nowait()
+                except queue.Empty:
+                    return
+
+                start = time.perf_counter()
+                try:
+                    # a PDF that crashed MuPDF took its worker down, the next file gets a new one
+                    if worker is None or not worker.alive():
+                        worker = ParseWorker()
+                    file_hash, chunks = worker.parse(pdf_path, chunk_max_length, chunk_overlap, chunk_boundary)
+                except Exception as e:
+                    self._fail(pdf_path, "parse", e)
+                    continue
+
+                self.metrics["parse"].record(len(chunks), time.perf_counter() - start, files=1)
+                print(f"{self.metrics['parse']} - parsed {os.path.basename(pdf_path)} into {len(chunks)} chunks")
+                self.parsed.put((pdf_path, file_hash, chunks))
+        finally:
+            if worker is not None:
+                worker.close()
+
+    def _summarize_stage(self):
+        item = None
+        try:
+            while True:
+                item = self.parsed.get()
+                if item is _DONE:
+                    return
+                self._summarize_file(*item)
+        except Exception as e:
+            self._fail(item[0], "summarize", e)
+            self._drain(self.parsed, "summarize")
+        finally:
+            self.summarized.put(_DONE)
+
+    def _summarize_file(self, pdf_path: str, file_hash: str, chunks: list[str]):
+        try:
+            chunk_ids = [chunk_id(chunk) for chunk in chunks]
+
+            # unchanged chunks keep their stored summaries and vectors, duplicates are summarized once
+            new_chunks = {}
+            for cid, chunk in zip(chunk_ids, chunks):
+                if cid not in new_chunks and not self.kb.manifest.is_known(cid):
+                    new_chunks[cid] = chunk
+            new_ids = list(new_chunks.keys())
+            chunks = list(new_chunks.values())
+            print(f"{os.path.basename(pdf_path)}: {len(chunks)} new chunks, {len(chunk_ids) - len(chunks)} reused")
+
+            summaries = []
+            for i in range(0, len(chunks), self.summary_batch_size):
+                batch = chunks[i:i + self.summary_batch_size]
+                batch_start = time.perf_counter()
+                # chunks summarized before, by an earlier run or another file, come from the summary cache
+                summaries.extend(self.kb.summary_cache.summarize(
+                    new_ids[i:i + self.summary_batch_size], batch, self._summarize_batch))
+                self.metrics["summarize"].record(len(batch), time.perf_counter() - batch_start)
+                print(f"{self.metrics['summarize']} - {len(summaries)}/{len(chunks)} of {os.path.basename(pdf_path)}")
+        except Exception as e:
+            self._fail(pdf_path, "summarize", e)
+            return
+
+        self.metrics["summarize"].record(0, 0, files=1)
+        self.summarized.put((pdf_path, file_hash, chunk_ids, new_ids, chunks, summaries))
+
+    def _summarize_batch(self, chunks: list[str]) -> list[str]:
+        return self.kb.summary_chain.batch(chunks, {"max_concurrency": self.summary_concurrency})
+
+    def _write_stage(self):
+        item = None
+        try:
+            while True:
+                item = self.summarized.get()
+                if item is _DONE:
+                    return
+                self._write_file(*item)
+        except Exception as e:
+            self._fail(item[0], "write", e)
+            self._drain(self.summarized, "write")
+
+    def _write_file(self, pdf_path: str, file_hash: str, chunk_ids: list[str], new_ids: list[str],
+                    chunks: list[str], summaries: list[str]):
+        try:
+            write_start = time.perf_counter()
+            self.kb._commit_file(pdf_path, file_hash, chunk_ids, new_ids, chunks, summaries, self.embed_batch_size)
+        except Exception as e:
+            self._fail(pdf_path, "write", e)
+            return
+
+        self.metrics["write"].record(len(chunks), time.perf_counter() - write_start, files=1)
+        print(f"{self.metrics['write']} - finished {os.path.basename(pdf_path)}")
+
+    # After a stage stopped, fail the files still coming to it so the stage before never blocks on a full queue
+    def _drain(self, source: queue.Queue, stage: str):
+        while True:
+            item = source.get()
+            if item is _DONE:
+                return
+            self._fail(item[0], stage, RuntimeError(f"the {stage} stage stopped"))
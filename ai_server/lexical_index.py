@@ -0,0 +1,294 @@
+import os
+import re
+import json
+import math
+import shutil
+import threading
+from collections import Counter
+import numpy as np
+from manifest import write_json_atomic
+
+# BM25 parameters and the number of segments of the same size that are merged into one
+bm25_k1 = float(os.getenv("BM25_K1", "1.2"))
+bm25_b = float(os.getenv("BM25_B", "0.75"))
+bm25_merge_factor = int(os.getenv("BM25_MERGE_FACTOR", "8"))
+
+# Words joined by dots, dashes or slashes stay one token too, so "E11.9", "GLP-1" or "mg/dL" can be matched exactly
+_TOKEN = re.compile(r"[a-z0-9]+(?:[.\-/][a-z0-9]+)*")
+_STOPWORDS = frozenset(
+    "a an and are as at be by for from has have in is it its of on or that the to was were which with".split()
+)
+
+def tokenize(text: str) -> list[str]:
+    tokens = []
+    for token in _TOKEN.findall(text.lower()):
+        if token in _STOPWORDS:
+            continue
+        tokens.append(token)
+        # compound tokens are also indexed by their parts
+        if not token.isalnum():
+            tokens.extend(part for part in re.split(r"[.\-/]", token) if part not in _STOPWORDS)
+    return tokens
+
+# One immutable segment of the index, a directory of:
+#   terms.txt       the terms, one per line, sorted
+#   offsets.npy     int64, postings of term i are at offsets[i]:offsets[i + 1]
+#   docs.npy        uint32, document ordinals of every posting, ascending per term
+#   tfs.npy         uint16, term frequency of every posting
+#   doc_ids.txt     the id of every document ordinal, one per line
+#   lengths.npy     uint32, number of tokens of every document
+# The postings arrays are memory-mapped, only the term dictionary is loaded.
+class Segment:
+    def __init__(self, path: str, deleted: list[int]):
+        self.path = path
+        self.name = os.path.basename(path)
+        with open(os.path.join(path, "terms.txt"), 'r', encoding='utf-8') as f:
+            self.terms = f.read().split("\n") if os.path.getsize(os.path.join(path, "terms.txt")) else []
+        self.term_index = {term: i for i, term in enumerate(self.terms)}
+        with open(os.path.join(path, "doc_ids.txt"), 'r', encoding='utf-8') as f:
+            self.doc_ids = f.read().split("\n")
+
+        self.offsets = np.load(os.path.join(path, "offsets.npy"))
+        self.docs = np.load(os.path.join(path, "docs.npy"), mmap_mode='r')
+        self.tfs = np.load(os.path.join(path, "tfs.npy"), mmap_mode='r')
+        self.lengths = np.load(os.path.join(path, "lengths.npy"))
+
+        self.deleted = np.zeros(len(self.doc_ids), dtype=bool)
+        self.deleted[deleted] = True
+
+    def __len__(self) -> int:
+        return len(self.doc_ids)
+
+    def live_count(self) -> int:
+        return len(self.doc_ids) - int(self.deleted.sum())
+
+    def postings(self, term: str) -> tuple[np.ndarray, np.ndarray] | None:
+        i = self.term_index.get(term)
+        if i is None:
+            return None
+        start, end = self.offsets[i], self.offsets[i + 1]
+        return self.docs[start:end], self.tfs[start:end]
+
+# Write a segment from its postings as (term index, document ordinal, tf) arrays
+def write_segment(path: str, terms: list[str], term_ids: np.ndarray, docs: np.ndarray, tfs: np.ndarray,
+                  doc_ids: list[str], lengths: np.ndarray):
+    order = np.lexsort((docs, term_ids))
+    offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(term_ids, minlength=len(terms)), out=offsets[1:])
+
+    # written next to the final directory and renamed, so a segment is either complete or absent
+    tmp_path = path + ".tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    with open(os.path.join(tmp_path, "terms.txt"), 'w', encoding='utf-8') as f:
+        f.write("\n".join(terms))
+    with open(os.path.join(tmp_path, "doc_ids.txt"), 'w', encoding='utf-8') as f:
+        f.write("\n".join(doc_ids))
+    np.save(os.path.join(tmp_path, "offsets.npy"), offsets)
+    np.save(os.path.join(tmp_path, "docs.npy"), docs[order].astype(np.uint32))
+    np.save(os.path.join(tmp_path, "tfs.npy"), np.minimum(tfs[order], np.iinfo(np.uint16).max).astype(np.uint16))
+    np.save(os.path.join(tmp_path, "lengths.npy"), lengths.astype(np.uint32))
+    os.replace(tmp_path, path)
+
+# Incremental BM25 index made of immutable segments, like Lucene: every add writes a new segment,
+# deletes only mark documents in segments.json, and once merge_factor segments of about the same size
+# exist they are merged into one, which also drops the deleted documents.
+# Document frequencies count deleted documents until their segment is merged.
+class BM25Index:
+    def __init__(self, path: str, k1: float = bm25_k1, b: float = bm25_b, merge_factor: int = bm25_merge_factor):
+        self.path = path
+        self.k1 = k1
+        self.b = b
+        self.merge_factor = merge_factor
+        self.manifest_path = os.path.join(path, "segments.json")
+        self._lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+
+        manifest = {"segments": [], "next": 0}
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path, 'r') as f:
+                manifest = json.load(f)
+        self._next = manifest["next"]
+        self.segments = [Segment(os.path.join(path, entry["name"]), entry["deleted"]) for entry in manifest["segments"]]
+
+        # segments left behind by a crash before the manifest was written
+        listed = {segment.name for segment in self.segments}
+        for name in os.listdir(path):
+            if name.startswith("seg_") and name not in listed:
+                shutil.rmtree(os.path.join(path, name), ignore_errors=True)
+
+        self.live: dict[str, tuple[Segment, int]] = {}
+        for segment in self.segments:
+            for ordinal, doc_id in enumerate(segment.doc_ids):
+                if not segment.deleted[ordinal]:
+                    self.live[doc_id] = (segment, ordinal)
+        self.total_length = sum(int(segment.lengths[~segment.deleted].sum()) for segment in self.segments)
+
+    def __len__(self) -> int:
+        return len(self.live)
+
+    def _save_manifest(self):
+        write_json_atomic(self.manifest_path, {
+            "next": self._next,
+            "segments": [
+                {"name": segment.name, "deleted": np.flatnonzero(segment.deleted).tolist()}
+                for segment in self.segments
+            ],
+        })
+
+    def _new_segment_path(self) -> str:
+        self._next += 1
+        return os.path.join(self.path, f"seg_{self._next:06d}")
+
+    # Index new documents, ids that are already indexed are skipped since their content never changes
+    def add(self, doc_ids: list[str], texts: list[str]) -> None:
+        with self._lock:
+            new = {doc_id: text for doc_id, text in zip(doc_ids, texts) if doc_id not in self.live}
+            if not new:
+                return
+
+            vocabulary: dict[str, int] = {}
+            term_ids, docs, tfs, lengths = [], [], [], []
+            for ordinal, text in enumerate(new.values()):
+                tokens = tokenize(text)
+                lengths.append(len(tokens))
+                for term, tf in Counter(tokens).items():
+                    term_ids.append(vocabulary.setdefault(term, len(vocabulary)))
+                    docs.append(ordinal)
+                    tfs.append(tf)
+
+            # terms are stored sorted, so the term ids are renumbered in sorted order
+            terms = sorted(vocabulary)
+            renumber = np.empty(len(vocabulary), dtype=np.int64)
+            for i, term in enumerate(terms):
+                renumber[vocabulary[term]] = i
+
+            path = self._new_segment_path()
+            write_segment(path, terms, renumber[np.array(term_ids, dtype=np.int64)], np.array(docs, dtype=np.int64),
+                          np.array(tfs, dtype=np.int64), list(new), np.array(lengths, dtype=np.int64))
+            segment = Segment(path, [])
+            self.segments.append(segment)
+            for ordinal, doc_id in enumerate(segment.doc_ids):
+                self.live[doc_id] = (segment, ordinal)
+            self.total_length += int(segment.lengths.sum())
+
+            retired = self._merge()
+            self._save_manifest()
+            for retired_path in retired:
+                shutil.rmtree(retired_path, ignore_errors=True)
+
+    def delete(self, doc_ids: list[str]) -> None:
+        with self._lock:
+            removed = False
+            for doc_id in doc_ids:
+                found = self.live.pop(doc_id, None)
+                if found is not None:
+                    segment, ordinal = found
+                    segment.deleted[ordinal] = True
+                    self.total_length -= int(segment.lengths[ordinal])
+                    removed = True
+            if removed:
+                self._save_manifest()
+
+    # Merge the newest segments while merge_factor of them are in the same size tier,
+    # returns the directories of the merged segments, to remove once the manifest is saved
+    def _merge(self) -> list[str]:
+        def tier(segment: Segment) -> int:
+            return int(math.log(max(segment.live_count(), 1), self.merge_factor))
+
+        retired = []
+        while len(self.segments) >= self.merge_factor:
+            newest = self.segments[-self.merge_factor:]
+            if len({tier(segment) for segment in newest}) != 1:
+                break
+            merged = self._merge_segments(newest)
+            self.segments = self.segments[:-self.merge_factor] + ([merged] if merged is not None else [])
+            retired.extend(segment.path for segment in newest)
+        return retired
+
+    def _merge_segments(self, segments: list[Segment]) -> Segment | None:
+        terms = sorted(set().union(*(segment.terms for segment in segments)))
+        term_index = {term: i for i, term in enumerate(terms)}
+
+        term_ids, docs, tfs, doc_ids, lengths = [], [], [], [], []
+        for segment in segments:
+            # new ordinal of every live document of this segment, -1 for deleted ones
+            live = ~segment.deleted
+            new_ordinals = np.full(len(segment), -1, dtype=np.int64)
+            new_ordinals[live] = np.arange(int(live.sum())) + len(doc_ids)
+            doc_ids.extend(doc_id for doc_id, alive in zip(segment.doc_ids, live) if alive)
+            lengths.append(segment.lengths[live])
+
+            segment_term_ids = np.array([term_index[term] for term in segment.terms], dtype=np.int64)
+            posting_terms = np.repeat(segment_term_ids, np.diff(segment.offsets))
+            posting_docs = new_ordinals[np.asarray(segment.docs, dtype=np.int64)]
+            keep = posting_docs >= 0
+            term_ids.append(posting_terms[keep])
+            docs.append(posting_docs[keep])
+            tfs.append(np.asarray(segment.tfs, dtype=np.int64)[keep])
+
+        if not doc_ids:
+            return None
+
+        path = self._new_segment_path()
+        write_segment(path, terms, np.concatenate(term_ids), np.concatenate(docs), np.concatenate(tfs),
+                      doc_ids, np.concatenate(lengths))
+        merged = Segment(path, [])
+        for ordinal, doc_id in enumerate(merged.doc_ids):
+            self.live[doc_id] = (merged, ordinal)
+        return merged
+
+    # The k best documents for a query as (doc id, BM25 score), best first
+    def search(self, query: str, k: int) -> list[tuple[str, float]]:
+        terms = list(dict.fromkeys(tokenize(query)))
+        with self._lock:
+            if not terms or not self.live:
+                return []
+
+            count = len(self.live)
+            avg_length = self.total_length / count if self.total_length else 1.0
+            postings = {term: [segment.postings(term) for segment in self.segments] for term in terms}
+            idf = {}
+            for term, per_segment in postings.items():
+                df = sum(len(found[0]) for found in per_segment if found is not None)
+                idf[term] = math.log(1 + (count - df + 0.5) / (df + 0.5))
+
+            doc_ids, scores = [], []
+            for s, segment in enumerate(self.segments):
+                ordinals, contributions = [], []
+                for term in terms:
+                    found = postings[term][s]
+                    if found is None:
+                        continue
+                    docs, tfs = found
+                    tfs = tfs.astype(np.float32)
+                    norm = self.k1 * (1 - self.b + self.b * segment.lengths[docs] / avg_length)
+                    ordinals.append(docs)
+                    contributions.append(idf[term] * tfs * (self.k1 + 1) / (tfs + norm))
+                if not ordinals:
+                    continue
+
+                # sum the contributions of every term per document, then keep this segment's best k
+                unique, inverse = np.unique(np.concatenate(ordinals), return_inverse=True)
+                segment_scores = np.bincount(inverse, weights=np.concatenate(contributions))
+                segment_scores[segment.deleted[unique]] = -np.inf
+                best = np.argsort(-segment_scores, kind="stable")[:k]
+                for i in best:
+                    if segment_scores[i] != -np.inf:
+                        doc_ids.append(segment.doc_ids[unique[i]])
+                        scores.append(float(segment_scores[i]))
+
+        best = np.argsort(-np.array(scores), kind="stable")[:k]
+        return [(doc_ids[i], scores[i]) for i in best]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "documents": len(self.live),
+                "segments": len(self.segments),
+                "terms": sum(len(segment.terms) for segment in self.segments),
+                "bytes": sum(
+                    os.path.getsize(os.path.join(segment.path, name))
+                    for segment in self.segments for name in os.listdir(segment.path)
+                ),
+            }
@@ -0,0 +1,111 @@
+import os
+import json
+import hashlib
+
+# Hash a file in blocks so large PDFs are never read in one go
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+# The id of a chunk is the hash of its text, so the same chunk always maps to the same vector and document
+def chunk_id(text: str) -> str:
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+# Write json to a temporary file first so a crash never leaves half a file behind
+def write_json_atomic(path: str, data) -> None:
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+# Tracks which chunks every ingested file is made of.
+# files: {filename: {"sha256": file hash, "chunks": [chunk ids]}}
+# refs:  {chunk id: number of files containing it}, a chunk is only removed once nothing refers to it
+class IngestManifest:
+    def __init__(self, path: str):
+        self.path = path
+        self.files: dict[str, dict] = {}
+        self.refs: dict[str, int] = {}
+
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                data = json.load(f)
+            self.files = data.get("files", {})
+            self.refs = data.get("refs", {})
+        self.version = self._version()
+
+    def save(self):
+        write_json_atomic(self.path, {"files": self.files, "refs": self.refs})
+        self.version = self._version()
+
+    # Changes whenever a file is added, changed, renamed or removed, anything derived from the
+    # knowledge base can be keyed on it
+    def _version(self) -> str:
+        contents = sorted((filename, entry["sha256"]) for filename, entry in self.files.items())
+        return hashlib.sha256(json.dumps(contents).encode('utf-8')).hexdigest()[:16]
+
+    def file_hash(self, filename: str) -> str | None:
+        entry = self.files.get(filename)
+        return entry["sha256"] if entry else None
+
+    # Find an ingested file with the given content, used to spot renamed files
+    def find_by_hash(self, file_hash: str) -> str | None:
+        for filename, entry in self.files.items():
+            if entry["sha256"] == file_hash:
+                return filename
+        return None
+
+    def chunks_of(self, filename: str) -> list[str]:
+        return list(self.files.get(filename, {}).get("chunks", []))
+
+    def is_known(self, chunk_id: str) -> bool:
+        return self.refs.get(chunk_id, 0) > 0
+
+    # Move the entry of a file to its new name and return the chunk ids that nothing refers to anymore:
+    # an entry already under the new name is replaced, and its chunks are released like in commit
+    def rename(self, old_filename: str, new_filename: str) -> list[str]:
+        replaced = self.files.pop(new_filename, None)
+        orphaned = self._release(set(replaced["chunks"])) if replaced is not None else []
+
+        self.files[new_filename] = self.files.pop(old_filename)
+        self.save()
+        return orphaned
+
+    # Record the chunks of a file and return the chunk ids that nothing refers to anymore
+    def commit(self, filename: str, file_hash: str, chunk_ids: list[str]) -> list[str]:
+        old_ids = set(self.files.get(filename, {}).get("chunks", []))
+        new_ids = set(chunk_ids)
+
+        for cid in new_ids - old_ids:
+            self.refs[cid] = self.refs.get(cid, 0) + 1
+        orphaned = self._release(old_ids - new_ids)
+
+        self.files[filename] = {"sha256": file_hash, "chunks": list(dict.fromkeys(chunk_ids))}
+        self.save()
+        return orphaned
+
+    # Forget a file and return the chunk ids that nothing refers to anymore
+    def remove(self, filename: str) -> list[str]:
+        entry = self.files.pop(filename, None)
+        if entry is None:
+            return []
+
+        orphaned = self._release(set(entry["chunks"]))
+        self.save()
+        return orphaned
+
+    def _release(self, chunk_ids) -> list[str]:
+        orphaned = []
+        for cid in chunk_ids:
+            count = self.refs.get(cid, 0) - 1
+            if count > 0:
+                self.refs[cid] = count
+            else:
+                self.refs.pop(cid, None)
+                orphaned.append(cid)
+        return orphaned
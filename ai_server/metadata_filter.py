@@ -0,0 +1,86 @@
+from datetime import datetime
+from typing import Any
+from pydantic import BaseModel
+
+# Metadata filter of a retrieval request. Every field that is set must match, sources and types match any
+# of their values. The date range is checked against the added_at timestamp every vector gets on ingest,
+# vectors ingested before it existed have none and never match a date range.
+class RetrievalFilter(BaseModel):
+    sources: list[str] | None = None
+    types: list[str] | None = None
+    added_after: datetime | None = None
+    added_before: datetime | None = None
+
+    # The filter as a Chroma where clause, None if it filters nothing
+    def where(self) -> dict | None:
+        clauses = []
+        if self.sources:
+            clauses.append({"source": {"$in": self.sources}})
+        if self.types:
+            clauses.append({"type": {"$in": self.types}})
+        if self.added_after is not None:
+            clauses.append({"added_at": {"$gte": self.added_after.timestamp()}})
+        if self.added_before is not None:
+            clauses.append({"added_at": {"$lte": self.added_before.timestamp()}})
+
+        if not clauses:
+            return None
+        return clauses[0] if len(clauses) == 1 else {"$and": clauses}
+
+_COMPARISONS = {
+    "$eq": lambda value, operand: value == operand,
+    "$ne": lambda value, operand: value != operand,
+    "$gt": lambda value, operand: value is not None and value > operand,
+    "$gte": lambda value, operand: value is not None and value >= operand,
+    "$lt": lambda value, operand: value is not None and value < operand,
+    "$lte": lambda value, operand: value is not None and value <= operand,
+    "$in": lambda value, operand: value in operand,
+    "$nin": lambda value, operand: value not in operand,
+}
+
+# Evaluate a Chroma where clause against the metadata of one document, for stores without a query engine
+def matches_where(metadata: dict, where: dict | None) -> bool:
+    if not where:
+        return True
+
+    for key, condition in where.items():
+        if key == "$and":
+            if not all(matches_where(metadata, clause) for clause in condition):
+                return False
+        elif key == "$or":
+            if not any(matches_where(metadata, clause) for clause in condition):
+                return False
+        elif isinstance(condition, dict):
+            value = metadata.get(key)
+            if not all(_COMPARISONS[operator](value, operand) for operator, operand in condition.items()):
+                return False
+        elif metadata.get(key) != condition:
+            return False
+    return True
+
+# The values a where clause allows for key, None if it allows any. Only equality and $in on the top
+# level or inside $and narrow it down, which is enough to pick the partitions a query has to search.
+def allowed_values(where: dict | None, key: str) -> set[Any] | None:
+    if not where:
+        return None
+
+    allowed = None
+    clauses = where.get("$and", []) + [{k: v} for k, v in where.items() if k != "$and"]
+    for clause in clauses:
+        for clause_key, condition in clause.items():
+            if clause_key == "$and":
+                values = allowed_values(clause, key)
+            elif clause_key != key:
+                continue
+            elif isinstance(condition, dict) and "$in" in condition:
+                values = set(condition["$in"])
+            elif isinstance(condition, dict) and "$eq" in condition:
+                values = {condition["$eq"]}
+            elif not isinstance(condition, dict):
+                values = {condition}
+            else:
+                continue
+
+            if values is not None:
+                allowed = values if allowed is None else allowed & values
+    return allowed
@@ -5,3 +5,8 @@ snapshot_download(
         local_dir="./models/Salesforce/blip2-opt-2.7b",
         )
 
+
+snapshot_download(
+        repo_id="cross-encoder/ms-marco-MiniLM-L-6-v2",
+        local_dir="./models/cross-encoder/ms-marco-MiniLM-L-6-v2",
+        )
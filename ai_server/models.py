@@ -1,3 +1,4 @@
+import os
 import torch 
 from transformers import AutoModelForCausalLM, AutoTokenizer, pipeline, AutoModelForSeq2SeqLM
 from langchain_huggingface import HuggingFacePipeline
@@ -7,12 +8,23 @@ from langchain_huggingface import HuggingFaceEmbeddings
 
 base_model_path = "./models/"
 chat_pipeline = None
+# Largest number of prompts the chat pipeline generates in one forward pass
+generation_batch_size = int(os.getenv("BATCH_MAX_SIZE", "8"))
+# Deterministic stand-ins from fake_models.py instead of the real models, no weights or CUDA needed
+fake_models_enabled = os.getenv("FAKE_MODELS", "false") == "true"
+# Fake summaries and vectors are kept in a data directory of their own, so a real run never reads them
+processed_dir_name = "processed_fake" if fake_models_enabled else "processed"
 
 def init_chat_model():
-    global device, chat_pipeline,base_model_path
+    global device, chat_pipeline,base_model_path, generation_batch_size
     if chat_pipeline is not None:
         return chat_pipeline
 
+    if fake_models_enabled:
+        from fake_models import FakeTextPipeline
+        chat_pipeline = HuggingFacePipeline(pipeline=FakeTextPipeline("text-generation"), batch_size=generation_batch_size)
+        return chat_pipeline
+
     model_path = base_model_path + "TinyLlama/TinyLlama-1.1B-Chat-v1.0"
 
     model = AutoModelForCausalLM.from_pretrained(
@@ -21,6 +33,9 @@ def init_chat_model():
             device_map="cuda"
             )
     tokenizer = AutoTokenizer.from_pretrained(model_path, padding_side="left", truncation=True)
+    # batched prompts are left padded, which needs a pad token
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
 
     pipe = pipeline(
             "text-generation",
@@ -28,18 +43,46 @@ def init_chat_model():
             tokenizer=tokenizer,
             eos_token_id=tokenizer.eos_token_id
             )
-    chat_pipeline = HuggingFacePipeline(pipeline=pipe)
+    chat_pipeline = HuggingFacePipeline(pipeline=pipe, batch_size=generation_batch_size)
     return chat_pipeline
 
+# Count tokens the way the chat model does, used to keep the prompt inside its budget
+def get_chat_token_counter():
+    tokenizer = init_chat_model().pipeline.tokenizer
+    return lambda text: len(tokenizer.encode(text, add_special_tokens=False))
+
 # Initialize the embeddings model
 def init_embeddings():
     global base_model_path
+    if fake_models_enabled:
+        from fake_models import FakeEmbeddings
+        return FakeEmbeddings()
     return HuggingFaceEmbeddings(model_name=base_model_path + "sentence-transformers/all-MiniLM-L6-v2", model_kwargs={"device": "cuda"})
 
+# Initialize the cross-encoder that reranks retrieved chunks, small enough to run on the cpu
+def init_reranker_model():
+    global base_model_path
+    if fake_models_enabled:
+        from fake_models import FakeCrossEncoder
+        return FakeCrossEncoder()
+    from sentence_transformers import CrossEncoder
+    return CrossEncoder(base_model_path + "cross-encoder/ms-marco-MiniLM-L-6-v2", device="cpu")
+
+# The summary model and prompt, together they decide which cached summaries are still valid
+summary_model_id = "fake/t5-small" if fake_models_enabled else "google-t5/t5-small"
+summary_prompt_text = """You are an assistant with diabetes medical expertise tasked with summarizing tables and text. 
+    Give a concise summary of the table or text. Table or text chunk: {element}"""
+
 # Create a chain for summarizing text
 def get_text_summary_chain():
-    global base_model_path
-    model_path = "google-t5/t5-small"
+    global base_model_path, summary_model_id, summary_prompt_text
+    model_path = summary_model_id
+    prompt = ChatPromptTemplate.from_template(summary_prompt_text)
+
+    if fake_models_enabled:
+        from fake_models import FakeTextPipeline
+        pipe = HuggingFacePipeline(pipeline=FakeTextPipeline("summarization"))
+        return {"element": lambda x: x} | prompt | pipe | StrOutputParser()
 
     model = AutoModelForSeq2SeqLM.from_pretrained(
         base_model_path + model_path, 
@@ -51,9 +94,4 @@ def get_text_summary_chain():
 
     pipe = pipeline("summarization", model=model, tokenizer=tokenizer)
     pipe = HuggingFacePipeline(pipeline=pipe)
-
-    prompt_text = """You are an assistant with diabetes medical expertise tasked with summarizing tables and text. 
-    Give a concise summary of the table or text. Table or text chunk: {element}"""
-
-    prompt = ChatPromptTemplate.from_template(prompt_text)
     return {"element": lambda x: x} | prompt | pipe | StrOutputParser()
@@ -1,22 +1,26 @@
 import os
-import uuid
 import json
-import pickle
-import pymupdf
 from pathlib import Path
 from datetime import datetime
-from typing import Any, Dict
+from typing import Any, Dict, Iterator
 from pydantic import BaseModel
-from pdf_extraction import extract_text
+from docstore import SQLiteDocStore
+from ingest_pipeline import IngestPipeline
+from manifest import IngestManifest, file_sha256, chunk_id, write_json_atomic
 from langchain.retrievers.multi_vector import MultiVectorRetriever
-from langchain.storage import InMemoryStore
-from langchain_chroma import Chroma
 from langchain_core.documents import Document
-from langchain_core.runnables import RunnablePassthrough
+from langchain_core.runnables import RunnablePassthrough, RunnableLambda
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.output_parsers import StrOutputParser
 
-from models import init_embeddings, init_chat_model, get_text_summary_chain
+from models import init_embeddings, init_chat_model, init_reranker_model, get_chat_token_counter, get_text_summary_chain, summary_model_id, summary_prompt_text, processed_dir_name
+from summary_cache import SummaryCache
+from vector_store import open_vectorstore
+from lexical_index import BM25Index
+from hybrid_retriever import HybridRetriever, retrieval_mode, retrieval_k
+from reranker import CrossEncoderReranker, rerank_enabled, rerank_candidates
+from context_packer import ContextPacker
+from metadata_filter import RetrievalFilter
 
 class Element(BaseModel):
     type: str
@@ -31,52 +35,77 @@ class DiabetesKnowledgeBase:
         Path(self.image_dir).mkdir(parents=True, exist_ok=True)
 
         # Create a directory to store processed data
-        self.processed_dir = os.path.join(self.data_dir, "processed")
+        self.processed_dir = os.path.join(self.data_dir, processed_dir_name)
         Path(self.processed_dir).mkdir(parents=True, exist_ok=True)
 
-        # Create a file to track processed PDFs and their timestamps
+        # Track the content hash and chunks of every ingested PDF
+        self.manifest = IngestManifest(os.path.join(self.processed_dir, "ingest_manifest.json"))
+
+        # Old log of PDFs keyed by modification time, only kept to clean up files ingested before the manifest
         self.processed_log_path = os.path.join(self.processed_dir, "processed_files.json")
         self.processed_files = self._load_processed_files()
 
-        # Create a path for the persisted vector store
-        self.vectorstore_path = os.path.join(self.processed_dir, "chroma_db")
-        self.docstore_path = os.path.join(self.processed_dir, "docstore.pkl")
+        # Create a path for the persisted docstore
+        self.docstore_path = os.path.join(self.processed_dir, "docstore.sqlite")
+        self.legacy_docstore_path = os.path.join(self.processed_dir, "docstore.pkl")
 
         # Initialize components
         self.embeddings = init_embeddings()
         self.chat_model = init_chat_model()
         self.summary_chain = get_text_summary_chain()
-        
-        # Initialze the retriever system
-        self.vectorstore = Chroma(
-            collection_name="diabetes_kb",
-            embedding_function=self.embeddings,
-            persist_directory=self.vectorstore_path
+        self.summary_cache = SummaryCache(
+            os.path.join(self.processed_dir, "summary_cache.sqlite"), summary_model_id, summary_prompt_text
         )
+        
+        # Initialze the retriever system, the vector store is Chroma or the local ANN index (VECTOR_BACKEND)
+        self.vectorstore = open_vectorstore(self.embeddings, self.processed_dir)
 
-        # Load docstore if it exists, otherwise create new one
-        if os.path.exists(self.docstore_path):
-            with open(self.docstore_path, 'rb') as f:
-                self.store = pickle.load(f)
-            
-            # Get document count using the yield_keys method
-            try:
-                doc_count = sum(1 for _ in self.store.yield_keys())
-                print(f"Loaded existing docstore with {doc_count} documents.")
-            except Exception as e:
-                print(f"Loaded existing docstore. Unable to count documents: {str(e)}")
-        else:
-            self.store = InMemoryStore()
-            print("Created new docstore!")
+        # Open the docstore, documents are only read from disk when the retriever asks for them
+        self.store = SQLiteDocStore(self.docstore_path)
+
+        # Move an old pickled docstore over the first time, the import is one transaction so a crash just retries it
+        if self.store.count() == 0 and os.path.exists(self.legacy_docstore_path):
+            imported = self.store.import_pickle(self.legacy_docstore_path)
+            print(f"Imported {imported} documents from {self.legacy_docstore_path}.")
+
+        print(f"Opened docstore with {self.store.count()} documents.")
         
-       
         self.id_key = "doc_id"
+
+        # BM25 over the parent chunks, kept next to the vector store so exact terms can be found
+        self.lexical_index = BM25Index(os.path.join(self.processed_dir, "bm25_index"))
+
+        # Undo whatever a killed ingest left half written
+        self.journal_path = os.path.join(self.processed_dir, "ingest_journal.json")
+        self._recover_ingest()
+
+        # Index the chunks ingested before there was a lexical index
+        if len(self.lexical_index) == 0 and self.store.count() > 0:
+            self._build_lexical_index()
         
-        self.retriever = MultiVectorRetriever(
-            vectorstore=self.vectorstore,
-            docstore=self.store,
-            id_key=self.id_key
-        )
+        # With reranking the retriever fetches more candidates and the reranker keeps the best few
+        self.reranker = None
+        candidates = retrieval_k
+        if rerank_enabled:
+            model = init_reranker_model()
+            self.reranker = CrossEncoderReranker(lambda pairs: model.predict(pairs, batch_size=32))
+            candidates = rerank_candidates
+
+        if retrieval_mode == "hybrid":
+            self.retriever = HybridRetriever(
+                vectorstore=self.vectorstore,
+                docstore=self.store,
+                lexical_index=self.lexical_index,
+                id_key=self.id_key,
+                k=candidates
+            )
+        else:
+            self.retriever = MultiVectorRetriever(
+                vectorstore=self.vectorstore,
+                docstore=self.store,
+                id_key=self.id_key,
+                search_kwargs={"k": candidates}
+            )
         
         # Initialize RAG chain
         template = """<|system|> You are a medical assistant specialized in diabetes. Answer only using the provided context.
@@ -91,11 +120,33 @@ class DiabetesKnowledgeBase:
         <|assistant|>
         """ 
         self.prompt = ChatPromptTemplate.from_template(template)
+
+        # The retrieved chunks are packed into a fixed token budget of the chat model
+        self.context_packer = ContextPacker(get_chat_token_counter())
         
-        self.init_chain = (
-            {"context": self.retriever, "question": RunnablePassthrough()} | self.prompt | self.chat_model | StrOutputParser()
+        self.init_chain = self._build_chain(self.retriever)
+
+    def _build_chain(self, retriever):
+        return (
+            {"context": retriever, "question": RunnablePassthrough()}
+            | RunnableLambda(self._rerank_context)
+            | RunnableLambda(self._pack_context)
+            | self.prompt | self.chat_model | StrOutputParser()
         )
 
+    # The retriever restricted to the chunks whose vectors match the filter
+    def _retriever_for(self, filters: RetrievalFilter | None):
+        where = filters.where() if filters is not None else None
+        if where is None:
+            return self.retriever
+        if isinstance(self.retriever, HybridRetriever):
+            return self.retriever.model_copy(update={"filter": where})
+        return self.retriever.model_copy(update={"search_kwargs": {**self.retriever.search_kwargs, "filter": where}})
+
+    def _chain_for(self, filters: RetrievalFilter | None):
+        retriever = self._retriever_for(filters)
+        return self.init_chain if retriever is self.retriever else self._build_chain(retriever)
+
     # Load the log of processed files
     def _load_processed_files(self) -> Dict[str, str]:
         if os.path.exists(self.processed_log_path):
@@ -109,69 +160,168 @@ class DiabetesKnowledgeBase:
         with open(self.processed_log_path, 'w') as f:
             json.dump(self.processed_files, f)
 
-    # Save the docstore to disk
+    # The docstore commits every write itself, this only reports its size
     def _persist_docstore(self):
+        print(f"Persisted docstore with {self.store.count()} documents.")
 
-        with open(self.docstore_path, 'wb') as f:
-            pickle.dump(self.store, f)
-        
-        # Get document count using the yield_keys method
-        try:
-            doc_count = sum(1 for _ in self.store.yield_keys())
-            print(f"Persisted docstore with {doc_count} documents.")
-        except Exception as e:
-            print(f"Persisted docstore. Unable to count documents: {str(e)}")
+    # Check if the content of the file has already been processed
+    def _needs_processing(self, pdf_path: str) -> bool:
+        filename = os.path.basename(pdf_path)
+        file_hash = file_sha256(pdf_path)
 
-    # Process a PDF file, extract text
-    def process_pdf(self, pdf_path: str) -> None:
+        if self.manifest.file_hash(filename) == file_hash:
+            print(f"Skipping {filename} - already processed!")
+            return False
+
+        # The same content under a name that is gone from disk means the file was renamed
+        old_filename = self.manifest.find_by_hash(file_hash)
+        if old_filename is not None and not os.path.exists(os.path.join(self.data_dir, old_filename)):
+            # the chunks of a file the renamed one replaced are dropped, under the journal like any other removal
+            self._write_journal(filename, [], self.manifest.chunks_of(filename))
+            self._delete_chunks(self.manifest.rename(old_filename, filename), filename)
+            self._clear_journal()
+            if filename in self.processed_files:
+                self._purge_legacy_file(filename)
+            print(f"Skipping {filename} - renamed from {old_filename}, reusing its chunks")
+            return False
+
+        return True
 
-        # Check if the file has already been processed and hasn't changed
+    # Write the new chunks of a file to the docstore and vector store and record them in the manifest.
+    # The manifest save is the commit point: the journal written first lists every id that may be
+    # touched, so after a crash on either side of it _recover_ingest can drop what nothing refers to.
+    # A file ingested before the manifest keeps its legacy vectors until the new version is committed.
+    def _commit_file(self, pdf_path: str, file_hash: str, chunk_ids: list[str], new_ids: list[str],
+                     chunks: list[str], summaries: list[str], batch_size: int):
         filename = os.path.basename(pdf_path)
-        file_mtime = str(os.path.getmtime(pdf_path))
+        legacy = self._legacy_ids(filename) if filename in self.processed_files else None
+        self._write_journal(filename, new_ids, self.manifest.chunks_of(filename), legacy)
 
-        if filename in self.processed_files and self.processed_files[filename] == file_mtime:
-            print(f"Skipping {filename} - already processed!")
-            return 
+        for i in range(0, len(chunks), batch_size):
+            batch = slice(i, i + batch_size)
+            self._add_to_retriever(chunks[batch], summaries[batch], "text", filename, doc_ids=new_ids[batch])
 
-        print(f"Processing {pdf_path}...")
-        doc = pymupdf.open(self.data_dir + filename)
-        text_chunks = extract_text(doc, max_length=2000)
-        
-        # Process text elements
-        print(f"Summarizing {len(text_chunks)} text chunks...")
-        text_summaries = self.summary_chain.batch(text_chunks, {"max_concurrent": 12})
+        orphaned = self.manifest.commit(filename, file_hash, chunk_ids)
+        self._delete_chunks(orphaned, filename)
+        if legacy is not None:
+            self._purge_legacy_file(filename, *legacy)
+        self._clear_journal()
+        self._persist_docstore()
 
-        # Save the interim results to prevent data loss in case of interruption
-        interim_results_dir = os.path.join(self.processed_dir, f"{filename}_interim")
-        Path(interim_results_dir).mkdir(parents=True, exist_ok=True)
+    # Forget PDFs that were deleted from the data directory
+    def _remove_missing_files(self):
+        for filename in list(self.manifest.files):
+            if not os.path.exists(os.path.join(self.data_dir, filename)):
+                self._write_journal(filename, [], self.manifest.chunks_of(filename))
+                self._delete_chunks(self.manifest.remove(filename), filename)
+                self._clear_journal()
 
-        with open(os.path.join(interim_results_dir, "text_summaries.pkl"), 'wb') as f:
-            pickle.dump(text_summaries, f)
-        
-        # Add to retriever (only if there are items to add)
-        if text_chunks and text_summaries:
-            self._add_to_retriever(text_chunks, text_summaries, "text", filename)
+        for filename in list(self.processed_files):
+            if not os.path.exists(os.path.join(self.data_dir, filename)):
+                self._purge_legacy_file(filename)
+
+    def _delete_chunks(self, doc_ids: list[str], source_file: str):
+        if not doc_ids:
+            return
+
+        self.vectorstore.delete(ids=doc_ids)
+        self.store.mdelete(doc_ids)
+        self.lexical_index.delete(doc_ids)
+        print(f"Removed {len(doc_ids)} chunks no longer in {source_file}")
+
+    def _build_lexical_index(self, batch_size: int = 10000):
+        doc_ids = list(self.store.yield_keys())
+        for i in range(0, len(doc_ids), batch_size):
+            batch = doc_ids[i:i + batch_size]
+            contents = self.store.mget(batch)
+            self.lexical_index.add([doc_id for doc_id, content in zip(batch, contents) if content is not None],
+                                   [content for content in contents if content is not None])
+        print(f"Built lexical index over {len(self.lexical_index)} chunks.")
+
+    def _write_journal(self, filename: str, added: list[str], previous: list[str],
+                       legacy: tuple[list[str], list[str]] | None = None):
+        journal = {"file": filename, "added": added, "previous": previous}
+        if legacy is not None:
+            journal["legacy"] = {"vectors": legacy[0], "documents": legacy[1]}
+        write_json_atomic(self.journal_path, journal)
+
+    def _clear_journal(self):
+        if os.path.exists(self.journal_path):
+            os.remove(self.journal_path)
+
+    # Finish or roll back an ingest that was killed halfway. Before the manifest commit the added chunks
+    # are unreferenced and get removed, after it the replaced ones are, either way the retriever ends up
+    # matching the manifest. The file itself is simply ingested again, its summaries come from the cache.
+    def _recover_ingest(self):
+        if not os.path.exists(self.journal_path):
+            return
+
+        with open(self.journal_path, 'r') as f:
+            journal = json.load(f)
+
+        candidates = dict.fromkeys(journal["added"] + journal["previous"])
+        unreferenced = [cid for cid in candidates if not self.manifest.is_known(cid)]
+        print(f"Recovering interrupted ingest of {journal['file']}")
+        self._delete_chunks(unreferenced, journal["file"])
+        # legacy vectors only go once the new version of the file was committed
+        legacy = journal.get("legacy")
+        if legacy is not None and self.manifest.file_hash(journal["file"]) is not None:
+            self._purge_legacy_file(journal["file"], legacy["vectors"], legacy["documents"])
+        self._clear_journal()
+
+    # Files ingested before the manifest have random ids, so their vectors are found by source instead.
+    # Returns the ids of the vectors and of their documents, chunks the manifest refers to are left out.
+    def _legacy_ids(self, filename: str) -> tuple[list[str], list[str]]:
+        legacy = self.vectorstore.get(where={"source": filename}, include=["metadatas"])
+        vector_ids, doc_ids = [], []
+        for vector_id, metadata in zip(legacy["ids"], legacy["metadatas"]):
+            doc_id = (metadata or {}).get(self.id_key)
+            if doc_id is not None and self.manifest.is_known(doc_id):
+                continue
+            vector_ids.append(vector_id)
+            if doc_id is not None:
+                doc_ids.append(doc_id)
+        return vector_ids, doc_ids
+
+    def _purge_legacy_file(self, filename: str, vector_ids: list[str] | None = None, doc_ids: list[str] | None = None):
+        if vector_ids is None:
+            vector_ids, doc_ids = self._legacy_ids(filename)
+
+        if vector_ids:
+            self.vectorstore.delete(ids=vector_ids)
+        if doc_ids:
+            self.store.mdelete(doc_ids)
+            self.lexical_index.delete(doc_ids)
 
-        # Mark as processed
-        self.processed_files[filename] = file_mtime
+        self.processed_files.pop(filename, None)
         self._save_processed_files()
-        
-        # Persist the vectorstore
-        self._persist_docstore()
+        print(f"Removed {len(vector_ids)} legacy vectors of {filename}")
+
+    # Process a PDF file, extract text
+    def process_pdf(self, pdf_path: str) -> dict:
+        return self.process_pdfs([pdf_path])
 
-        # Clean up interim files
-        if os.path.exists(interim_results_dir):
-            import shutil
-            shutil.rmtree(interim_results_dir)
+    # Run the PDFs that changed through the staged ingest pipeline
+    def process_pdfs(self, pdf_paths: list[str]) -> dict:
+        pdf_paths = [pdf_path for pdf_path in pdf_paths if self._needs_processing(pdf_path)]
+        if not pdf_paths:
+            return {}
+
+        print(f"Processing {len(pdf_paths)} PDFs...")
+        return IngestPipeline(self).run(pdf_paths)
 
     # Add contents and their summaries to the retriever
-    def _add_to_retriever(self, contents, summaries, content_type, source_file):
+    def _add_to_retriever(self, contents, summaries, content_type, source_file, doc_ids=None):
         # Skip if there's nothing to add
         if not contents or not summaries:
             print(f"No {content_type} content to add for {source_file} - skipping")
             return
         
-        doc_ids = [str(uuid.uuid4()) for _ in contents]
+        # Vectors and documents share the chunk hash as id so they can be found again on re-ingest
+        if doc_ids is None:
+            doc_ids = [chunk_id(content) for content in contents]
+        # added_at is the same moment as a number, Chroma can only filter ranges of numbers
+        added = datetime.now()
         summary_docs = [
             Document(
                 page_content=s, 
@@ -179,28 +329,68 @@ class DiabetesKnowledgeBase:
                     self.id_key: doc_ids[i], 
                     "type": content_type,
                     "source": source_file,
-                    "date_added": datetime.now().isoformat()
+                    "date_added": added.isoformat(),
+                    "added_at": added.timestamp()
                 }
             )
             for i, s in enumerate(summaries)
         ]
-        self.vectorstore.add_documents(summary_docs, embeddings=self.embeddings)
+        self.vectorstore.add_documents(summary_docs, ids=doc_ids)
         self.store.mset(list(zip(doc_ids, contents)))
+        self.lexical_index.add(doc_ids, contents)
         print(f"Added {len(summary_docs)} {content_type} documents from {source_file}")
         
     # Process all PDFs in the data directory
-    def process_all_pdfs(self):
+    def process_all_pdfs(self) -> dict:
         pdf_files = [f for f in os.listdir(self.data_dir) if f.lower().endswith('.pdf')]
-        for pdf_file in pdf_files:
-            pdf_path = os.path.join(self.data_dir, pdf_file)
-            self.process_pdf(pdf_path)
+        metrics = self.process_pdfs([os.path.join(self.data_dir, pdf_file) for pdf_file in pdf_files])
+
+        # Only now, so renames are detected and chunks moved to another file are not deleted and summarized again
+        self._remove_missing_files()
+        return metrics
             
-    # Answer a question using the RAG pipeline
-    def answer_question(self, question: str) -> str:
-        response = self.init_chain.invoke(question)
-            # Extract the answer part
+    # Version of the ingested content, changes with every ingest that adds, changes or removes a file
+    @property
+    def version(self) -> str:
+        return self.manifest.version
+
+    # Keep only the retrieved chunks the cross-encoder ranks highest, when reranking is on
+    def _rerank_context(self, inputs: dict) -> dict:
+        if self.reranker is None:
+            return inputs
+        return {**inputs, "context": self.reranker.rerank(inputs["question"], inputs["context"])}
+
+    # Fill the context with the best chunks that fit the token budget
+    def _pack_context(self, inputs: dict) -> dict:
+        # the chunks and tokens of every request add up in the packer's counters, see /stats
+        context, _ = self.context_packer.pack(inputs["context"])
+        return {**inputs, "context": context}
+
+    # The chunks retrieved for a question, before reranking and packing
+    def retrieve(self, question: str, filters: RetrievalFilter | None = None) -> list[str]:
+        return self._retriever_for(filters).invoke(question)
+
+    # Answer a question using the RAG pipeline, optionally only from the chunks matching filters
+    def answer_question(self, question: str, filters: RetrievalFilter | None = None) -> str:
+        response = self._chain_for(filters).invoke(question)
+        return self._extract_answer(response)
+
+    # Answer several questions at once, retrieval and generation run as one batch
+    def answer_questions(self, questions: list[str]) -> list[str]:
+        responses = self.init_chain.batch(questions)
+        return [self._extract_answer(response) for response in responses]
+
+    # Extract the answer part of the generated text
+    def _extract_answer(self, response: str) -> str:
         answer_start = response.find("<|assistant|>")
         if answer_start != -1:
             return response[answer_start + len("<|assistant|>"):].strip()
         
         return response.strip()  # If "Answer:" isn't found, return full response
+
+    # Stream the answer token by token using the RAG pipeline
+    def stream_answer(self, question: str, filters: RetrievalFilter | None = None) -> Iterator[str]:
+        # The streaming pipeline only yields newly generated tokens, so the prompt never needs stripping here
+        for token in self._chain_for(filters).stream(question):
+            if token:
+                yield token
@@ -0,0 +1,63 @@
+import os
+import sys
+import json
+import pymupdf
+from typing import Iterator
+from manifest import file_sha256
+from pdf_extraction import iter_text_chunks
+
+# Parse worker of the ingest pipeline. ingest_pipeline.ParseWorker starts it as its own interpreter,
+# so it only ever imports pymupdf, pdf_extraction and manifest, never app.py and the models. Every line on stdin
+# asks to parse one PDF. It is answered by lines of chunks, a batch at a time, then one line with the
+# hash, or with the error if parsing failed.
+
+# Chunks sent per line, so a large PDF is never held whole in the worker nor written as one line
+_BATCH_SIZE = 256
+
+# Size and modification time, they change when the file is written
+def _file_state(path: str) -> tuple[int, int]:
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime_ns
+
+# The text chunks of one PDF in batches. MuPDF reads the file as it goes, the page being parsed is
+# all of the document in memory.
+def parse_pdf(pdf_path: str, max_length: int, overlap: int = 0, boundary: str = "line",
+              batch_size: int = _BATCH_SIZE) -> Iterator[list[str]]:
+    doc = pymupdf.open(pdf_path, filetype="pdf")
+    try:
+        batch = []
+        for chunk in iter_text_chunks(doc, max_length=max_length, overlap=overlap, boundary=boundary):
+            batch.append(chunk)
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+    finally:
+        doc.close()
+
+def main():
+    # answers get stdout to themselves, anything else printed, by MuPDF too, goes to stderr
+    answers = os.fdopen(os.dup(sys.stdout.fileno()), 'w', encoding='utf-8')
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+
+    for line in sys.stdin:
+        request = json.loads(line)
+        try:
+            # the hash and the parse read the file separately, they only match if it did not change in between.
+            # It is the manifest's own hash, so the manifest recognizes the file when it comes again
+            before = _file_state(request["pdf_path"])
+            pdf_hash = file_sha256(request["pdf_path"])
+            for batch in parse_pdf(**request):
+                answers.write(json.dumps({"chunks": batch}) + "\n")
+                answers.flush()
+            if _file_state(request["pdf_path"]) != before:
+                raise RuntimeError("the file changed while it was parsed")
+            answer = {"hash": pdf_hash}
+        except Exception as e:
+            answer = {"error": f"{type(e).__name__}: {e}"}
+        answers.write(json.dumps(answer) + "\n")
+        answers.flush()
+
+if __name__ == "__main__":
+    main()
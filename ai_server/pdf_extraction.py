@@ -1,29 +1,118 @@
 import os
 import pymupdf
 import re
+from typing import Callable, Iterable, Iterator
 
 dimlimit = 100  # 100  # each image side must be greater than this
 relsize = 0  # 0.05  # image : image size ratio must be larger than this (5%)
 abssize = 2048  # 2048  # absolute image size limit 2 KB: ignore if smaller
 imgdir = "./data/extracted_images/"  # found images are stored in this subfolder
 
-def extract_text(doc: pymupdf.Document, max_length=300) -> list[str]:
-    chunks = []
-    all_text = chr(12).join([page.get_text() for page in doc])
-    sentences = re.split(r'\n', all_text)  # Split on empty lines (paragraphs)
-    current_chunk = ""
-
-    for sentence in sentences:
-        if len(current_chunk) + len(sentence) <= max_length:
-            current_chunk += sentence + "\n"
-        else:
-            chunks.append(current_chunk.strip())
-            current_chunk = sentence + "\n"
-
-    if current_chunk:
-        chunks.append(current_chunk.strip())
-
-    return chunks
+_SENTENCE_END = re.compile(r"(?<=[.!?])\s+")
+
+# Lines of the document one page at a time, only the current page's text is held in memory.
+# A line cut by a page break is carried over and joined with a form feed, as if the pages were one text.
+def iter_lines(doc: pymupdf.Document) -> Iterator[str]:
+    tail = None
+    for page in doc:
+        text = page.get_text()
+        if tail is not None:
+            text = tail + chr(12) + text
+        lines = text.split("\n")
+        tail = lines.pop()
+        yield from lines
+    if tail is not None:
+        yield tail
+
+# Sentences of a stream of lines, lines wrapped inside a sentence are joined with a space and
+# empty lines end a paragraph, and so the sentence before them
+def iter_sentences(lines: Iterable[str]) -> Iterator[str]:
+    pending = []
+    for line in lines:
+        line = line.strip()
+        if not line:
+            if pending:
+                yield " ".join(pending)
+                pending = []
+            continue
+
+        parts = _SENTENCE_END.split(line)
+        for part in parts[:-1]:
+            pending.append(part)
+            yield " ".join(pending)
+            pending = []
+        pending.append(parts[-1])
+        if parts[-1].endswith((".", "!", "?")):
+            yield " ".join(pending)
+            pending = []
+
+    if pending:
+        yield " ".join(pending)
+
+# Cut a unit longer than max_length between words, so no chunk ever ends inside a word
+def _split_words(unit: str, max_length: int, length_function: Callable[[str], int]) -> Iterator[str]:
+    words = []
+    size = 0
+    for word in unit.split():
+        word_size = length_function(word)
+        if words and size + word_size > max_length:
+            yield " ".join(words)
+            words = []
+            size = 0
+        words.append(word)
+        size += word_size + 1
+    if words:
+        yield " ".join(words)
+
+# Chunks of at most max_length, built page by page so memory stays flat however long the document is.
+# boundary "line" cuts between lines of the PDF, "sentence" between sentences and cuts sentences that
+# are too long between words. Lengths are counted by length_function, characters by default, a tokenizer's
+# counter makes them token budgets. The last units of a chunk, up to overlap, also start the next one.
+def iter_text_chunks(doc: pymupdf.Document, max_length=300, overlap=0, boundary="line",
+                     length_function: Callable[[str], int] = len) -> Iterator[str]:
+    if boundary == "sentence":
+        units = (piece for sentence in iter_sentences(iter_lines(doc))
+                 for piece in _split_words(sentence, max_length, length_function))
+        separator = " "
+    elif boundary == "line":
+        units = iter_lines(doc)
+        separator = "\n"
+    else:
+        raise ValueError(f"Unknown chunk boundary: {boundary}")
+
+    buffer = []  # (unit, size with its separator) of the chunk being built
+    size = 0
+    for unit in units:
+        unit_size = length_function(unit)
+        if buffer and size + unit_size > max_length:
+            chunk = separator.join(part for part, _ in buffer).strip()
+            if chunk:
+                yield chunk
+
+            # carry the tail of the chunk over, as long as the next unit still fits after it
+            carried = []
+            carried_size = 0
+            for part, part_size in reversed(buffer):
+                if carried_size + part_size > overlap:
+                    break
+                carried.insert(0, (part, part_size))
+                carried_size += part_size
+            while carried and carried_size + unit_size > max_length:
+                carried_size -= carried.pop(0)[1]
+            buffer = carried
+            size = carried_size
+
+        buffer.append((unit, unit_size + 1))
+        size += unit_size + 1
+
+    chunk = separator.join(part for part, _ in buffer).strip()
+    if chunk:
+        yield chunk
+
+# All chunks of the document, with the defaults these are the chunks ingested before chunking was streamed
+def extract_text(doc: pymupdf.Document, max_length=300, overlap=0, boundary="line",
+                 length_function: Callable[[str], int] = len) -> list[str]:
+    return list(iter_text_chunks(doc, max_length, overlap, boundary, length_function))
 
 def extract_images(doc: pymupdf.Document) -> Exception | None:
     global dimlimit, relsize, abssize, imgdir
@@ -0,0 +1,75 @@
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Callable
+from manifest import chunk_id
+
+# Cross-encoder reranking between retriever and prompt, off unless RERANK=true
+rerank_enabled = os.getenv("RERANK", "false") == "true"
+rerank_candidates = int(os.getenv("RERANK_CANDIDATES", "12"))
+rerank_top_n = int(os.getenv("RERANK_TOP_N", "3"))
+rerank_cache_size = int(os.getenv("RERANK_CACHE_SIZE", "50000"))
+
+def question_hash(question: str) -> str:
+    return hashlib.sha256(" ".join(question.lower().split()).encode('utf-8')).hexdigest()
+
+# Scores every (question, chunk) pair with a cross-encoder and keeps the top_n chunks.
+# All pairs missing from the score cache go through score_fn in one batch, scores are cached
+# by (question hash, chunk id) so a repeated question never scores the same chunk twice.
+class CrossEncoderReranker:
+    def __init__(self, score_fn: Callable[[list[tuple[str, str]]], list[float]], top_n: int = rerank_top_n,
+                 cache_size: int = rerank_cache_size):
+        self.score_fn = score_fn
+        self.top_n = top_n
+        self.cache_size = cache_size
+        self._scores: OrderedDict[tuple[str, str], float] = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def scores(self, question: str, chunks: list[str]) -> list[float]:
+        qhash = question_hash(question)
+        keys = [(qhash, chunk_id(chunk)) for chunk in chunks]
+
+        found = {}
+        with self._lock:
+            for key in keys:
+                if key in self._scores:
+                    self._scores.move_to_end(key)
+                    found[key] = self._scores[key]
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+
+        missing = {key: chunk for key, chunk in zip(keys, chunks) if key not in found}
+        if missing:
+            new_scores = self.score_fn([(question, chunk) for chunk in missing.values()])
+            computed = {key: float(score) for key, score in zip(missing, new_scores)}
+            found.update(computed)
+
+            with self._lock:
+                self._scores.update(computed)
+                while len(self._scores) > self.cache_size:
+                    self._scores.popitem(last=False)
+
+        return [found[key] for key in keys]
+
+    # The top_n chunks for a question, most relevant first
+    def rerank(self, question: str, chunks: list[str]) -> list[str]:
+        if not chunks:
+            return []
+        scores = self.scores(question, chunks)
+        order = sorted(range(len(chunks)), key=lambda i: scores[i], reverse=True)
+        return [chunks[i] for i in order[:self.top_n]]
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "entries": len(self._scores),
+                "top_n": self.top_n,
+            }
@@ -0,0 +1,41 @@
+import os
+import sys
+import uuid
+from langchain_core.documents import Document
+from langchain_core.stores import InMemoryStore
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from fake_models import FakeEmbeddings
+from hybrid_retriever import HybridRetriever
+from lexical_index import BM25Index
+from vector_store import LocalVectorStore
+
+# A filtered lexical search keeps the chunks whose vectors match the filter, including vectors ingested
+# before the manifest, whose ids are random rather than the doc id of their chunk
+def test_filtered_lexical_search_matches_legacy_vector_ids(tmp_path):
+    embeddings = FakeEmbeddings(latency_ms=0)
+    vectorstore = LocalVectorStore(embeddings, str(tmp_path / "ivf_index"))
+    chunks = {
+        "legacy-doc": ("metformin dosing in chronic kidney disease", {"source": "legacy.pdf", "type": "text"}),
+        "new-doc": ("metformin dosing in older adults", {"source": "new.pdf", "type": "text"}),
+    }
+    vectorstore.add_texts(
+        [text for text, _ in chunks.values()],
+        [{"doc_id": doc_id, **metadata} for doc_id, (_, metadata) in chunks.items()],
+        ids=[str(uuid.uuid4()), "new-doc"],
+    )
+
+    lexical_index = BM25Index(str(tmp_path / "bm25_index"))
+    lexical_index.add(list(chunks), [text for text, _ in chunks.values()])
+    docstore = InMemoryStore()
+    docstore.mset([(doc_id, Document(page_content=text)) for doc_id, (text, _) in chunks.items()])
+
+    def search(where):
+        retriever = HybridRetriever(vectorstore=vectorstore, docstore=docstore, lexical_index=lexical_index,
+                                    dense_k=0, lexical_k=4, filter=where)
+        return [document.page_content for document in retriever.invoke("metformin dosing")]
+
+    assert search({"source": "legacy.pdf"}) == [chunks["legacy-doc"][0]]
+    assert search({"source": "new.pdf"}) == [chunks["new-doc"][0]]
+    assert len(search({"type": "text"})) == 2
@@ -0,0 +1,359 @@
+import os
+import re
+import json
+import hashlib
+import threading
+from typing import Any, Callable, Iterable, Iterator, Optional
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.vectorstores import VectorStore
+from langchain_chroma import Chroma
+from ann_index import IVFIndex
+from docstore import SQLiteDocStore
+from manifest import write_json_atomic
+from metadata_filter import matches_where, allowed_values
+
+# Which vector store backs the retriever: "chroma", or "ivf" for the local ANN index
+vector_backend = os.getenv("VECTOR_BACKEND", "chroma")
+# Which metadata key splits the vectors into one collection per value: "none", "source" or "type"
+vector_partition = os.getenv("VECTOR_PARTITION", "none")
+
+# Number of vectors copied per page when moving a Chroma collection into the local index
+_IMPORT_PAGE = 5000
+# A filtered search takes this many times k candidates from the index and keeps the k that match
+_FILTER_OVERSAMPLE = 8
+
+# Vector store on the local IVF index, the summary documents themselves are kept in a SQLiteDocStore next to it
+class LocalVectorStore(VectorStore):
+    def __init__(self, embedding_function: Embeddings, path: str, **index_kwargs):
+        self.embedding_function = embedding_function
+        self.path = path
+        self.index = IVFIndex(path, **index_kwargs)
+        self.documents = SQLiteDocStore(os.path.join(path, "documents.sqlite"))
+
+    @property
+    def embeddings(self) -> Embeddings:
+        return self.embedding_function
+
+    def add_texts(self, texts: Iterable[str], metadatas: Optional[list[dict]] = None,
+                  ids: Optional[list[str]] = None, **kwargs: Any) -> list[str]:
+        texts = list(texts)
+        metadatas = metadatas or [{} for _ in texts]
+        if ids is None:
+            raise ValueError("LocalVectorStore needs an id for every text")
+
+        vectors = self.embedding_function.embed_documents(texts)
+        self.add_vectors(ids, vectors, [Document(page_content=text, metadata=metadata) for text, metadata in zip(texts, metadatas)])
+        return list(ids)
+
+    # Documents go in before their vectors, so a vector found by a search always has its document
+    def add_vectors(self, ids: list[str], vectors, documents: list[Document]):
+        self.documents.mset(list(zip(ids, documents)))
+        self.index.add(ids, vectors)
+
+    def delete(self, ids: Optional[list[str]] = None, **kwargs: Any) -> None:
+        if not ids:
+            return
+        self.index.delete(ids)
+        self.documents.mdelete(ids)
+
+    def similarity_search_with_score(self, query: str, k: int = 4, **kwargs: Any) -> list[tuple[Document, float]]:
+        return self.similarity_search_by_vector_with_score(self.embedding_function.embed_query(query), k, **kwargs)
+
+    def similarity_search_by_vector_with_score(self, embedding: list[float], k: int = 4, nprobe: Optional[int] = None,
+                                               filter: Optional[dict] = None, **kwargs: Any) -> list[tuple[Document, float]]:
+        hits = self.index.search(embedding, k * _FILTER_OVERSAMPLE if filter else k, nprobe)
+        documents = self.documents.mget([doc_id for doc_id, _ in hits])
+        results = [
+            (document, score) for document, (_, score) in zip(documents, hits)
+            if document is not None and matches_where(document.metadata, filter)
+        ]
+        return results[:k]
+
+    # Scores are cosine similarities already, so they are the relevance scores
+    def similarity_search_by_vector_with_relevance_scores(self, embedding: list[float], k: int = 4,
+                                                          **kwargs: Any) -> list[tuple[Document, float]]:
+        return self.similarity_search_by_vector_with_score(embedding, k, **kwargs)
+
+    def similarity_search(self, query: str, k: int = 4, **kwargs: Any) -> list[Document]:
+        return [document for document, _ in self.similarity_search_with_score(query, k, **kwargs)]
+
+    def similarity_search_by_vector(self, embedding: list[float], k: int = 4, **kwargs: Any) -> list[Document]:
+        return [document for document, _ in self.similarity_search_by_vector_with_score(embedding, k, **kwargs)]
+
+    # Scores are cosine similarities already
+    def _select_relevance_score_fn(self):
+        return lambda score: score
+
+    # The ids and metadata of the documents among ids whose metadata matches where, like Chroma's get,
+    # which includes the metadatas and documents unless include names what to return
+    def get(self, ids: Optional[list[str]] = None, where: Optional[dict] = None,
+            include: Optional[list[str]] = None, **kwargs: Any) -> dict:
+        include = ["metadatas", "documents"] if include is None else include
+        keys = list(ids) if ids is not None else list(self.documents.yield_keys())
+        found = [
+            (doc_id, document) for doc_id, document in zip(keys, self.documents.mget(keys))
+            if document is not None and matches_where(document.metadata, where)
+        ]
+        result = {"ids": [doc_id for doc_id, _ in found]}
+        if "metadatas" in include:
+            result["metadatas"] = [document.metadata for _, document in found]
+        if "documents" in include:
+            result["documents"] = [document.page_content for _, document in found]
+        return result
+
+    # Copy every vector and document of a Chroma collection, the embeddings are reused as they are
+    def import_chroma(self, chroma: Chroma) -> int:
+        imported = 0
+        for ids, vectors, documents in vector_pages(chroma):
+            self.add_vectors(ids, vectors, documents)
+            imported += len(ids)
+        return imported
+
+    @classmethod
+    def from_texts(cls, texts: list[str], embedding: Embeddings, metadatas: Optional[list[dict]] = None,
+                   ids: Optional[list[str]] = None, path: str = "./ivf_index", **kwargs: Any) -> "LocalVectorStore":
+        store = cls(embedding, path, **kwargs)
+        store.add_texts(texts, metadatas, ids)
+        return store
+
+# Every vector of a store with its id and document, a page at a time
+def vector_pages(store: VectorStore) -> Iterator[tuple[list[str], np.ndarray, list[Document]]]:
+    if isinstance(store, LocalVectorStore):
+        keys = list(store.documents.yield_keys())
+        for i in range(0, len(keys), _IMPORT_PAGE):
+            ids, vectors = store.index.get(keys[i:i + _IMPORT_PAGE])
+            if ids:
+                yield ids, vectors, store.documents.mget(ids)
+        return
+
+    offset = 0
+    while True:
+        page = store.get(include=["embeddings", "documents", "metadatas"], limit=_IMPORT_PAGE, offset=offset)
+        if not page["ids"]:
+            return
+        documents = [Document(page_content=text, metadata=metadata or {})
+                     for text, metadata in zip(page["documents"], page["metadatas"])]
+        yield page["ids"], np.asarray(page["embeddings"], dtype=np.float32), documents
+        offset += len(page["ids"])
+
+# The chromadb collection under a Chroma store, the only place this module reaches past Chroma's public API.
+# Chroma can only add texts it embeds itself and has no count, the collection upserts vectors that are
+# already embedded, so moving or partitioning a store never embeds its documents again, and counts them.
+def _chroma_collection(store: Chroma):
+    return store._collection
+
+# Add vectors that are already embedded to either backend
+def add_vectors(store: VectorStore, ids: list[str], vectors, documents: list[Document]):
+    if isinstance(store, LocalVectorStore):
+        store.add_vectors(ids, vectors, documents)
+    else:
+        _chroma_collection(store).upsert(
+            ids=ids,
+            embeddings=np.asarray(vectors, dtype=np.float32).tolist(),
+            metadatas=[document.metadata for document in documents],
+            documents=[document.page_content for document in documents]
+        )
+
+def vector_count(store: VectorStore) -> int:
+    return len(store.index) if isinstance(store, LocalVectorStore) else _chroma_collection(store).count()
+
+# Chroma collection names allow letters, digits, dots, dashes and underscores, the hash keeps them unique
+def partition_name(value: str) -> str:
+    slug = re.sub(r"[^a-z0-9]+", "_", value.lower()).strip("_")[:40]
+    return f"diabetes_kb_{slug}_{hashlib.sha256(value.encode('utf-8')).hexdigest()[:8]}"
+
+# One vector store per value of a metadata key, so per source PDF or per content type.
+# A query whose filter pins that key only searches the matching partitions and never touches the others.
+# The partitions are listed in partitions.json, the vectors every query searched are counted for /stats.
+class PartitionedVectorStore(VectorStore):
+    def __init__(self, embedding_function: Embeddings, partition_by: str, registry_path: str,
+                 open_partition: Callable[[str], VectorStore]):
+        self.embedding_function = embedding_function
+        self.partition_by = partition_by
+        self.registry_path = registry_path
+        self.open_partition = open_partition
+
+        registry = {"partition_by": partition_by, "partitions": {}}
+        if os.path.exists(registry_path):
+            with open(registry_path, 'r') as f:
+                registry = json.load(f)
+        if registry["partition_by"] != partition_by:
+            raise ValueError(f"Vectors are partitioned by {registry['partition_by']}, "
+                             f"remove {registry_path} and its partitions to partition by {partition_by}")
+
+        # metadata value -> partition name
+        self.names: dict[str, str] = registry["partitions"]
+        self.partitions = {value: open_partition(name) for value, name in self.names.items()}
+        self.sizes = {value: vector_count(store) for value, store in self.partitions.items()}
+
+        self._lock = threading.Lock()
+        self.queries = 0
+        self.vectors_touched = 0
+        self.last_vectors_touched = 0
+        self.partition_queries = dict.fromkeys(self.partitions, 0)
+
+    @property
+    def embeddings(self) -> Embeddings:
+        return self.embedding_function
+
+    def _partition(self, value: str) -> VectorStore:
+        with self._lock:
+            if value not in self.partitions:
+                self.names[value] = partition_name(value)
+                self.partitions[value] = self.open_partition(self.names[value])
+                self.sizes[value] = 0
+                self.partition_queries[value] = 0
+                write_json_atomic(self.registry_path, {"partition_by": self.partition_by, "partitions": self.names})
+            return self.partitions[value]
+
+    # The partitions a where clause can match
+    def _select(self, where: Optional[dict]) -> list[str]:
+        allowed = allowed_values(where, self.partition_by)
+        return [value for value in self.partitions if allowed is None or value in allowed]
+
+    def add_texts(self, texts: Iterable[str], metadatas: Optional[list[dict]] = None,
+                  ids: Optional[list[str]] = None, **kwargs: Any) -> list[str]:
+        texts = list(texts)
+        metadatas = metadatas or [{} for _ in texts]
+        if ids is None:
+            raise ValueError("PartitionedVectorStore needs an id for every text")
+
+        # one embedding call for the texts of every partition
+        vectors = self.embedding_function.embed_documents(texts)
+        self.add_vectors(ids, vectors, [Document(page_content=text, metadata=metadata) for text, metadata in zip(texts, metadatas)])
+        return list(ids)
+
+    def add_vectors(self, ids: list[str], vectors, documents: list[Document]):
+        groups: dict[str, list[int]] = {}
+        for i, document in enumerate(documents):
+            groups.setdefault(str(document.metadata.get(self.partition_by, "")), []).append(i)
+
+        for value, members in groups.items():
+            store = self._partition(value)
+            add_vectors(store, [ids[i] for i in members], [vectors[i] for i in members], [documents[i] for i in members])
+            self.sizes[value] = vector_count(store)
+
+    # The partition of an id is not known, so it is deleted from all of them
+    def delete(self, ids: Optional[list[str]] = None, **kwargs: Any) -> None:
+        if not ids:
+            return
+        for value, store in list(self.partitions.items()):
+            store.delete(ids=ids)
+            self.sizes[value] = vector_count(store)
+
+    def similarity_search_with_score(self, query: str, k: int = 4, **kwargs: Any) -> list[tuple[Document, float]]:
+        return self.similarity_search_by_vector_with_score(self.embedding_function.embed_query(query), k, **kwargs)
+
+    # Every selected partition returns its k best with relevance scores, so partitions of both backends can be merged
+    def similarity_search_by_vector_with_score(self, embedding: list[float], k: int = 4, filter: Optional[dict] = None,
+                                               **kwargs: Any) -> list[tuple[Document, float]]:
+        selected = self._select(filter)
+        results = []
+        for value in selected:
+            store = self.partitions[value]
+            relevance = store._select_relevance_score_fn()
+            hits = store.similarity_search_by_vector_with_relevance_scores(embedding, k, filter=filter, **kwargs)
+            results.extend((document, relevance(score)) for document, score in hits)
+
+        touched = sum(self.sizes[value] for value in selected)
+        with self._lock:
+            self.queries += 1
+            self.vectors_touched += touched
+            self.last_vectors_touched = touched
+            for value in selected:
+                self.partition_queries[value] += 1
+
+        return sorted(results, key=lambda result: result[1], reverse=True)[:k]
+
+    def similarity_search(self, query: str, k: int = 4, **kwargs: Any) -> list[Document]:
+        return [document for document, _ in self.similarity_search_with_score(query, k, **kwargs)]
+
+    def similarity_search_by_vector(self, embedding: list[float], k: int = 4, **kwargs: Any) -> list[Document]:
+        return [document for document, _ in self.similarity_search_by_vector_with_score(embedding, k, **kwargs)]
+
+    # The partitions return relevance scores already
+    def _select_relevance_score_fn(self):
+        return lambda score: score
+
+    # Like Chroma's get, merged over the partitions where can match
+    def get(self, ids: Optional[list[str]] = None, where: Optional[dict] = None,
+            include: Optional[list[str]] = None, **kwargs: Any) -> dict:
+        include = ["metadatas", "documents"] if include is None else include
+        found = {"ids": [], **{key: [] for key in include}}
+        for value in self._select(where):
+            page = self.partitions[value].get(ids=ids, where=where, include=include)
+            for key, values in found.items():
+                values.extend(page[key])
+        return found
+
+    # Move the vectors of an unpartitioned store over, the embeddings are reused as they are
+    def import_store(self, store: VectorStore) -> int:
+        imported = 0
+        for ids, vectors, documents in vector_pages(store):
+            self.add_vectors(ids, vectors, documents)
+            imported += len(ids)
+        return imported
+
+    @classmethod
+    def from_texts(cls, texts: list[str], embedding: Embeddings, metadatas: Optional[list[dict]] = None,
+                   ids: Optional[list[str]] = None, path: str = "./partitioned_vectors", partition_by: str = "source",
+                   backend: str = vector_backend, **kwargs: Any) -> "PartitionedVectorStore":
+        os.makedirs(path, exist_ok=True)
+        store = cls(embedding, partition_by, os.path.join(path, "partitions.json"),
+                    partition_opener(embedding, path, backend))
+        store.add_texts(texts, metadatas, ids)
+        return store
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "partition_by": self.partition_by,
+                "queries": self.queries,
+                "avg_vectors_touched": round(self.vectors_touched / self.queries, 1) if self.queries else 0.0,
+                "last_vectors_touched": self.last_vectors_touched,
+                "vectors": sum(self.sizes.values()),
+                "partitions": {
+                    value: {"vectors": self.sizes[value], "queries": self.partition_queries[value]}
+                    for value in self.partitions
+                },
+            }
+
+# Opens the partition of a given name in processed_dir, a Chroma collection or a local index
+def partition_opener(embeddings: Embeddings, processed_dir: str, backend: str) -> Callable[[str], VectorStore]:
+    if backend == "chroma":
+        chroma_path = os.path.join(processed_dir, "chroma_db")
+        return lambda name: Chroma(collection_name=name, embedding_function=embeddings, persist_directory=chroma_path)
+    return lambda name: LocalVectorStore(embeddings, os.path.join(processed_dir, "ivf_partitions", name))
+
+# Open the vector store of the knowledge base in processed_dir with the configured backend.
+# The first time the local index is used an existing Chroma collection is copied into it, and
+# the first time the vectors are partitioned the unpartitioned store is split up.
+def open_vectorstore(embeddings: Embeddings, processed_dir: str, backend: str = vector_backend,
+                     partition_by: str = vector_partition) -> VectorStore:
+    chroma_path = os.path.join(processed_dir, "chroma_db")
+    if backend not in ("chroma", "ivf"):
+        raise ValueError(f"Unknown vector backend: {backend}")
+
+    if partition_by != "none":
+        store = PartitionedVectorStore(embeddings, partition_by, os.path.join(processed_dir, "partitions.json"),
+                                       partition_opener(embeddings, processed_dir, backend))
+        if not store.partitions:
+            imported = store.import_store(open_vectorstore(embeddings, processed_dir, backend, "none"))
+            if imported:
+                print(f"Partitioned {imported} vectors by {partition_by}.")
+        return store
+
+    if backend == "chroma":
+        return Chroma(
+            collection_name="diabetes_kb",
+            embedding_function=embeddings,
+            persist_directory=chroma_path
+        )
+
+    store = LocalVectorStore(embeddings, os.path.join(processed_dir, "ivf_index"))
+    if len(store.index) == 0 and os.path.exists(chroma_path):
+        imported = store.import_chroma(open_vectorstore(embeddings, processed_dir, "chroma", "none"))
+        print(f"Imported {imported} vectors from {chroma_path}.")
+    return store
@@ -0,0 +1,111 @@
+import asyncio
+import json
+import os
+import httpx
+from typing import AsyncIterator
+from fastapi import Request
+from .error import AiServerError, AiServerBusyError
+
+AI_URL = os.getenv("AI_URL", "http://ai_server:4242")
+
+# Generation can take minutes, so only the connect phase gets a short timeout
+AI_CONNECT_TIMEOUT = float(os.getenv("AI_CONNECT_TIMEOUT", "5"))
+AI_READ_TIMEOUT = float(os.getenv("AI_READ_TIMEOUT", "300"))
+AI_MAX_CONNECTIONS = int(os.getenv("AI_MAX_CONNECTIONS", "32"))
+AI_MAX_KEEPALIVE = int(os.getenv("AI_MAX_KEEPALIVE", "16"))
+# How many answers may be generated at once, and how long a request may wait for a slot
+AI_MAX_CONCURRENCY = int(os.getenv("AI_MAX_CONCURRENCY", "8"))
+AI_QUEUE_TIMEOUT = float(os.getenv("AI_QUEUE_TIMEOUT", "30"))
+AI_RETRIES = int(os.getenv("AI_RETRIES", "3"))
+AI_RETRY_BACKOFF = float(os.getenv("AI_RETRY_BACKOFF", "0.5"))
+
+# Errors that happen before the request reached the ai server, so sending it again cannot generate twice.
+# Anything after that fails at once: a read timeout or a dropped connection may come after the server started
+# generating, and so may a 502 or 504 from a proxy in between. The ai server itself never answers 503 busy.
+RETRYABLE_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+class AiClient():
+    def __init__(self, base_url: str = AI_URL):
+        self.client = httpx.AsyncClient(
+                base_url=base_url,
+                timeout=httpx.Timeout(AI_READ_TIMEOUT, connect=AI_CONNECT_TIMEOUT),
+                limits=httpx.Limits(
+                    max_connections=AI_MAX_CONNECTIONS,
+                    max_keepalive_connections=AI_MAX_KEEPALIVE,
+                    ),
+                )
+        self.slots = asyncio.Semaphore(AI_MAX_CONCURRENCY)
+
+    async def close(self):
+        await self.client.aclose()
+
+    # Wait for a free generation slot, giving up with a 503 instead of queueing forever
+    async def _acquire_slot(self):
+        try:
+            await asyncio.wait_for(self.slots.acquire(), timeout=AI_QUEUE_TIMEOUT)
+        except asyncio.TimeoutError:
+            raise AiServerBusyError
+
+    # Sleep before the next attempt, doubling the delay every time
+    async def _backoff(self, attempt: int):
+        await asyncio.sleep(AI_RETRY_BACKOFF * (2 ** attempt))
+
+    # Get the full answer for a message from the ai server
+    async def answer(self, message_content: str) -> str:
+        await self._acquire_slot()
+        try:
+            for attempt in range(AI_RETRIES + 1):
+                last_attempt = attempt == AI_RETRIES
+                try:
+                    ai_response = await self.client.post("/answer", json={"message": message_content})
+                except RETRYABLE_ERRORS:
+                    if last_attempt:
+                        raise AiServerError
+                    await self._backoff(attempt)
+                    continue
+                except httpx.TransportError:
+                    raise AiServerError
+
+                if ai_response.status_code != 200:
+                    raise AiServerError
+                return ai_response.json()["message"]
+        finally:
+            self.slots.release()
+
+    # Stream the answer tokens for a message from the ai server.
+    # Retries only happen before the first token, a stream that breaks halfway is an error.
+    async def stream_answer(self, message_content: str) -> AsyncIterator[str]:
+        await self._acquire_slot()
+        try:
+            for attempt in range(AI_RETRIES + 1):
+                last_attempt = attempt == AI_RETRIES
+                started = False
+                try:
+                    async with self.client.stream("POST", "/answer/stream", json={"message": message_content}) as ai_response:
+                        if ai_response.status_code != 200:
+                            raise AiServerError
+
+                        async for line in ai_response.aiter_lines():
+                            if not line.startswith("data: "):
+                                continue
+                            event = json.loads(line[len("data: "):])
+                            if "error" in event:
+                                raise AiServerError
+                            if event.get("done"):
+                                return
+                            started = True
+                            yield event["token"]
+                        # the server hung up without saying it was done
+                        raise AiServerError
+                except RETRYABLE_ERRORS:
+                    if started or last_attempt:
+                        raise AiServerError
+                    await self._backoff(attempt)
+                except httpx.TransportError:
+                    raise AiServerError
+        finally:
+            self.slots.release()
+
+# Dependency handing routes the client created in the app lifespan
+async def get_ai_client(request: Request) -> AiClient:
+    return request.app.state.ai_client
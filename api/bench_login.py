@@ -0,0 +1,84 @@
+import os
+import time
+import asyncio
+import argparse
+import tempfile
+import statistics
+import httpx
+
+# Run from the repo root with: python -m api.bench_login
+# Logins go through the app in-process while a probe keeps hitting /healthcheck.
+# With bcrypt on the event loop the probe stalls behind every login, with the worker pool it does not.
+
+os.environ.setdefault("DEV", "true")
+os.environ["DB_ROOT"] = tempfile.mkdtemp(prefix="bench_login_")
+
+from .main import app
+from .hashing import PasswordHasher
+
+# Runs bcrypt right on the event loop, which is what login used to do
+class InlineHasher(PasswordHasher):
+    async def _run(self, fn, *args):
+        return fn(*args)
+
+def percentile(values: list[float], pct: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+async def run(client: httpx.AsyncClient, users: list[str], logins: int, concurrency: int) -> tuple[float, list[float]]:
+    probe_latencies = []
+    done = asyncio.Event()
+
+    async def probe():
+        while not done.is_set():
+            start = time.perf_counter()
+            await client.get("/healthcheck")
+            probe_latencies.append(time.perf_counter() - start)
+            await asyncio.sleep(0.01)
+
+    pending = iter(range(logins))
+
+    async def login_client():
+        for i in pending:
+            username = users[i % len(users)]
+            res = await client.post("/auth/login", json={"username": username, "password": "password"})
+            res.raise_for_status()
+
+    probe_task = asyncio.create_task(probe())
+    start = time.perf_counter()
+    await asyncio.gather(*[login_client() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - start
+    done.set()
+    await probe_task
+    return elapsed, probe_latencies
+
+async def main():
+    parser = argparse.ArgumentParser(description="Login throughput with bcrypt inline vs on the worker pool")
+    parser.add_argument("--users", type=int, default=8)
+    parser.add_argument("--logins", type=int, default=64)
+    parser.add_argument("--concurrency", type=int, default=16)
+    args = parser.parse_args()
+
+    async with app.router.lifespan_context(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+            users = [f"bench_user_{i}" for i in range(args.users)]
+            for username in users:
+                res = await client.put("/auth/signup", json={
+                    "username": username, "icon_file": "", "role": "user", "password": "password"
+                    })
+                res.raise_for_status()
+
+            pooled_hasher = app.state.password_hasher
+            for name, hasher in [("inline", InlineHasher()), ("pool", pooled_hasher)]:
+                app.state.password_hasher = hasher
+                elapsed, probes = await run(client, users, args.logins, args.concurrency)
+                print(f"{name:>6}: {args.logins / elapsed:7.1f} logins/s  "
+                      f"healthcheck p50 {statistics.median(probes) * 1000:7.1f} ms  "
+                      f"p99 {percentile(probes, 99) * 1000:7.1f} ms  ({len(probes)} probes)")
+                if hasher is not pooled_hasher:
+                    hasher.close()
+            app.state.password_hasher = pooled_hasher
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,11 +1,23 @@
 import sqlite3
 import re
+import time
 import datetime
+import threading
+import os
 import os.path
+from collections import OrderedDict
 from .classes import UserInfo
 from .error import UserNotInDbError
-_db_connections = {}
-DB_ROOT = "./dbs"
+DB_ROOT = os.getenv("DB_ROOT", "./dbs")
+
+# Open per-user connections are kept in a bounded LRU pool, idle ones get evicted
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "64"))
+DB_POOL_IDLE_SECONDS = float(os.getenv("DB_POOL_IDLE_SECONDS", "300"))
+# How long a connection pushed out of a full pool stays open, for the requests that got it just before
+DB_POOL_CLOSE_GRACE_SECONDS = float(os.getenv("DB_POOL_CLOSE_GRACE_SECONDS", "30"))
+
+# Bumped whenever init_tables changes, stored in the db file as PRAGMA user_version
+SCHEMA_VERSION = 1
 
 create_user_query: str = '''
 insert into user_info values (?,?,?,?,?)
@@ -14,9 +26,29 @@ insert into user_info values (?,?,?,?,?)
 class DbConnection():
     def __init__(self, username: str):
         self.username = username
-        self.connection = sqlite3.connect(f"{DB_ROOT}/{username}.sqlite")
-        self.cursor = self.connection.cursor()
-        self.init_tables()
+        self.last_used = time.monotonic()
+        # pooled connections outlive the thread that opened them
+        self.connection = sqlite3.connect(f"{DB_ROOT}/{username}.sqlite", check_same_thread=False)
+        self.set_pragmas()
+
+        # schema creation only runs once per db file
+        if self.cursor.execute("PRAGMA user_version;").fetchone()[0] < SCHEMA_VERSION:
+            self.init_tables()
+
+    # Every query gets a cursor of its own, concurrent requests of a user share the connection
+    # and a shared cursor would hand one request the rows of another
+    @property
+    def cursor(self) -> sqlite3.Cursor:
+        return self.connection.cursor()
+
+    def set_pragmas(self):
+        # WAL lets history reads go on while the ai reply is written
+        self.cursor.execute("PRAGMA journal_mode=WAL;")
+        self.cursor.execute("PRAGMA synchronous=NORMAL;")
+        self.cursor.execute("PRAGMA cache_size=-4000;")  # 4 MB page cache
+        self.cursor.execute("PRAGMA mmap_size=67108864;")  # 64 MB
+        self.cursor.execute("PRAGMA temp_store=MEMORY;")
+        self.cursor.execute("PRAGMA busy_timeout=5000;")
 
     def init_tables(self):
         tables_script: str = '''
@@ -56,16 +88,19 @@ class DbConnection():
         create index if not exists idx_chat_id on messages (chat_id);
         '''
 
+        tables_script += f'''
+        PRAGMA user_version = {SCHEMA_VERSION};
+        '''
+
         tables_script += '''
         COMMIT;
         '''
         self.cursor.executescript(tables_script)
 
     def close(self):
-        global _db_connections
+        global _pool
 
-        if self.username in _db_connections:
-            del _db_connections[self.username]
+        _pool.discard(self.username)
         self.connection.close()
         
     def get_info(self) -> UserInfo:
@@ -87,14 +122,75 @@ class DbConnection():
 def CheckBanned(username) -> bool:
     return re.search(r'[^a-zA-Z0-9_-]', username) != None
 
+class ConnectionPool():
+    def __init__(self, max_size: int, idle_seconds: float):
+        self.max_size = max_size
+        self.idle_seconds = idle_seconds
+        self.connections: OrderedDict[str, DbConnection] = OrderedDict()
+        # evicted connections waiting to be closed, see _close_retired
+        self.retired: list[DbConnection] = []
+        self.lock = threading.RLock()
+
+    def get(self, username: str) -> DbConnection | None:
+        with self.lock:
+            self._evict_idle()
+            self._close_retired()
+            db = self.connections.get(username)
+            if db is not None:
+                db.last_used = time.monotonic()
+                self.connections.move_to_end(username)
+            return db
+
+    def put(self, db: DbConnection) -> DbConnection:
+        with self.lock:
+            db.last_used = time.monotonic()
+            replaced = self.connections.get(db.username)
+            if replaced is not None and replaced is not db:
+                self.retired.append(replaced)
+            self.connections[db.username] = db
+            self.connections.move_to_end(db.username)
+            while len(self.connections) > self.max_size:
+                self.retired.append(self.connections.popitem(last=False)[1])
+            self._close_retired()
+            return db
+
+    def discard(self, username: str):
+        with self.lock:
+            self.connections.pop(username, None)
+
+    def _evict_idle(self):
+        now = time.monotonic()
+        while self.connections:
+            username, db = next(iter(self.connections.items()))
+            if now - db.last_used < self.idle_seconds:
+                break
+            del self.connections[username]
+            self.retired.append(db)
+
+    # Close evicted connections once no request can still be using them. Idle ones are closed right away,
+    # one pushed out of a full pool may have been handed to a request just before and waits the grace period.
+    def _close_retired(self):
+        now = time.monotonic()
+        waiting = []
+        for db in self.retired:
+            if now - db.last_used >= DB_POOL_CLOSE_GRACE_SECONDS:
+                db.connection.close()
+            else:
+                waiting.append(db)
+        self.retired = waiting
+
+_pool = ConnectionPool(DB_POOL_SIZE, DB_POOL_IDLE_SECONDS)
+
 def GetUserDb(username) -> DbConnection | None:
-    global _db_connections
+    global _pool
 
-    if username in _db_connections:
-        return _db_connections[username]
+    with _pool.lock:
+        db = _pool.get(username)
+        if db is not None:
+            return db
 
-    if os.path.isfile(f"{DB_ROOT}/{username}.sqlite"):
-        return DbConnection(username)
+        if os.path.isfile(f"{DB_ROOT}/{username}.sqlite"):
+            return _pool.put(DbConnection(username))
 
     return None
 
@@ -105,17 +201,17 @@ def CreateUserDb(user_info: UserInfo) -> DbConnection:
     icon_file = user_info.icon_file
     date_added = datetime.datetime.now().isoformat()
 
-    global _db_connections, create_user_query
-    _db_connections[username] = DbConnection(username)
-    _db_connections[username].cursor.execute(create_user_query, (
+    global _pool, create_user_query
+    db = _pool.put(DbConnection(username))
+    db.cursor.execute(create_user_query, (
         username,
         password_hash,
         role,
         icon_file,
         date_added
         ))
-    _db_connections[username].connection.commit()
-    return _db_connections[username]
+    db.connection.commit()
+    return db
 
 # mental illness
 #class Db(object):
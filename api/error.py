@@ -6,3 +6,26 @@ class UserNotInDbError(HTTPException):
                 status_code=404,
                 detail="user not found in db"
                 )
+
+class AiServerError(HTTPException):
+    def __init__(self):
+        super().__init__(
+                status_code=500,
+                detail="somthing went wrong with ai server"
+                )
+
+class AiServerBusyError(HTTPException):
+    def __init__(self):
+        super().__init__(
+                status_code=503,
+                detail="the ai server is busy, try again later",
+                headers={"Retry-After": "5"}
+                )
+
+class ServerBusyError(HTTPException):
+    def __init__(self):
+        super().__init__(
+                status_code=503,
+                detail="the server is busy, try again later",
+                headers={"Retry-After": "1"}
+                )
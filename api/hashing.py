@@ -0,0 +1,37 @@
+import asyncio
+import os
+import bcrypt
+from concurrent.futures import ThreadPoolExecutor
+from fastapi import Request
+from .error import ServerBusyError
+
+# bcrypt releases the GIL while hashing, so a thread pool gives real parallelism
+HASH_WORKERS = int(os.getenv("HASH_WORKERS", str(min(4, os.cpu_count() or 1))))
+# How many password checks may be running or waiting before new ones get a 503
+HASH_MAX_PENDING = int(os.getenv("HASH_MAX_PENDING", "64"))
+
+class PasswordHasher():
+    def __init__(self, workers: int = HASH_WORKERS, max_pending: int = HASH_MAX_PENDING):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="bcrypt")
+        self.pending = asyncio.Semaphore(max_pending)
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    async def _run(self, fn, *args):
+        # refuse instead of queueing without limit when the pool is saturated
+        if self.pending.locked():
+            raise ServerBusyError
+        async with self.pending:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+
+    async def hash_password(self, password: str) -> str:
+        hashed = await self._run(bcrypt.hashpw, password.encode('utf-8'), bcrypt.gensalt())
+        return hashed.decode('utf-8')
+
+    async def check_password(self, password: str, password_hash: str) -> bool:
+        return await self._run(bcrypt.checkpw, password.encode('utf-8'), password_hash.encode('utf-8'))
+
+# Dependency handing routes the hasher created in the app lifespan
+async def get_password_hasher(request: Request) -> PasswordHasher:
+    return request.app.state.password_hasher
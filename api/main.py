@@ -3,8 +3,22 @@ from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import RedirectResponse
 from .routes.chats import router as chats_router
 from .routes.auth import router as auth_router
+from .ai_client import AiClient
+from .hashing import PasswordHasher
+from contextlib import asynccontextmanager
 import logging
-app = FastAPI()
+
+# One pooled http client per app lifespan, shared by every call to the ai server,
+# and one bounded worker pool for password hashing
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    app.state.ai_client = AiClient()
+    app.state.password_hasher = PasswordHasher()
+    yield
+    await app.state.ai_client.close()
+    app.state.password_hasher.close()
+
+app = FastAPI(lifespan=lifespan)
 
 origins = [
         "*"
@@ -1,11 +1,11 @@
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, Depends
 from ..error import UserNotInDbError
 from ..db import GetUserDb, CreateUserDb, CheckBanned
 from ..classes import UserInfo
+from ..hashing import PasswordHasher, get_password_hasher
 from pydantic import BaseModel
-import bcrypt
+import asyncio
 import datetime
-import time
 
 router = APIRouter()
 
@@ -28,7 +28,7 @@ class RegisterRes(BaseModel):
     role: str
 
 @router.post("/login")
-async def login(request: LoginReq) -> LoginRes:
+async def login(request: LoginReq, hasher: PasswordHasher = Depends(get_password_hasher)) -> LoginRes:
     response: LoginRes
     username = request.username
     if CheckBanned(username):
@@ -42,23 +42,22 @@ async def login(request: LoginReq) -> LoginRes:
 
     if user_db_connection == None:
         # sleeping to prevent heuristics attacks
-        time.sleep(0.1)
+        await asyncio.sleep(0.1)
         raise HTTPException(status_code=404, detail="username or password is wrong")
 
     user_info = user_db_connection.get_info()
 
-    if bcrypt.checkpw(password.encode('utf-8'), user_info.password_hash.encode('utf-8')):
+    if await hasher.check_password(password, user_info.password_hash):
         response = LoginRes(
                 username=user_info.username,
                 role=user_info.role
                 )
-        user_db_connection.close()
         return response
     else:
         raise HTTPException(status_code=404, detail="username or password is wrong")
 
 @router.put("/signup")
-async def signup(request: RegisterReq) -> RegisterRes:
+async def signup(request: RegisterReq, hasher: PasswordHasher = Depends(get_password_hasher)) -> RegisterRes:
     response: RegisterRes
     username = request.username
 
@@ -73,9 +72,15 @@ async def signup(request: RegisterReq) -> RegisterRes:
     if user_db != None:
         raise HTTPException(status_code=409, detail="this user is already registered")
 
+    password_hash = await hasher.hash_password(password)
+
+    # the hashing above yields the event loop, someone may have taken the name meanwhile
+    if GetUserDb(username) != None:
+        raise HTTPException(status_code=409, detail="this user is already registered")
+
     user_db = CreateUserDb(UserInfo(
         username=username,
-        password_hash=bcrypt.hashpw(password.encode(), bcrypt.gensalt()).decode('utf-8'),
+        password_hash=password_hash,
         role=role,
         icon_file=icon_file,
         date_added=datetime.datetime.now().isoformat()
@@ -86,6 +91,5 @@ async def signup(request: RegisterReq) -> RegisterRes:
             username=user.username,
             role=user.role
             )
-    user_db.close()
 
     return response
@@ -1,15 +1,16 @@
 import lorem
-import requests
-from ..error import UserNotInDbError
-from fastapi import APIRouter
+from ..error import UserNotInDbError, AiServerError
+from ..ai_client import AiClient, get_ai_client
+from fastapi import APIRouter, Depends
 from fastapi.exceptions import HTTPException
+from fastapi.responses import StreamingResponse
 from ..classes import Chat, Message
 from ..db import GetUserDb
 from pydantic import BaseModel
 import os
+import json
 import datetime
-
-AI_URL = "http://ai_server:4242"
+import contextlib
 
 dev = os.getenv("DEV")
 
@@ -90,7 +91,7 @@ async def insert_chat(request: NewChatReq) -> int:
     return chat_id
 
 @router.put("/new-message", status_code=200)
-async def new_message(request: NewMessageReq) -> list[Message]:
+async def new_message(request: NewMessageReq, ai_client: AiClient = Depends(get_ai_client)) -> list[Message]:
     response: list[Message] = []
     username = request.username
     chat_id = request.chat_id
@@ -130,12 +131,7 @@ async def new_message(request: NewMessageReq) -> list[Message]:
     global dev
     ai_response = None
     if dev != "true":
-        server_url: str = "http://ai_server:4242/answer"
-        message = {"message": message_content}
-        ai_response = requests.post(server_url, json=message)
-        if ai_response.status_code != 200:
-            raise HTTPException(status_code=500, detail= "somthing went wrong with ai server")
-        ai_response = ai_response.json()["message"]
+        ai_response = await ai_client.answer(message_content)
 
     query: str = '''
     insert into messages(chat_id, message_content, sender, date_added)
@@ -171,6 +167,94 @@ async def new_message(request: NewMessageReq) -> list[Message]:
         ))
     return response
 
+# Format a payload as a single server-sent event
+def sse_event(payload: dict) -> str:
+    return f"data: {json.dumps(payload)}\n\n"
+
+# Yield the generated tokens as they arrive from the ai server
+async def stream_ai_tokens(ai_client: AiClient, message_content: str):
+    global dev
+    if dev == "true":
+        for word in lorem.paragraph().split(" "):
+            yield word + " "
+        return
+
+    # closed as soon as this generator is, so the ai slot is released without waiting for the garbage collector
+    async with contextlib.aclosing(ai_client.stream_answer(message_content)) as tokens:
+        async for token in tokens:
+            yield token
+
+def insert_message(user_db, chat_id: int, message_content: str, sender: str) -> Message:
+    query: str = '''
+    insert into messages(chat_id, message_content, sender, date_added)
+    values (?,?,?,?)
+    returning message_id, message_content, sender, date_added;
+    '''
+    res = user_db.cursor.execute(query, (
+        chat_id,
+        message_content,
+        sender,
+        datetime.datetime.now().isoformat()
+        )).fetchone()
+    user_db.connection.commit()
+
+    return Message(
+        message_id=res[0],
+        message_content=res[1],
+        sender=res[2],
+        date_added=res[3],
+        )
+
+# Same as new-message but relays the ai reply as server-sent events while it is generated.
+# Events are {"type": "user_message"}, then one {"type": "token"} per token and finally
+# {"type": "ai_message"} once the full reply has been stored, or {"type": "error"}.
+@router.put("/new-message/stream", status_code=200)
+async def new_message_stream(request: NewMessageReq, ai_client: AiClient = Depends(get_ai_client)) -> StreamingResponse:
+    username = request.username
+    chat_id = request.chat_id
+    message_content = request.message_content
+    user_db = GetUserDb(username)
+    if user_db == None:
+        raise UserNotInDbError
+
+    query: str = '''
+    select * from chats where
+    chat_id=?
+    '''
+    res = user_db.cursor.execute(query, [chat_id]).fetchone()
+    if res == None:
+        raise HTTPException(status_code=404, detail="chat_id not found in db")
+
+    user_message = insert_message(user_db, chat_id, message_content, "user")
+
+    async def relay():
+        yield sse_event({"type": "user_message", "message": user_message.model_dump()})
+
+        tokens: list[str] = []
+        try:
+            # a client that disconnects stops the relay here, aclosing then ends the stream to the ai server at once
+            async with contextlib.aclosing(stream_ai_tokens(ai_client, message_content)) as stream:
+                async for token in stream:
+                    tokens.append(token)
+                    yield sse_event({"type": "token", "token": token})
+        except HTTPException as e:
+            yield sse_event({"type": "error", "detail": e.detail})
+            return
+        except Exception:
+            # a malformed event or a broken connection halfway through the answer
+            yield sse_event({"type": "error", "detail": AiServerError().detail})
+            return
+
+        # persist the whole reply only once the stream has ended
+        ai_message = insert_message(GetUserDb(username), chat_id, "".join(tokens).strip(), "ai")
+        yield sse_event({"type": "ai_message", "message": ai_message.model_dump()})
+
+    return StreamingResponse(
+            relay(),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+            )
+
 @router.get("/get-chat-detail")
 async def get_message_from_chat(username: str, chat_id: int) -> list[Message]:
     user_db = GetUserDb(username)
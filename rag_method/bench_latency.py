@@ -0,0 +1,205 @@
+import os
+import sys
+import json
+import time
+import random
+import hashlib
+import argparse
+import platform
+import subprocess
+import statistics
+import contextvars
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+# Add the current directory and the knowledge base next to it to the path
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "RAG_method"))
+
+from langchain_core.runnables import RunnableLambda, RunnableSequence
+from multimodal_rag import DiabetesKnowledgeBase
+
+# Latency per stage and throughput of DiabetesKnowledgeBase, the performance counterpart of eval.py.
+# Every query goes through the knowledge base's own chain. Its components are timed where the chain
+# calls them: the embeddings, the vector store search, the docstore fetch, the prompt and the model,
+# so whatever the chain does between them counts in the total only. The same queries then run through
+# the chain at several concurrency levels for the QPS. Results are written as JSON, so runs of
+# different commits can be compared.
+# By default the chain's model is swapped for a stub with a fixed latency and token rate, so the numbers
+# are our own overhead and a CPU-only machine can run it. --real generates with the knowledge base's chat model.
+
+DEFAULT_DATASET = os.path.join(os.path.dirname(os.path.abspath(__file__)), "evaluation_dataset.json")
+STAGES = ["embed", "vector_search", "docstore_fetch", "prompt_build", "generate", "total"]
+
+_TEMPLATES = [
+    "What is the recommended {topic} for {group}?",
+    "How does {topic} change for {group}?",
+    "What are the risks of {topic} in {group}?",
+    "When should {topic} be reviewed for {group}?",
+]
+_TOPICS = ["HbA1c target", "insulin dose", "metformin therapy", "blood pressure goal", "statin therapy",
+           "continuous glucose monitoring", "hypoglycemia treatment", "carbohydrate intake", "SGLT2 inhibitor use"]
+_GROUPS = ["older adults", "pregnant women", "children with type 1 diabetes", "patients with chronic kidney disease",
+           "hospitalized patients", "adults with type 2 diabetes"]
+
+# Deterministic stand-in for the chat model: waits for the first token, then emits tokens at a fixed rate
+class StubLLM:
+    def __init__(self, first_token_ms: float, tokens_per_second: float, answer_tokens: int):
+        self.first_token_ms = first_token_ms
+        self.tokens_per_second = tokens_per_second
+        self.answer_tokens = answer_tokens
+
+    def invoke(self, prompt) -> str:
+        time.sleep(self.first_token_ms / 1000 + self.answer_tokens / self.tokens_per_second)
+        rng = random.Random(hashlib.sha256(str(prompt).encode('utf-8')).hexdigest())
+        return " ".join(rng.choice(_TOPICS).split()[0] for _ in range(self.answer_tokens))
+
+def synthetic_queries(n: int, seed: int = 0) -> list[str]:
+    rng = random.Random(seed)
+    return [rng.choice(_TEMPLATES).format(topic=rng.choice(_TOPICS), group=rng.choice(_GROUPS)) for _ in range(n)]
+
+# Questions of a JSON list of strings or of objects with a "question", or of a JSONL file of those objects
+def recorded_queries(path: str) -> list[str]:
+    with open(path, 'r') as f:
+        if path.endswith(".jsonl"):
+            items = [json.loads(line) for line in f if line.strip()]
+        else:
+            items = json.load(f)
+    return [(item["question"] if isinstance(item, dict) else item).strip() for item in items]
+
+def percentiles(values: list[float]) -> dict:
+    values = sorted(values)
+    pick = lambda pct: values[min(len(values) - 1, int(len(values) * pct / 100))] * 1000
+    return {"n": len(values), "mean_ms": statistics.mean(values) * 1000,
+            "p50_ms": pick(50), "p95_ms": pick(95), "p99_ms": pick(99)}
+
+# Seconds per stage of the query running in this context. The chain runs the retriever on a thread of its
+# own, LangChain hands that thread a copy of the context, which still holds the same dict.
+_query_timings = contextvars.ContextVar("query_timings", default=None)
+
+# Wrap a function so the seconds spent in it add up in the given stage of the query calling it
+def timed(stage: str, function):
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            timings = _query_timings.get()
+            if timings is not None:
+                timings[stage] += time.perf_counter() - start
+    return wrapper
+
+# Time the components of the knowledge base where its chain calls them and return the chain to benchmark.
+# The embeddings, vector store and docstore are the objects the retriever holds, their methods are
+# wrapped in place. The prompt and the model are steps of the chain, the chain gets them wrapped, with
+# llm in place of the chat model.
+def instrument(kb: DiabetesKnowledgeBase, llm, k: int, cold: bool) -> RunnableSequence:
+    embeddings = getattr(kb.embeddings, "embeddings", kb.embeddings) if cold else kb.embeddings
+    kb.embeddings.embed_query = timed("embed", embeddings.embed_query)
+    kb.vectorstore.similarity_search = timed("vector_search", kb.vectorstore.similarity_search)
+    kb.store.mget = timed("docstore_fetch", kb.store.mget)
+    kb.retriever.search_kwargs = {**kb.retriever.search_kwargs, "k": k}
+
+    steps = {
+        id(kb.prompt): RunnableLambda(timed("prompt_build", kb.prompt.invoke)),
+        id(kb.chat_model): RunnableLambda(timed("generate", llm.invoke)),
+    }
+    return RunnableSequence(*[steps.get(id(step), step) for step in kb.chain.steps])
+
+# One query through the chain, returns the seconds spent in each stage
+def run_query(chain: RunnableSequence, question: str) -> dict:
+    timings = dict.fromkeys(STAGES, 0.0)
+    token = _query_timings.set(timings)
+    start = time.perf_counter()
+    try:
+        chain.invoke(question)
+    finally:
+        _query_timings.reset(token)
+    timings["total"] = time.perf_counter() - start
+    # the vector store embeds the question inside its search
+    timings["vector_search"] -= timings["embed"]
+    return timings
+
+def stage_latencies(chain: RunnableSequence, queries: list[str], iterations: int) -> dict:
+    samples = {stage: [] for stage in STAGES}
+    for _ in range(iterations):
+        for question in queries:
+            for stage, seconds in run_query(chain, question).items():
+                samples[stage].append(seconds)
+    return {stage: percentiles(values) for stage, values in samples.items()}
+
+def throughput(chain: RunnableSequence, queries: list[str], concurrency: int, requests: int) -> dict:
+    batch = [queries[i % len(queries)] for i in range(requests)]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        totals = [timings["total"] for timings in executor.map(lambda q: run_query(chain, q), batch)]
+    elapsed = time.perf_counter() - start
+    return {"concurrency": concurrency, "requests": requests, "qps": requests / elapsed, **percentiles(totals)}
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description="Latency per stage and throughput of the RAG pipeline")
+    parser.add_argument("--data-dir", type=str, required=True, help="Directory of the knowledge base")
+    parser.add_argument("--query-sets", nargs="+", choices=["synthetic", "recorded"], default=["synthetic", "recorded"])
+    parser.add_argument("--queries", type=str, default=DEFAULT_DATASET, help="Recorded queries, JSON or JSONL")
+    parser.add_argument("--synthetic-count", type=int, default=50)
+    parser.add_argument("--k", type=int, default=4, help="Documents retrieved per query, the retriever's default")
+    parser.add_argument("--iterations", type=int, default=3, help="Passes over a query set for the stage latencies")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--requests", type=int, default=64, help="Queries sent per concurrency level")
+    parser.add_argument("--real", action="store_true", help="Generate with the knowledge base's chat model instead of the stub")
+    parser.add_argument("--cold", action="store_true", help="Embed with the model itself, not through the embedding cache")
+    parser.add_argument("--stub-first-token-ms", type=float, default=200)
+    parser.add_argument("--stub-tokens-per-second", type=float, default=50)
+    parser.add_argument("--stub-answer-tokens", type=int, default=64)
+    parser.add_argument("--output", type=str, default="bench_latency.json")
+    args = parser.parse_args()
+
+    kb = DiabetesKnowledgeBase(args.data_dir)
+    llm = kb.chat_model if args.real else StubLLM(args.stub_first_token_ms, args.stub_tokens_per_second, args.stub_answer_tokens)
+    chain = instrument(kb, llm, args.k, args.cold)
+
+    query_sets = {}
+    if "synthetic" in args.query_sets:
+        query_sets["synthetic"] = synthetic_queries(args.synthetic_count)
+    if "recorded" in args.query_sets:
+        query_sets["recorded"] = recorded_queries(args.queries)
+
+    report = {
+        "timestamp": datetime.now().isoformat(),
+        "commit": git_commit(),
+        "machine": {"platform": platform.platform(), "python": platform.python_version(), "cpus": os.cpu_count()},
+        "settings": vars(args),
+        "documents": kb.store.count(),
+        "query_sets": {},
+    }
+
+    for name, queries in query_sets.items():
+        print(f"\n{name}: {len(queries)} queries")
+        stages = stage_latencies(chain, queries, args.iterations)
+        for stage, stats in stages.items():
+            print(f"{stage:>15}: p50 {stats['p50_ms']:8.2f} ms  p95 {stats['p95_ms']:8.2f} ms  p99 {stats['p99_ms']:8.2f} ms")
+
+        levels = []
+        for concurrency in args.concurrency:
+            result = throughput(chain, queries, concurrency, args.requests)
+            levels.append(result)
+            print(f"  concurrency {concurrency:>3}: {result['qps']:7.2f} QPS  p50 {result['p50_ms']:8.2f} ms  p95 {result['p95_ms']:8.2f} ms")
+        report["query_sets"][name] = {"queries": len(queries), "stages": stages, "throughput": levels}
+
+    if hasattr(kb.embeddings, "stats"):
+        report["embedding_cache"] = kb.embeddings.stats()
+    kb.close()
+
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"\nResults saved to {args.output}")
+
+if __name__ == "__main__":
+    main()
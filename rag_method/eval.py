@@ -1,21 +1,147 @@
+import os
+import re
 import json
+import hashlib
+import inspect
 import numpy as np
-from typing import List, Dict, Any, Tuple
-from sklearn.metrics.pairwise import cosine_similarity
-from sentence_transformers import SentenceTransformer
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Callable, List, Dict, Any, Optional, Tuple
 from rouge import Rouge
 from multimodal_rag import DiabetesKnowledgeBase
+from models import embedding_model_name, summary_model_id, summary_prompt_text, ollama_base_url
+from multi_query import multi_query_enabled, multi_query_paraphrase, multi_query_max
+from results_store import EvalResultsStore
+
+_SENTENCE_END = re.compile(r'(?<=[.!?])\s+')
+
+# Answer of get_base_model_answer when generation failed, it is never stored
+BASE_MODEL_ERROR = "Error generating answer"
+# The hallucination comparison retrieves with the default k of get_contexts_for_question
+COMPARISON_K = 10
+BASE_MODEL_TEMPLATE = """You are a question and answering chatbot. Answer the question below:
+        
+        Question: {question}
+        
+        Give a detailed and factual answer based on your knowledge.
+        """
+
+# Fingerprint of the inputs the generations depend on: the models and the server they run on, the
+# prompts, the retrieval settings, the questions and the version of the knowledge base. Runs with the same
+# fingerprint share their stored generations, so an interrupted run resumes and a change to the metrics
+# scores the stored answers again, while a change to any of these inputs generates everything again.
+# Code changes are not part of it, after changing how answers are generated pass --run-id or --fresh.
+def run_fingerprint(kb: DiabetesKnowledgeBase, eval_dataset_path: str) -> str:
+    with open(eval_dataset_path, 'rb') as f:
+        dataset_hash = hashlib.sha256(f.read()).hexdigest()
+    parts = {
+        "chat_model": getattr(kb.chat_model, "model", type(kb.chat_model).__name__),
+        "ollama_base_url": ollama_base_url,
+        "embedding_model": embedding_model_name,
+        "summary_model": summary_model_id,
+        "summary_prompt": summary_prompt_text,
+        "rag_prompt": kb.prompt.pretty_repr(),
+        "base_prompt": BASE_MODEL_TEMPLATE,
+        "retrieval": {
+            "search_kwargs": kb.retriever.search_kwargs,
+            "contexts_defaults": str(inspect.signature(kb.get_contexts_for_question)),
+            "comparison_k": COMPARISON_K,
+        },
+        "multi_query": [multi_query_enabled, multi_query_paraphrase, multi_query_max],
+        "dataset": dataset_hash,
+        "knowledge_base": {"processed_files": kb.processed_files, "documents": kb.store.count()},
+    }
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode('utf-8')).hexdigest()[:16]
 
 class RAGEvaluator:
-    def __init__(self, knowledge_base: DiabetesKnowledgeBase, eval_dataset_path: str):
+    def __init__(self, knowledge_base: DiabetesKnowledgeBase, eval_dataset_path: str,
+                 results_store: Optional[EvalResultsStore] = None, workers: int = 1, rescore_only: bool = False):
         self.kb = knowledge_base
+        # Answers and contexts are generated once per question and kept in the results store, if there is one
+        self.results_store = results_store
+        self.workers = workers
+        self.rescore_only = rescore_only
         self.eval_dataset = self._load_evaluation_dataset(eval_dataset_path)
-        self.model = SentenceTransformer('sentence-transformers/all-MiniLM-L6-v2')
+        # The knowledge base embeddings, so questions and contexts embedded during retrieval are not encoded again
+        self.model = knowledge_base.embeddings
         self.rouge = Rouge()
+        # Unit vector of every text encoded in this run, so each text is encoded once and metrics are matrix products
+        self._vectors: Dict[str, np.ndarray] = {}
         
     def _load_evaluation_dataset(self, path: str) -> List[Dict[str, Any]]:
         with open(path, 'r') as f:
             return json.load(f)
+
+    # A generated value of a question from the results store, produced and stored first if it is missing
+    def _generated(self, question: str, kind: str, produce: Callable[[], Any], keep: Callable[[Any], bool] = lambda value: True) -> Any:
+        if self.results_store is None:
+            return produce()
+
+        value = self.results_store.get(question, kind)
+        if value is not None:
+            return value
+        if self.rescore_only:
+            raise RuntimeError(f"No stored {kind} for question: {question[:80]}, run without --rescore first")
+
+        value = produce()
+        if keep(value):
+            self.results_store.put(question, kind, value)
+        return value
+
+    def _rag_answer(self, question: str) -> str:
+        return self._generated(question, "rag_answer", lambda: self.kb.answer_question(question))
+
+    def _base_answer(self, question: str) -> str:
+        return self._generated(question, "base_answer", lambda: self.get_base_model_answer(question),
+                               keep=lambda answer: answer != BASE_MODEL_ERROR)
+
+    def _contexts(self, question: str, k: int) -> List[str]:
+        return self._generated(question, f"contexts@{k}", lambda: self.kb.get_contexts_for_question(question, k=k))
+
+    # Generate the answers and contexts of every question that has none stored yet, workers questions at a time.
+    # Scoring afterwards only reads the store, so it never waits on the LLM.
+    def generate_all(self, k: int):
+        if self.results_store is None or self.rescore_only:
+            return
+
+        def generate(question: str):
+            self._rag_answer(question)
+            self._base_answer(question)
+            self._contexts(question, k)
+            self._contexts(question, COMPARISON_K)
+
+        questions = [question_data["question"] for question_data in self.eval_dataset]
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = {executor.submit(generate, question): question for question in questions}
+            for done, future in enumerate(as_completed(futures), start=1):
+                future.result()
+                print(f"Generated {done}/{len(questions)}: {futures[future][:80]}...")
+
+    # Encode the texts not seen yet in one batch and return the unit vectors of all of them, in order
+    def _encode(self, texts: List[str]) -> np.ndarray:
+        missing = [text for text in dict.fromkeys(texts) if text not in self._vectors]
+        if missing:
+            vectors = np.asarray(self.model.encode(missing), dtype=np.float32)
+            norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+            for text, vector in zip(missing, vectors / np.where(norms == 0, 1, norms)):
+                self._vectors[text] = vector
+
+        if not texts:
+            return np.zeros((0, 0), dtype=np.float32)
+        return np.stack([self._vectors[text] for text in texts])
+
+    # Answer sentences that need support from the contexts
+    def _supported_sentences(self, answer: str) -> List[str]:
+        sentences = [s for s in _SENTENCE_END.split(answer) if len(s.strip()) > 10]  # Filter out very short sentences
+        # Skip very short sentences or common phrases that might not need support
+        return [s for s in sentences if len(s.split()) >= 3 and not s.lower().startswith(("i don't", "i do not"))]
+
+    # The retrieved contexts split by sentences for more precise similarity
+    def _context_chunks(self, retrieved_contexts: List[str]) -> List[str]:
+        return [c for context in retrieved_contexts for c in _SENTENCE_END.split(context) if len(c.strip()) > 10]
+
+    # Sentences of an answer checked for hallucination, very short ones are skipped
+    def _hallucination_sentences(self, answer: str) -> List[str]:
+        return [s for s in _SENTENCE_END.split(answer) if len(s.strip()) > 0 and len(s.split()) >= 3]
             
     def evaluate_all(self) -> Dict[str, Any]:
         results = {
@@ -25,6 +151,9 @@ class RAGEvaluator:
         
         # Using fixed k=5
         k = 5
+
+        # Generate every answer and context first, in parallel, scoring below reads them from the store
+        self.generate_all(k)
         
         # Lists to collect metrics across all questions
         recall_at_k = []
@@ -77,10 +206,14 @@ class RAGEvaluator:
     # Evaluate a single question using multiple RAG metrics.
     def evaluate_question(self, question: str, ground_truth: str, expected_contexts: List[str], k: int) -> Dict[str, float]:
         # Get RAG system response
-        generated_answer = self.kb.answer_question(question)
+        generated_answer = self._rag_answer(question)
         
         # Get retrieved contexts
-        all_contexts = self.kb.get_contexts_for_question(question, k=k)
+        all_contexts = self._contexts(question, k)
+
+        # Encode everything the metrics below compare in one batch
+        self._encode([generated_answer, ground_truth, question] + all_contexts
+                     + self._supported_sentences(generated_answer) + self._context_chunks(all_contexts))
         
         # Calculate metrics
         metrics = {}
@@ -130,11 +263,10 @@ class RAGEvaluator:
         # Use semantic similarity with sentence embeddings
         try:
             # Get embeddings
-            generated_embedding = self.model.encode([generated_answer])[0]
-            truth_embedding = self.model.encode([ground_truth])[0]
+            generated_embedding, truth_embedding = self._encode([generated_answer, ground_truth])
             
             # Calculate cosine similarity
-            similarity = cosine_similarity([generated_embedding], [truth_embedding])[0][0]
+            similarity = float(generated_embedding @ truth_embedding)
             
             # Also use ROUGE scores for lexical comparison
             rouge_scores = self.rouge.get_scores(generated_answer, ground_truth)[0]
@@ -151,48 +283,24 @@ class RAGEvaluator:
     # Calculate faithfulness - how well the answer is grounded in the contexts.
     def calculate_faithfulness(self, generated_answer: str, retrieved_contexts: List[str]) -> float:
 
-        # Join all contexts into a single text
-        all_contexts_text = ' '.join(retrieved_contexts)
-        
         # Get embeddings
         try:
             # Split the answer into sentences for more granular analysis
-            import re
-            answer_sentences = re.split(r'(?<=[.!?])\s+', generated_answer)
-            answer_sentences = [s for s in answer_sentences if len(s.strip()) > 10]  # Filter out very short sentences
-            
-            # For each sentence in the answer, check if it's supported by the contexts
-            support_scores = []
-            
-            for sentence in answer_sentences:
-                # Skip very short sentences or common phrases that might not need support
-                if len(sentence.split()) < 3 or sentence.lower().startswith(("i don't", "i do not")):
-                    continue
-                    
-                # Get embedding for this sentence
-                sentence_embedding = self.model.encode([sentence])[0]
-                
-                # Split contexts into chunks for more precise similarity
-                context_chunks = []
-                for context in retrieved_contexts:
-                    # Simple chunking by sentences
-                    chunks = re.split(r'(?<=[.!?])\s+', context)
-                    context_chunks.extend([c for c in chunks if len(c.strip()) > 10])
-                
-                # Calculate similarity with each context chunk
-                max_similarity = 0
-                if context_chunks:
-                    context_embeddings = self.model.encode(context_chunks)
-                    similarities = cosine_similarity([sentence_embedding], context_embeddings)[0]
-                    max_similarity = max(similarities)
-                
-                support_scores.append(max_similarity)
+            answer_sentences = self._supported_sentences(generated_answer)
+            if not answer_sentences:
+                return 0.5  # Default if no evaluable sentences
+
+            # Split contexts into chunks, every sentence is scored against every chunk in one matrix product
+            context_chunks = self._context_chunks(retrieved_contexts)
+            if not context_chunks:
+                return 0.0
+
+            sentence_embeddings = self._encode(answer_sentences)
+            context_embeddings = self._encode(context_chunks)
+            support_scores = (sentence_embeddings @ context_embeddings.T).max(axis=1)
             
             # Overall faithfulness is the average support score across all sentences
-            if support_scores:
-                return float(np.mean(support_scores))
-            else:
-                return 0.5  # Default if no evaluable sentences
+            return float(np.mean(support_scores))
         except Exception as e:
             print(f"Error calculating faithfulness: {str(e)}")
             return 0.5
@@ -201,24 +309,16 @@ class RAGEvaluator:
     def calculate_context_relevance(self, retrieved_contexts: List[str], question: str) -> float:
     
         try:
-            # Get question embedding
-            question_embedding = self.model.encode([question])[0]
-            
-            # Calculate similarity for each context
-            relevance_scores = []
-            for context in retrieved_contexts:
-                if not context or len(context.strip()) < 10:
-                    continue
-                    
-                context_embedding = self.model.encode([context])[0]
-                similarity = cosine_similarity([question_embedding], [context_embedding])[0][0]
-                relevance_scores.append(similarity)
+            contexts = [context for context in retrieved_contexts if context and len(context.strip()) >= 10]
+            if not contexts:
+                return 0.0
+
+            # Similarity of the question to every context at once
+            question_embedding = self._encode([question])[0]
+            relevance_scores = self._encode(contexts) @ question_embedding
             
             # Overall relevance is the average across all contexts
-            if relevance_scores:
-                return float(np.mean(relevance_scores))
-            else:
-                return 0.0
+            return float(np.mean(relevance_scores))
         except Exception as e:
             print(f"Error calculating context relevance: {str(e)}")
             return 0.0
@@ -230,14 +330,7 @@ class RAGEvaluator:
         from langchain_core.output_parsers import StrOutputParser
         
         # Create a simple prompt for the base model
-        template = """You are a question and answering chatbot. Answer the question below:
-        
-        Question: {question}
-        
-        Give a detailed and factual answer based on your knowledge.
-        """
-        
-        prompt = ChatPromptTemplate.from_template(template)
+        prompt = ChatPromptTemplate.from_template(BASE_MODEL_TEMPLATE)
         
         # Use the same chat model as the one used in RAG system
         chain = prompt | self.kb.chat_model | StrOutputParser()
@@ -247,42 +340,29 @@ class RAGEvaluator:
             return chain.invoke({"question": question})
         except Exception as e:
             print(f"Error getting base model answer: {str(e)}")
-            return "Error generating answer"
+            return BASE_MODEL_ERROR
 
 
     # Helper method to calculate hallucination score for an answer against context
     def _calculate_hallucination_score(self, answer, context):
-  
-        from sklearn.metrics.pairwise import cosine_similarity
-        
-        # Split answer into sentences
-        import re
-        answer_sentences = re.split(r'(?<=[.!?])\s+', answer)
-        answer_sentences = [s for s in answer_sentences if len(s.strip()) > 0]
         
-        # Check each sentence for support in contexts
+        # Split answer into sentences, skipping very short ones
+        answer_sentences = self._hallucination_sentences(answer)
         total_sentences = len(answer_sentences)
-        unsupported_sentences = 0
+        if total_sentences == 0:
+            return 0
         
-        for sentence in answer_sentences:
-            # Skip very short sentences
-            if len(sentence.split()) < 3:
-                total_sentences -= 1
-                continue
-            
-            # Check if sentence is supported by context
-            try:
-                sentence_embedding = self.model.encode([sentence])
-                context_embedding = self.model.encode([context])
-                similarity = cosine_similarity(sentence_embedding, context_embedding)[0][0]
-                
-                # If similarity is below threshold, consider it unsupported
-                if similarity < 0.5:  # Threshold can be adjusted (can maybe try 0.25)
-                    unsupported_sentences += 1
-            except Exception as e:
-                print(f"Error calculating similarity: {str(e)}")
-                # Assume unsupported if calculation fails
-                unsupported_sentences += 1
+        # Check every sentence for support in the context at once
+        try:
+            context_embedding = self._encode([context])[0]
+            similarities = self._encode(answer_sentences) @ context_embedding
+
+            # If similarity is below threshold, consider it unsupported
+            unsupported_sentences = int(np.sum(similarities < 0.5))  # Threshold can be adjusted (can maybe try 0.25)
+        except Exception as e:
+            print(f"Error calculating similarity: {str(e)}")
+            # Assume unsupported if calculation fails
+            unsupported_sentences = total_sentences
         
         # Calculate hallucination score (percentage of unsupported sentences)
         return unsupported_sentences / total_sentences if total_sentences > 0 else 0
@@ -301,12 +381,16 @@ class RAGEvaluator:
             print(f"Processing question {i+1}/{len(self.eval_dataset)}")
             
             # Get answers from both models
-            rag_answer = self.kb.answer_question(question)
-            base_answer = self.get_base_model_answer(question)
+            rag_answer = self._rag_answer(question)
+            base_answer = self._base_answer(question)
             
             # Get retrieved contexts for evaluation
-            retrieved_contexts = self.kb.get_contexts_for_question(question)
+            retrieved_contexts = self._contexts(question, COMPARISON_K)
             combined_context = ' '.join(retrieved_contexts)
+
+            # Encode everything compared below in one batch
+            self._encode([ground_truth, rag_answer, base_answer, combined_context]
+                         + self._hallucination_sentences(rag_answer) + self._hallucination_sentences(base_answer))
             
             # Evaluate RAG model hallucination
             rag_hallucination_score = self._calculate_hallucination_score(rag_answer, combined_context)
@@ -315,12 +399,10 @@ class RAGEvaluator:
             base_hallucination_score = self._calculate_hallucination_score(base_answer, combined_context)
             
             # Calculate factual consistency with ground truth for both models
-            ground_truth_embedding = self.model.encode([ground_truth])
-            rag_answer_embedding = self.model.encode([rag_answer])
-            base_answer_embedding = self.model.encode([base_answer])
+            ground_truth_embedding, rag_answer_embedding, base_answer_embedding = self._encode([ground_truth, rag_answer, base_answer])
             
-            rag_factual_consistency = cosine_similarity(ground_truth_embedding, rag_answer_embedding)[0][0]
-            base_factual_consistency = cosine_similarity(ground_truth_embedding, base_answer_embedding)[0][0]
+            rag_factual_consistency = float(ground_truth_embedding @ rag_answer_embedding)
+            base_factual_consistency = float(ground_truth_embedding @ base_answer_embedding)
             
             # Calculate improvement percentage
             if base_hallucination_score > 0:
@@ -492,11 +574,24 @@ if __name__ == "__main__":
     parser.add_argument("--data-dir", type=str, required=True, help="Directory containing knowledge base PDFs")
     parser.add_argument("--eval-dataset", type=str, required=True, help="Path to evaluation dataset JSON")
     parser.add_argument("--output", type=str, default="rag_evaluation_report.json", help="Output path for evaluation report")
+    parser.add_argument("--workers", type=int, default=4, help="Questions generated concurrently")
+    parser.add_argument("--results-store", type=str, default="eval_results.sqlite", help="Where generated answers and contexts are kept between runs")
+    parser.add_argument("--run-id", type=str, default=None, help="Run whose generations to resume, by default the fingerprint of the models, prompts, settings, questions and knowledge base")
+    parser.add_argument("--fresh", action="store_true", help="Forget the stored answers and contexts of the run and generate them again")
+    parser.add_argument("--rescore", action="store_true", help="Only score the stored answers and contexts, generate nothing")
     
     args = parser.parse_args()
     
     kb = DiabetesKnowledgeBase(args.data_dir)
+
+    run_id = args.run_id or run_fingerprint(kb, args.eval_dataset)
+    results_store = EvalResultsStore(args.results_store, run_id)
+    if args.fresh:
+        results_store.clear()
+    print(f"Results store {args.results_store} holds {results_store.count()} generations of run {run_id}.")
     
-    evaluator = RAGEvaluator(kb, args.eval_dataset)
+    evaluator = RAGEvaluator(kb, args.eval_dataset, results_store, workers=args.workers, rescore_only=args.rescore)
     results = evaluator.evaluate_all() 
-    evaluator.generate_report(results, args.output)
\ No newline at end of file
+    evaluator.generate_report(results, args.output)
+    print(f"Embedding cache: {kb.embeddings.stats()}")
+    kb.close()
\ No newline at end of file
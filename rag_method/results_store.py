@@ -0,0 +1,61 @@
+import json
+import sqlite3
+import threading
+from datetime import datetime
+from typing import Any, Optional
+
+# Generated answers and retrieved contexts of an evaluation run, one row per run, question and kind
+# ("rag_answer", "base_answer", "contexts@5", ...). Every row is committed as soon as it is generated,
+# so an interrupted run resumes where it stopped and metrics can be scored again without generating.
+# A run only sees its own rows: the run id is the fingerprint of what the generations depend on,
+# so a run with another model, prompt or knowledge base generates everything again.
+class EvalResultsStore:
+    def __init__(self, path: str, run: str):
+        self.path = path
+        self.run = run
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL;")
+        self._connection.execute("PRAGMA synchronous=NORMAL;")
+        # rows of stores from before there were runs cannot be told apart, they are dropped
+        columns = [row[1] for row in self._connection.execute("PRAGMA table_info(generations)")]
+        if columns and "run" not in columns:
+            self._connection.execute("DROP TABLE generations")
+        self._connection.execute('''
+            CREATE TABLE IF NOT EXISTS generations (
+                run TEXT NOT NULL,
+                question TEXT NOT NULL,
+                kind TEXT NOT NULL,
+                value TEXT NOT NULL,
+                created_at TEXT NOT NULL,
+                PRIMARY KEY (run, question, kind)
+            )''')
+        self._connection.commit()
+
+    def get(self, question: str, kind: str) -> Optional[Any]:
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT value FROM generations WHERE run = ? AND question = ? AND kind = ?",
+                (self.run, question, kind)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put(self, question: str, kind: str, value: Any):
+        with self._lock:
+            with self._connection:
+                self._connection.execute(
+                    "INSERT OR REPLACE INTO generations (run, question, kind, value, created_at) VALUES (?, ?, ?, ?, ?)",
+                    (self.run, question, kind, json.dumps(value), datetime.now().isoformat()))
+
+    # Forget the generations of this run
+    def clear(self):
+        with self._lock:
+            with self._connection:
+                self._connection.execute("DELETE FROM generations WHERE run = ?", (self.run,))
+
+    def count(self) -> int:
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM generations WHERE run = ?", (self.run,)).fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._connection.close()